@@ -0,0 +1,110 @@
+"""Benchmark of the chunked backfill against a regular import of the same history.
+
+Both run on the same multi-year synthetic workload, mostly already in Firefly III, served by a
+fake Credit Agricole client and a local stub Firefly III server. Each one runs in its own
+process to compare their peak memory. They must store exactly the same transactions.
+
+Usage: python benchmarks/bench_backfill.py [number of days] [bank transactions per day] [chunk days]
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+import main  # noqa: E402
+from backfill import Backfill, BackfillCheckpoint  # noqa: E402
+from firefly_connector import FireflyConnector  # noqa: E402
+
+from fake_bank import FakeCreditAgricole  # noqa: E402
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+DUPLICATE_RATIO = 0.9
+
+
+def run(mode: str, days: int, per_day: int, chunk_days: int, results):
+    workload = SyntheticWorkload(
+        accounts=3, transactions_per_day=per_day, days=days, duplicate_ratio=DUPLICATE_RATIO
+    )
+    with StubFireflyServer(workload) as server:
+        connector = FireflyConnector(
+            Firefly_configuration(host=server.url + "/api", access_token="benchmark")
+        )
+        bank_client = FakeCreditAgricole(workload)
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        if mode == "import":
+            os.environ["GET_TRANSACTIONS_PERIOD_DAYS"] = str(days)
+            main.run_import(connector, bank_client)
+        else:
+            today = datetime.now().date()
+            with tempfile.TemporaryDirectory() as directory, BackfillCheckpoint(
+                os.path.join(directory, "checkpoint.sqlite")
+            ) as checkpoint:
+                backfill = Backfill(
+                    connector,
+                    bank_client,
+                    connector.get_firefly_accounts(),
+                    checkpoint,
+                    chunk_days=chunk_days,
+                )
+                backfill.run(
+                    bank_client.list_account(backfill.account_index),
+                    today - timedelta(days=days),
+                    today,
+                )
+        seconds = time.perf_counter() - start
+        digest = hashlib.sha256(
+            "\n".join(sorted(json.dumps(b, sort_keys=True) for b in server.stored)).encode()
+        ).hexdigest()
+        results.put(
+            {
+                "mode": mode,
+                "seconds": seconds,
+                "stored": len(server.stored),
+                "operations": workload.bank_transactions_count,
+                # ru_maxrss is in KiB on Linux
+                "peak_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "growth_mib": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024,
+                "digest": digest,
+            }
+        )
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 730
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    chunk_days = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    results = multiprocessing.Queue()
+    reports = {}
+    for mode in ("import", "backfill"):
+        process = multiprocessing.Process(target=run, args=(mode, days, per_day, chunk_days, results))
+        process.start()
+        reports[mode] = results.get()
+        process.join()
+    for mode, report in reports.items():
+        print(
+            "%-9s %7d operations, %6d stored in %7.2fs, peak memory %7.1f MiB (+%.1f MiB during the run)"
+            % (
+                mode,
+                report["operations"],
+                report["stored"],
+                report["seconds"],
+                report["peak_mib"],
+                report["growth_mib"],
+            )
+        )
+    if reports["import"]["digest"] != reports["backfill"]["digest"]:
+        print("The backfill did not store the same transactions as the import")
+        sys.exit(1)
+    print("Same transactions stored")
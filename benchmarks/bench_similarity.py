@@ -0,0 +1,68 @@
+"""Benchmark of the fuzzy libelle comparison used by the transfer detection.
+
+Checks on a generated corpus of noisy bank libelles that the SimilarityEngine takes
+the same decisions as difflib's ratio at the transfer threshold, then compares their speed.
+
+Usage: python benchmarks/bench_similarity.py [number of libelles]
+"""
+import difflib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from Util.Transactions.similarity import SimilarityEngine  # noqa: E402
+from Util.Transactions.transfer_detection import TRANSFER_SIMILARITY_RATIO  # noqa: E402
+
+PREFIXES = ["VIR SEPA", "VIR INST", "PRLV SEPA", "CARTE X1234", "VIREMENT EMIS", ""]
+NAMES = ["LIVRET A", "M DUPONT JEAN", "EDF CLIENTS", "SFR", "LECLERC", "CPAM", "LOYER", "URSSAF"]
+
+
+def libelles(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        libelle = "%s %s %s" % (
+            rng.choice(PREFIXES),
+            rng.choice(NAMES),
+            rng.choice(["", "REF %06d" % rng.randint(0, 999999), "%02d/%02d" % (rng.randint(1, 28), rng.randint(1, 12))]),
+        )
+        # noise: dropped or duplicated characters
+        if rng.random() < 0.3:
+            i = rng.randrange(len(libelle))
+            libelle = libelle[:i] + libelle[i + 1 :]
+        corpus.append(libelle.strip())
+    return corpus
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    corpus = libelles(count)
+    pairs = [(a, b) for a in corpus for b in corpus]
+
+    start = time.perf_counter()
+    expected = [
+        difflib.SequenceMatcher(None, a, b).ratio() >= TRANSFER_SIMILARITY_RATIO
+        for a, b in pairs
+    ]
+    difflib_duration = time.perf_counter() - start
+
+    engine = SimilarityEngine()
+    start = time.perf_counter()
+    decisions = [engine.is_similar(a, b, TRANSFER_SIMILARITY_RATIO) for a, b in pairs]
+    engine_duration = time.perf_counter() - start
+
+    mismatches = sum(1 for e, d in zip(expected, decisions) if e != d)
+    print(f"pairs: {len(pairs)}, similar: {sum(expected)}, mismatches: {mismatches}")
+    print(f"difflib: {difflib_duration:.2f}s, engine: {engine_duration:.2f}s, speedup x{difflib_duration / engine_duration:.1f}")
+    print(
+        f"rejected by length: {engine.rejected_by_length}, by characters: {engine.rejected_by_characters}, memo: {engine.cache_info()}"
+    )
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark of the streaming import against the batch import.
+
+Runs both imports on the same synthetic workload, served by a fake Credit Agricole client with
+a latency per bank request and a local stub Firefly III server, checks that they store exactly
+the same transactions, then compares their duration and when the first transaction was stored.
+
+Usage: python benchmarks/bench_streaming.py [number of bank transactions] [bank latency in seconds]
+"""
+import functools
+import json
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+import main  # noqa: E402
+from firefly_connector import FireflyConnector  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+from fake_bank import FakeCreditAgricole  # noqa: E402
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+DAYS = 180
+
+
+class SlowFakeCreditAgricole(FakeCreditAgricole):
+    """Fake client taking `latency` seconds per bank request, in a slot of its request limiter
+    like the requests of the real client"""
+
+    def __init__(self, workload: SyntheticWorkload, latency: float):
+        super().__init__(workload)
+        self.latency = latency
+
+    def _call_bank(self, function, *args, **kwargs):
+        @functools.wraps(function)
+        def slow_function(*args, **kwargs):
+            time.sleep(self.latency)
+            return function(*args, **kwargs)
+
+        return super()._call_bank(slow_function, *args, **kwargs)
+
+
+def run(size: int, latency: float, streaming: bool) -> dict:
+    os.environ["GET_TRANSACTIONS_PERIOD_DAYS"] = str(DAYS)
+    os.environ["STREAMING_IMPORT"] = "1" if streaming else "0"
+    workload = SyntheticWorkload(accounts=3, transactions_per_day=max(1, size // DAYS), days=DAYS)
+    metrics.reset()
+    with StubFireflyServer(workload) as server:
+        first_store = []
+        handle_post = server.handle_post
+
+        def timed_handle_post(request, body):
+            if not first_store:
+                first_store.append(time.perf_counter())
+            handle_post(request, body)
+
+        server.handle_post = timed_handle_post
+        connector = FireflyConnector(
+            Firefly_configuration(host=server.url + "/api", access_token="benchmark")
+        )
+        start = time.perf_counter()
+        main.run_import(connector, SlowFakeCreditAgricole(workload, latency))
+        seconds = time.perf_counter() - start
+        return {
+            "stored": sorted(json.dumps(b, sort_keys=True) for b in server.stored),
+            "seconds": seconds,
+            "first_store": (first_store[0] - start) if first_store else None,
+            "max_pending": metrics.gauges.get("streaming_max_pending_operations"),
+        }
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    batch = run(size, latency, streaming=False)
+    streaming = run(size, latency, streaming=True)
+    for name, result in (("batch", batch), ("streaming", streaming)):
+        print(
+            "%-10s %6d stored in %7.3fs, first stored after %7.3fs, at most %s operations held"
+            % (name, len(result["stored"]), result["seconds"], result["first_store"] or 0, result["max_pending"])
+        )
+    if batch["stored"] != streaming["stored"]:
+        print("The streaming import did not store the same transactions as the batch import")
+        sys.exit(1)
+    print("Same transactions stored")
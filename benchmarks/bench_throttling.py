@@ -0,0 +1,180 @@
+"""Check of the adaptive concurrency against a Firefly III instance that throttles.
+
+Runs an import against a local stub Firefly III server like a small PHP-FPM pool: a few workers
+serve the requests, as many requests can wait for a free worker, and the requests beyond are
+answered 429 Too Many Requests with a Retry-After header. The connector is given many more
+workers than the server can take, once with a fixed concurrency and once with the adaptive
+limiter. The adaptive run must store every transaction, and its concurrency must settle within
+what the server accepts with few throttled requests.
+Then downloads the transaction pages from a server that is not overloaded but answers them much
+slower than the accounts: the adaptive limiter must not lower the concurrency for it.
+
+Usage: python benchmarks/bench_throttling.py [number of bank transactions] [server capacity] [connector workers]
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+import main  # noqa: E402
+from adaptive_limiter import AdaptiveLimiter  # noqa: E402
+from firefly_connector import FireflyConnector, StoreStatus  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+from fake_bank import FakeCreditAgricole  # noqa: E402
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+DAYS = 60
+SERVER_LATENCY = 0.02
+RETRY_AFTER = "1"
+# share of the requests answered 429 accepted once the concurrency has settled
+MAX_THROTTLED_SHARE = 0.1
+# latency of the transaction pages of the run with different latencies per endpoint
+PAGE_LATENCY = 0.3
+
+
+def run(size: int, capacity: int, workers: int, adaptive: bool) -> dict:
+    os.environ["GET_TRANSACTIONS_PERIOD_DAYS"] = str(DAYS)
+    os.environ["STREAMING_IMPORT"] = "0"
+    workload = SyntheticWorkload(accounts=3, transactions_per_day=max(1, size // DAYS), days=DAYS)
+    limiter = (
+        AdaptiveLimiter("firefly", max_limit=workers)
+        if adaptive
+        else AdaptiveLimiter("firefly", max_limit=workers, min_limit=workers, latency_tolerance=None)
+    )
+    metrics.reset()
+    with StubFireflyServer(
+        workload,
+        latency=SERVER_LATENCY,
+        capacity=capacity,
+        queue_size=capacity,  # requests waiting for a worker, beyond them the server throttles
+        retry_after=RETRY_AFTER,
+    ) as server:
+        connector = FireflyConnector(
+            Firefly_configuration(host=server.url + "/api", access_token="benchmark"),
+            max_workers=workers,
+            limiter=limiter,
+        )
+        # the limit over time, sampled every 50ms
+        limits = []
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                limits.append(int(limiter.limit))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            results = main.run_import(connector, FakeCreditAgricole(workload))
+        finally:
+            done.set()
+            sampler.join()
+        seconds = time.perf_counter() - start
+        # the second half of the run, once the limit had time to settle
+        settled = limits[len(limits) // 2 :] or [int(limiter.limit)]
+        return {
+            "seconds": seconds,
+            "stored": sum(1 for r in results if r.status == StoreStatus.STORED),
+            "failed": sum(1 for r in results if r.status == StoreStatus.FAILED),
+            "requests": server.requests,
+            "throttled": server.throttled,
+            "max_in_flight": server.max_in_flight,
+            "settled_limit": (min(settled), max(settled)),
+            "decreases": metrics.counters.get("firefly_concurrency_decreases", 0),
+            "pauses": metrics.counters.get("firefly_retry_after_pauses", 0),
+        }
+
+
+def run_endpoints(workers: int) -> dict:
+    """Download the transaction pages, slower than the accounts, from a server without throttling"""
+    workload = SyntheticWorkload(accounts=workers, transactions_per_day=2, days=30, duplicate_ratio=0.8)
+    limiter = AdaptiveLimiter("firefly", max_limit=workers)
+    metrics.reset()
+    with StubFireflyServer(
+        workload, page_size=10, latency=SERVER_LATENCY, page_latency=PAGE_LATENCY
+    ) as server:
+        connector = FireflyConnector(
+            Firefly_configuration(host=server.url + "/api", access_token="benchmark"),
+            max_workers=workers,
+            limiter=limiter,
+        )
+        start = time.perf_counter()
+        accounts = connector.get_firefly_accounts()
+        for _ in connector.get_firefly_transactions(accounts, period_days=None):
+            pass
+        return {
+            "seconds": time.perf_counter() - start,
+            "pages": server.pages_served,
+            "max_in_flight": server.max_in_flight,
+            "limit": int(limiter.limit),
+            "decreases": metrics.counters.get("firefly_concurrency_decreases", 0),
+        }
+
+
+if __name__ == "__main__":
+    # the retries of the throttled requests are expected
+    logging.disable(logging.WARNING)
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    results = {
+        "fixed": run(size, capacity, workers, adaptive=False),
+        "adaptive": run(size, capacity, workers, adaptive=True),
+    }
+    endpoints = run_endpoints(capacity)
+    for name, result in results.items():
+        print(
+            "%-9s %5d stored, %3d failed in %6.2fs: %5d requests, %4d throttled, "
+            "%2d Retry-After pauses, %2d decreases, limit settled in %s"
+            % (
+                name,
+                result["stored"],
+                result["failed"],
+                result["seconds"],
+                result["requests"],
+                result["throttled"],
+                result["pauses"],
+                result["decreases"],
+                result["settled_limit"],
+            )
+        )
+
+    print(
+        "endpoints %5d pages of %.1fs in %6.2fs: at most %d in flight, %2d decreases, limit ended at %d"
+        % (
+            endpoints["pages"],
+            PAGE_LATENCY,
+            endpoints["seconds"],
+            endpoints["max_in_flight"],
+            endpoints["decreases"],
+            endpoints["limit"],
+        )
+    )
+
+    adaptive = results["adaptive"]
+    problems = []
+    if adaptive["failed"]:
+        problems.append("%d transactions failed" % adaptive["failed"])
+    # the requests served and queued, plus the one the limit probes with before backing off
+    accepted = 2 * capacity
+    if adaptive["settled_limit"][1] > accepted + 1:
+        problems.append("the limit settled above the %d requests the server accepts" % accepted)
+    if adaptive["throttled"] > MAX_THROTTLED_SHARE * adaptive["requests"]:
+        problems.append("%d of %d requests were throttled" % (adaptive["throttled"], adaptive["requests"]))
+    if endpoints["decreases"] or endpoints["limit"] < capacity:
+        problems.append(
+            "slower transaction pages lowered the limit to %d without throttling" % endpoints["limit"]
+        )
+    if problems:
+        print("The adaptive concurrency did not converge: " + ", ".join(problems))
+        sys.exit(1)
+    print("The adaptive concurrency converged without failures")
@@ -0,0 +1,82 @@
+"""Micro-benchmark of the construction cost and memory footprint of TransactionCustom.
+
+The previous dict based implementation is kept below as a reference point.
+
+Usage: python benchmarks/bench_transaction_custom.py [number of objects]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from dateutil import tz
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from firefly_iii_client.models.transaction_type_property import TransactionTypeProperty  # noqa: E402
+
+from Util.Transactions.Transaction_custom import TransactionCustom  # noqa: E402
+
+
+class LegacyTransactionCustom:
+    def __init__(
+        self,
+        date,
+        libelle,
+        amount,
+        found_account_number,
+        origin_account_number,
+        transaction_type,
+        destination_account_number=None,
+    ):
+        self.found_account_number = found_account_number
+        self.origin_account_number = origin_account_number
+        self.date = date
+        if not isinstance(date, datetime):
+            self.date = datetime.strptime(date, "%b %d, %Y, %I:%M:%S %p")
+        self.date = self.date.replace(tzinfo=tz.gettz("Europe / Berlin"))
+        self.libelle = libelle
+        self.amount = abs(amount)
+        self.destination_account_number = destination_account_number
+        self.type = transaction_type
+
+
+def operations(count: int):
+    return [
+        dict(
+            date="Jan %02d, 2024, 12:00:00 AM" % (i % 28 + 1),
+            libelle="PRLV SEPA FOURNISSEUR %d" % (i % 50),
+            amount=-(i % 1000) / 7,
+            found_account_number="0001",
+            origin_account_number="0001",
+            transaction_type=TransactionTypeProperty.WITHDRAWAL,
+        )
+        for i in range(count)
+    ]
+
+
+def measure(cls, ops):
+    start = time.perf_counter()
+    objects = [cls(**op) for op in ops]
+    elapsed = time.perf_counter() - start
+    del objects
+
+    tracemalloc.start()
+    objects = [cls(**op) for op in ops]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return elapsed / len(ops), size / len(ops)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    ops = operations(count)
+    for name, cls in (("before", LegacyTransactionCustom), ("after", TransactionCustom)):
+        duration, size = measure(cls, ops)
+        print(f"{name:>6}: {duration * 1e6:8.2f} us/object {size:8.0f} bytes/object")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Check of the checkpoint of the backfill.
+
+Runs a backfill against a fake Credit Agricole client and a local stub Firefly III server, and
+makes a store fail in the middle of a chunk, which stops the backfill after the chunks before it.
+Running the backfill again must skip exactly these chunks and end with the same transactions
+stored as a backfill that was never interrupted. The bank session expires after every request,
+so each chunk must renew it. Finally, the checkpoint must refuse a backfill with another first
+day or chunk size.
+
+Usage: python benchmarks/check_backfill_resume.py [chunks before the failure]
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+from backfill import Backfill, BackfillCheckpoint  # noqa: E402
+from banks_clients.configuration import Configuration as Bank_configuration  # noqa: E402
+from firefly_connector import FireflyConnector, StoreResult, StoreStatus  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+from fake_bank import FakeCreditAgricole  # noqa: E402
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+DAYS = 120
+CHUNK_DAYS = 20
+
+
+class FailingConnector(FireflyConnector):
+    """Connector failing the second half of the stores of the given call, the first half being stored"""
+
+    def __init__(self, configuration, failing_call: int):
+        super().__init__(configuration)
+        self.failing_call = failing_call
+        self.calls = 0
+
+    def create_firefly_transactions(self, transaction):
+        self.calls += 1
+        if self.calls != self.failing_call:
+            return super().create_firefly_transactions(transaction)
+        half = len(transaction) // 2
+        return super().create_firefly_transactions(transaction[:half]) + [
+            StoreResult(t, StoreStatus.FAILED, 1) for t in transaction[half:]
+        ]
+
+
+def backfill(server, checkpoint, connector=None, date_start=None, chunk_days=CHUNK_DAYS) -> dict:
+    connector = connector or FireflyConnector(
+        Firefly_configuration(host=server.url + "/api", access_token="check")
+    )
+    # every chunk finds the session expired
+    bank_client = FakeCreditAgricole(server.workload, Bank_configuration(session_ttl=0))
+    bank_client.login()
+    today = datetime.now().date()
+    run = Backfill(
+        connector, bank_client, connector.get_firefly_accounts(), checkpoint, chunk_days=chunk_days
+    )
+    return run.run(
+        bank_client.list_account(run.account_index),
+        date_start or today - timedelta(days=DAYS),
+        today,
+    )
+
+
+def stored(server) -> list:
+    return sorted(json.dumps(b, sort_keys=True) for b in server.stored)
+
+
+def workload() -> SyntheticWorkload:
+    return SyntheticWorkload(accounts=3, transactions_per_day=20, days=DAYS, duplicate_ratio=0.5)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    interrupted_after = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    problems = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        with StubFireflyServer(workload()) as server, BackfillCheckpoint(
+            os.path.join(directory, "reference.sqlite")
+        ) as checkpoint:
+            backfill(server, checkpoint)
+            reference = stored(server)
+
+        path = os.path.join(directory, "checkpoint.sqlite")
+        with StubFireflyServer(workload()) as server:
+            with BackfillCheckpoint(path) as checkpoint:
+                connector = FailingConnector(
+                    Firefly_configuration(host=server.url + "/api", access_token="check"),
+                    failing_call=interrupted_after + 1,
+                )
+                try:
+                    backfill(server, checkpoint, connector)
+                    problems.append("the failed store did not stop the backfill")
+                except Exception as e:
+                    print("Stopped: %s" % e)
+
+            metrics.reset()
+            with BackfillCheckpoint(path) as checkpoint:
+                summary = backfill(server, checkpoint)
+            logins = metrics.counters.get("bank_logins", 0)
+            print(
+                "Resumed: %(chunks_skipped)s chunks skipped, %(chunks_imported)s imported, "
+                "%(stored)s transactions stored" % summary + ", %d bank logins" % logins
+            )
+            if summary["chunks_skipped"] != interrupted_after:
+                problems.append(
+                    "%s chunks skipped instead of %s" % (summary["chunks_skipped"], interrupted_after)
+                )
+            if stored(server) != reference:
+                problems.append(
+                    "%d transactions stored instead of the %d of an uninterrupted backfill"
+                    % (len(server.stored), len(reference))
+                )
+            if logins <= summary["chunks_imported"]:
+                problems.append("the expired bank session was not renewed for every chunk")
+
+            for name, other in (
+                ("first day", {"date_start": datetime.now().date() - timedelta(days=DAYS - 1)}),
+                ("chunk size", {"chunk_days": CHUNK_DAYS + 1}),
+            ):
+                with BackfillCheckpoint(path) as checkpoint:
+                    try:
+                        backfill(server, checkpoint, **other)
+                        problems.append("a checkpoint made for another %s was accepted" % name)
+                    except Exception as e:
+                        print("Refused another %s: %s" % (name, e))
+
+    if problems:
+        print("Backfill resume check failed: " + ", ".join(problems))
+        sys.exit(1)
+    print("The resumed backfill stored the same transactions as an uninterrupted one")
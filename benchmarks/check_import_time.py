@@ -0,0 +1,75 @@
+"""Check the startup cost of the importer with python -X importtime.
+
+Fails when importing main loads the generated Firefly III client, which must only be imported
+when a connector is created, or when the cumulative import time of main exceeds the budget.
+The time is the median of several runs in fresh interpreters.
+
+Usage: python benchmarks/check_import_time.py [--budget 0.5] [--runs 5]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+# modules that must stay free of the Firefly III client
+CHECKED_MODULES = [
+    "main",
+    "Util.Transactions.Transaction_custom",
+    "Util.Transactions.transfer_detection",
+    "Util.Transactions.duplicates",
+    "Util.Accounts.account_index",
+]
+HEAVY_PACKAGE = "firefly_iii_client"
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def import_times(module: str) -> dict:
+    """Cumulative import time in seconds of every top level and nested module loaded by the import"""
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        p for p in (SRC_DIR, environment.get("PYTHONPATH")) if p
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        capture_output=True,
+        text=True,
+        env=environment,
+    )
+    if result.returncode != 0:
+        raise Exception("Could not import %s:\n%s" % (module, result.stderr[-2000:]))
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2)) / 1e6
+    return times
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=0.5, help="Seconds allowed to import main")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    failures = []
+    for module in CHECKED_MODULES:
+        heavy = sorted(m for m in import_times(module) if m.split(".")[0] == HEAVY_PACKAGE)
+        if heavy:
+            failures.append("importing %s loads %s" % (module, ", ".join(heavy[:5])))
+
+    seconds = statistics.median(import_times("main")["main"] for _ in range(args.runs))
+    print("main imported in %.3fs (budget %.3fs)" % (seconds, args.budget))
+    if seconds > args.budget:
+        failures.append("main imported in %.3fs, over the budget of %.3fs" % (seconds, args.budget))
+
+    if failures:
+        print("Startup regressions:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("Startup within budget, %s is not imported" % HEAVY_PACKAGE)
+
+
+if __name__ == "__main__":
+    main_cli()
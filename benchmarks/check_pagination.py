@@ -0,0 +1,77 @@
+"""Check of the concurrent download of the Firefly III transaction pages.
+
+Downloads the transactions of several accounts from a local stub Firefly III server with a small
+page size, so that every account spans many pages. Fails unless every transaction is received
+exactly once, every page is requested exactly once and several requests were in flight together.
+
+Usage: python benchmarks/check_pagination.py [page size] [connector workers]
+"""
+import math
+import os
+import sys
+from collections import Counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+from firefly_connector import FireflyConnector  # noqa: E402
+
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+# slow enough responses for the pages to overlap
+SERVER_LATENCY = 0.01
+
+
+if __name__ == "__main__":
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    workload = SyntheticWorkload(accounts=4, transactions_per_day=5, days=30, duplicate_ratio=0.8)
+    # a transfer is listed under both of its accounts
+    expected = Counter(
+        group["id"] for groups in workload.firefly_transactions.values() for group in groups
+    )
+    expected_pages = sum(
+        max(1, math.ceil(len(groups) / page_size))
+        for groups in workload.firefly_transactions.values()
+    )
+
+    with StubFireflyServer(workload, latency=SERVER_LATENCY) as server:
+        connector = FireflyConnector(
+            Firefly_configuration(host=server.url + "/api", access_token="check"),
+            max_workers=workers,
+            page_size=page_size,
+        )
+        accounts = connector.get_firefly_accounts()
+        received = Counter(
+            group.id
+            for page in connector.get_firefly_transactions(accounts, period_days=None)
+            for group in page.data
+        )
+
+    print(
+        "%d transactions received in %d pages of %d from %d accounts, at most %d requests in flight"
+        % (
+            sum(received.values()),
+            server.pages_served,
+            page_size,
+            len(accounts),
+            server.max_in_flight,
+        )
+    )
+    problems = []
+    if received != expected:
+        problems.append(
+            "%d transactions missing, %d received more than expected"
+            % (sum((expected - received).values()), sum((received - expected).values()))
+        )
+    if server.pages_served != expected_pages:
+        problems.append("%d pages requested instead of %d" % (server.pages_served, expected_pages))
+    if workers > 1 and server.max_in_flight <= 1:
+        problems.append("the pages were not fetched concurrently")
+    if problems:
+        print("Pagination check failed: " + ", ".join(problems))
+        sys.exit(1)
+    print("Every transaction received exactly once")
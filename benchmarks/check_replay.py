@@ -0,0 +1,84 @@
+"""Check that replaying a capture reproduces the captured import.
+
+Captures an import run against a fake Credit Agricole client and a local stub Firefly III server
+as if it had run a few days ago, then replays the capture without network. The replay must give
+the same store results as the captured import. The same replay run as of today must give
+different results, otherwise the workload does not exercise the windows of the import.
+
+Usage: python benchmarks/check_replay.py [days since the capture]
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+import main  # noqa: E402
+from capture import Capture, CaptureWriter, ReplayBankClient, ReplayFireflyConnector  # noqa: E402
+from firefly_connector import FireflyConnector  # noqa: E402
+
+from fake_bank import FakeCreditAgricole  # noqa: E402
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+PERIOD_DAYS = 30
+
+
+def outcomes(results) -> set:
+    return {
+        (r.status.value, json.dumps(r.transaction.to_dict(), sort_keys=True, default=str))
+        for r in results
+    }
+
+
+def replay(path: str, now: datetime = None) -> set:
+    capture = Capture(path)
+    with ReplayFireflyConnector(capture) as connector:
+        return outcomes(main.run_import(connector, ReplayBankClient(capture), now=now))
+
+
+if __name__ == "__main__":
+    logging.disable(logging.WARNING)
+    days_ago = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    os.environ["GET_TRANSACTIONS_PERIOD_DAYS"] = str(PERIOD_DAYS)
+    workload = SyntheticWorkload(accounts=3, transactions_per_day=10, days=2 * PERIOD_DAYS)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "capture.jsonl.gz")
+        with StubFireflyServer(workload) as server, CaptureWriter(
+            path, now=datetime.now() - timedelta(days=days_ago)
+        ) as capture:
+            connector = FireflyConnector(
+                Firefly_configuration(host=server.url + "/api", access_token="check")
+            )
+            captured = outcomes(
+                main.run_import(
+                    connector, FakeCreditAgricole(workload), capture=capture, now=capture.now
+                )
+            )
+
+        replayed = replay(path, now=Capture(path).now)
+        replayed_today = replay(path)
+
+    print(
+        "captured %d store results %d days ago, replayed %d, %d when replayed as of today"
+        % (len(captured), days_ago, len(replayed), len(replayed_today))
+    )
+    problems = []
+    if replayed != captured:
+        problems.append(
+            "%d results missing from the replay, %d not in the capture"
+            % (len(captured - replayed), len(replayed - captured))
+        )
+    if days_ago and replayed_today == captured:
+        problems.append("replaying as of today gave the same results, the check proves nothing")
+    if problems:
+        print("Replay check failed: " + ", ".join(problems))
+        sys.exit(1)
+    print("The replay reproduced the captured import")
@@ -0,0 +1,51 @@
+"""Credit Agricole client serving a synthetic workload instead of the bank API."""
+import logging
+import time
+from typing import Dict, List
+
+from adaptive_limiter import AdaptiveLimiter
+from banks_clients import CreditAgricole
+from banks_clients.configuration import Configuration
+from metrics import metrics
+from Util.Accounts.account_index import AccountIndex
+
+from synthetic import SyntheticAccount, SyntheticWorkload
+
+
+class FakeCreditAgricole(CreditAgricole):
+    """CreditAgricole client without login, listing the accounts of a synthetic workload.
+    The conversion of the operations is the one of the real client.
+
+    :param workload: The synthetic workload to serve
+    :param configuration: A bank configuration object, only used for the fetching options
+    """
+
+    def __init__(self, workload: SyntheticWorkload, configuration: Configuration = None):
+        self.workload = workload
+        self.configuration = configuration or Configuration()
+        self.logger = logging.getLogger(__name__)
+        self.request_limiter = AdaptiveLimiter(
+            "bank", max_limit=max(1, self.configuration.max_workers or 1)
+        )
+        self.capture = None
+        self.session = None
+        self.failed_accounts: Dict[str, Exception] = {}
+
+    def login(self):
+        """Open a session without the bank, so that the session renewals can be exercised"""
+        metrics.increment("bank_logins")
+        self.session = object()
+        self.logged_in_at = time.monotonic()
+
+    def list_account(self, reference_accounts: AccountIndex = None) -> List[SyntheticAccount]:
+        if self.capture is not None:
+            self.capture.record_bank_accounts(self.workload.bank_accounts)
+        if reference_accounts is None:
+            return list(self.workload.bank_accounts)
+        if not isinstance(reference_accounts, AccountIndex):
+            reference_accounts = AccountIndex(reference_accounts)
+        return [
+            a
+            for a in self.workload.bank_accounts
+            if reference_accounts.has_account_number(a.numeroCompte)
+        ]
@@ -0,0 +1,191 @@
+"""Offline benchmark of the whole import pipeline.
+
+A synthetic workload is served by a fake Credit Agricole client and a local stub Firefly III server,
+and every stage of the import is timed with its peak memory. The results are compared with a
+stored baseline and the run fails when a stage regressed past the tolerance.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--sizes 1000,10000,100000] [--update-baseline]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+from firefly_iii_client.configuration import Configuration as Firefly_configuration  # noqa: E402
+
+import main  # noqa: E402
+from firefly_connector import FireflyConnector  # noqa: E402
+from Util.Accounts.account_index import AccountIndex  # noqa: E402
+
+from fake_bank import FakeCreditAgricole  # noqa: E402
+from stub_firefly import StubFireflyServer  # noqa: E402
+from synthetic import SyntheticWorkload  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+DAYS = 180
+# differences below this number of seconds are considered noise
+NOISE_FLOOR_SECONDS = 0.05
+
+
+class StageRecorder:
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name: str, items: int, function, *args, **kwargs):
+        tracemalloc.reset_peak()
+        memory_start, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        self.stages[name] = {
+            "items": items,
+            "seconds": round(seconds, 4),
+            "throughput": round(items / seconds, 1) if seconds else None,
+            "peak_bytes": peak - memory_start,
+        }
+        return result
+
+
+def run_pipeline(size: int, accounts: int = 3) -> dict:
+    workload = SyntheticWorkload(
+        accounts=accounts, transactions_per_day=max(1, size // DAYS), days=DAYS
+    )
+    recorder = StageRecorder()
+
+    with StubFireflyServer(workload) as server:
+        connector = FireflyConnector(
+            Firefly_configuration(host=server.url + "/api", access_token="benchmark")
+        )
+        bank_client = FakeCreditAgricole(workload)
+
+        firefly_accounts = recorder.run("firefly_accounts", 1, connector.get_firefly_accounts)
+        account_index = AccountIndex(firefly_accounts)
+        firefly_pages = recorder.run(
+            "firefly_download",
+            sum(len(t) for t in workload.firefly_transactions.values()),
+            lambda: list(connector.get_firefly_transactions(firefly_accounts, DAYS)),
+        )
+        firefly_transactions = recorder.run(
+            "firefly_convert",
+            sum(len(p.data) for p in firefly_pages),
+            connector.convert_to_custom_transactions,
+            firefly_pages,
+            account_index,
+        )
+        bank_accounts = bank_client.list_account(account_index)
+        bank_transactions = recorder.run(
+            "bank_fetch",
+            workload.bank_transactions_count,
+            bank_client.list_transactions,
+            bank_accounts,
+            DAYS,
+        )
+        recorder.run(
+            "check_transfers", len(bank_transactions), main.check_transfers, bank_transactions
+        )
+        recorder.run(
+            "check_duplicates",
+            len(bank_transactions),
+            main.check_duplicates,
+            firefly_transactions,
+            bank_transactions,
+        )
+        new_transactions = recorder.run(
+            "convert_to_firefly",
+            len(bank_transactions),
+            connector.convert_to_firefly_transactions,
+            bank_transactions,
+            account_index,
+        )
+        recorder.run(
+            "store", len(new_transactions), connector.create_firefly_transactions, new_transactions
+        )
+
+    return {"bank_transactions": workload.bank_transactions_count, "stages": recorder.stages}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for size, result in results.items():
+        for stage, measure in result["stages"].items():
+            reference = baseline.get(size, {}).get("stages", {}).get(stage)
+            if reference is None:
+                continue
+            if (
+                measure["seconds"] > reference["seconds"] * (1 + tolerance)
+                and measure["seconds"] - reference["seconds"] > NOISE_FLOOR_SECONDS
+            ):
+                regressions.append(
+                    "%s/%s: %.3fs instead of %.3fs"
+                    % (size, stage, measure["seconds"], reference["seconds"])
+                )
+            if measure["peak_bytes"] > reference["peak_bytes"] * (1 + tolerance) + 1024 * 1024:
+                regressions.append(
+                    "%s/%s: peak memory %d bytes instead of %d"
+                    % (size, stage, measure["peak_bytes"], reference["peak_bytes"])
+                )
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Numbers of bank transactions")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed relative regression")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    results = {}
+    for size in args.sizes.split(","):
+        results[size] = run_pipeline(int(size))
+        print("%s bank transactions" % results[size]["bank_transactions"])
+        for stage, measure in results[size]["stages"].items():
+            print(
+                "  %-20s %8d items %9.3fs %12s items/s %8.1f MiB"
+                % (
+                    stage,
+                    measure["items"],
+                    measure["seconds"],
+                    measure["throughput"],
+                    measure["peak_bytes"] / 1024 / 1024,
+                )
+            )
+    tracemalloc.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print("Baseline updated: %s" % args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found at %s, run with --update-baseline" % args.baseline)
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print("Regressions past the baseline:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print("No regression past the baseline")
+
+
+if __name__ == "__main__":
+    main_cli()
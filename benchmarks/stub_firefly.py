@@ -0,0 +1,252 @@
+"""Local HTTP server answering the few Firefly III API endpoints used by the importer."""
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import CASH_ACCOUNT_ID, SyntheticWorkload
+
+TRANSACTIONS_PATH = re.compile(r"^/api/v1/accounts/(?P<id>[^/]+)/transactions$")
+
+
+class StubFireflyServer:
+    """Serve the accounts and transactions of a synthetic workload and accept new transactions.
+
+    :param workload: The synthetic workload to serve
+    :param page_size: The default number of transactions per page
+    :param latency: The number of seconds each request takes
+    :param page_latency: The number of seconds each request of a transaction page takes, defaults
+        to latency
+    :param capacity: The number of requests served at the same time, like the workers of a small
+        PHP-FPM pool, None for no limit
+    :param queue_size: The number of requests waiting for a free worker when all of them are busy,
+        the requests beyond are answered 429 Too Many Requests
+    :param retry_after: The Retry-After header of the 429 responses, None to not send it
+    """
+
+    def __init__(
+        self,
+        workload: SyntheticWorkload,
+        page_size: int = 50,
+        latency: float = 0.0,
+        page_latency: float = None,
+        capacity: int = None,
+        queue_size: int = 0,
+        retry_after: str = None,
+    ):
+        self.workload = workload
+        self.page_size = page_size
+        self.latency = latency
+        self.page_latency = page_latency
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.throttled = 0
+        self.waiting = 0
+        self._workers = threading.Semaphore(capacity) if capacity is not None else None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.pages_served = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.stored = []
+        # (account id, start, end) -> transaction groups, so that pages do not filter again
+        self._windows = {}
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict, headers: dict = None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _enter(self) -> bool:
+                """Wait for a free worker, False if the queue was full and the request was answered 429"""
+                with stub.lock:
+                    stub.requests += 1
+                    throttled = (
+                        stub.capacity is not None
+                        and stub.in_flight + stub.waiting >= stub.capacity + stub.queue_size
+                    )
+                    if throttled:
+                        stub.throttled += 1
+                    else:
+                        stub.waiting += 1
+                if throttled:
+                    self._send(
+                        429,
+                        {"message": "Too Many Requests"},
+                        {"Retry-After": stub.retry_after} if stub.retry_after else None,
+                    )
+                    return False
+                if stub._workers is not None:
+                    stub._workers.acquire()
+                with stub.lock:
+                    stub.waiting -= 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                latency = stub.latency
+                if stub.page_latency is not None and TRANSACTIONS_PATH.match(urlparse(self.path).path):
+                    latency = stub.page_latency
+                if latency:
+                    time.sleep(latency)
+                return True
+
+            def _leave(self):
+                with stub.lock:
+                    stub.in_flight -= 1
+                if stub._workers is not None:
+                    stub._workers.release()
+
+            def do_GET(self):
+                if not self._enter():
+                    return
+                try:
+                    stub.handle_get(self)
+                finally:
+                    self._leave()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if not self._enter():
+                    return
+                try:
+                    stub.handle_post(self, json.loads(body or b"{}"))
+                finally:
+                    self._leave()
+
+        return Handler
+
+    @staticmethod
+    def _pagination(total: int, per_page: int, page: int) -> dict:
+        return {
+            "pagination": {
+                "total": total,
+                "count": max(0, min(per_page, total - (page - 1) * per_page)),
+                "per_page": per_page,
+                "current_page": page,
+                "total_pages": max(1, math.ceil(total / per_page)),
+            }
+        }
+
+    def handle_get(self, request):
+        url = urlparse(request.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/api/v1/accounts":
+            accounts = self.workload.firefly_accounts
+            request._send(
+                200,
+                {
+                    "data": accounts,
+                    "meta": self._pagination(len(accounts), len(accounts) or 1, 1),
+                    "links": {"self": url.path},
+                },
+            )
+            return
+
+        match = TRANSACTIONS_PATH.match(url.path)
+        if match is None:
+            request._send(404, {"message": "Not found"})
+            return
+
+        groups = self.transactions(match.group("id"), query.get("start"), query.get("end"))
+        per_page = int(query.get("limit") or self.page_size)
+        page = int(query.get("page") or 1)
+        with self.lock:
+            self.pages_served += 1
+        request._send(
+            200,
+            {
+                "data": groups[(page - 1) * per_page : page * per_page],
+                "meta": self._pagination(len(groups), per_page, page),
+                "links": {"self": url.path},
+            },
+        )
+
+    def transactions(self, account_id: str, start: str = None, end: str = None):
+        key = (account_id, start, end)
+        with self.lock:
+            if key not in self._windows:
+                groups = self.workload.firefly_transactions.get(account_id, [])
+                # dates are ISO formatted, comparing the day prefix is enough
+                self._windows[key] = [
+                    g
+                    for g in groups
+                    if (start is None or g["attributes"]["transactions"][0]["date"][:10] >= start)
+                    and (end is None or g["attributes"]["transactions"][0]["date"][:10] <= end)
+                ]
+            return self._windows[key]
+
+    def _account(self, account_id: str | None) -> dict:
+        """The account of an id, the cash account for the missing side of a withdrawal or deposit"""
+        for account in self.workload.firefly_accounts:
+            if account["id"] == (account_id or CASH_ACCOUNT_ID):
+                return account
+        return {"id": account_id, "attributes": {"name": None}}
+
+    def handle_post(self, request, body: dict):
+        if urlparse(request.path).path != "/api/v1/transactions":
+            request._send(404, {"message": "Not found"})
+            return
+        with self.lock:
+            self.stored.append(body)
+            group_id = "stored-%d" % len(self.stored)
+        splits = []
+        for split in body.get("transactions", []):
+            source = self._account(split.get("source_id"))
+            destination = self._account(split.get("destination_id"))
+            splits.append(
+                dict(
+                    split,
+                    transaction_journal_id=group_id,
+                    source_id=source["id"],
+                    source_name=source["attributes"]["name"],
+                    destination_id=destination["id"],
+                    destination_name=destination["attributes"]["name"],
+                )
+            )
+        group = {
+            "type": "transactions",
+            "id": group_id,
+            "attributes": {"transactions": splits},
+            "links": {"self": "/transactions/%s" % group_id},
+        }
+        # like Firefly III, the next listings of the accounts include the new transaction
+        with self.lock:
+            for account_id in {s[key] for s in splits for key in ("source_id", "destination_id")}:
+                self.workload.firefly_transactions.setdefault(account_id, []).append(group)
+            self._windows.clear()
+        request._send(200, {"data": group})
@@ -0,0 +1,200 @@
+"""Synthetic bank and Firefly III data for the offline benchmarks."""
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List
+
+BANK_DATE_FORMAT = "%b %d, %Y, %I:%M:%S %p"
+CASH_ACCOUNT_ID = "0"
+CASH_ACCOUNT_NAME = "Cash account"
+
+MERCHANTS = [
+    "LECLERC",
+    "CARREFOUR MARKET",
+    "EDF CLIENTS PARTICULIERS",
+    "SNCF VOYAGES",
+    "AMAZON EU SARL",
+    "BOULANGERIE DU CENTRE",
+    "PHARMACIE DE LA GARE",
+    "CPAM REMBOURSEMENT",
+    "SALAIRE ACME SAS",
+    "FREE MOBILE",
+]
+
+
+class SyntheticAccount:
+    """Stand-in for a creditagricole_particuliers Account."""
+
+    def __init__(self, numero_compte: str, libelle: str):
+        self.numeroCompte = numero_compte
+        self.libelleProduit = libelle
+        self.operations: List[SimpleNamespace] = []
+
+    def get_operations(self, date_start: str = None, date_stop: str = None):
+        start = datetime.strptime(date_start, "%Y-%m-%d") if date_start else datetime.min
+        stop = (
+            datetime.strptime(date_stop, "%Y-%m-%d") + timedelta(days=1)
+            if date_stop
+            else datetime.max
+        )
+        return SimpleNamespace(
+            list_operations=[
+                o
+                for o in self.operations
+                if start <= o.date < stop
+            ]
+        )
+
+
+class SyntheticWorkload:
+    """Generate the bank operations of several accounts and the part of them already in Firefly III.
+
+    :param accounts: The number of bank accounts
+    :param transactions_per_day: The number of bank operations per day, over all the accounts
+    :param days: The number of days of operations, ending today
+    :param transfer_ratio: The share of operations that are transfers between two accounts
+    :param duplicate_ratio: The share of operations already imported in Firefly III
+    :param libelle_noise: The probability that the libelle of a transfer counterpart differs by one character
+    :param seed: The seed of the random generator
+    """
+
+    def __init__(
+        self,
+        accounts: int = 3,
+        transactions_per_day: int = 20,
+        days: int = 180,
+        transfer_ratio: float = 0.1,
+        duplicate_ratio: float = 0.5,
+        libelle_noise: float = 0.2,
+        seed: int = 0,
+    ):
+        self.days = days
+        self.rng = random.Random(seed)
+        self.transfer_ratio = transfer_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.libelle_noise = libelle_noise
+
+        self.bank_accounts = [
+            SyntheticAccount("%011d" % (10000000000 + i), "COMPTE %d" % i)
+            for i in range(accounts)
+        ]
+        self.firefly_accounts = [
+            {
+                "type": "accounts",
+                "id": str(i + 1),
+                "attributes": {
+                    "name": a.libelleProduit,
+                    "type": "asset",
+                    "account_number": a.numeroCompte,
+                    "iban": None,
+                },
+            }
+            for i, a in enumerate(self.bank_accounts)
+        ] + [
+            {
+                "type": "accounts",
+                "id": CASH_ACCOUNT_ID,
+                "attributes": {"name": CASH_ACCOUNT_NAME, "type": "cash"},
+            }
+        ]
+        # Firefly III account id -> transaction groups, in the Firefly III API format
+        self.firefly_transactions: Dict[str, List[dict]] = {
+            a["id"]: [] for a in self.firefly_accounts
+        }
+        self._journal_id = 0
+
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        for day in range(days):
+            date = today - timedelta(days=day)
+            for _ in range(transactions_per_day):
+                self._generate_operation(date)
+
+    @property
+    def bank_transactions_count(self) -> int:
+        return sum(len(a.operations) for a in self.bank_accounts)
+
+    def _noisy(self, libelle: str) -> str:
+        if self.rng.random() >= self.libelle_noise:
+            return libelle
+        i = self.rng.randrange(len(libelle))
+        return libelle[:i] + libelle[i + 1 :]
+
+    def _generate_operation(self, date: datetime):
+        reference = "REF %08d" % self.rng.randrange(10**8)
+        amount = self.rng.randrange(1, 500000) / 100
+        imported = self.rng.random() < self.duplicate_ratio
+
+        if len(self.bank_accounts) > 1 and self.rng.random() < self.transfer_ratio:
+            origin, destination = self.rng.sample(range(len(self.bank_accounts)), 2)
+            libelle = "VIR %s %s" % (self.bank_accounts[destination].libelleProduit, reference)
+            libelles = {origin: libelle, destination: self._noisy(libelle)}
+            self._add_bank_operation(origin, date, -amount, libelles[origin])
+            self._add_bank_operation(destination, date, amount, libelles[destination])
+            if imported:
+                # the transfer keeps the libelle of the account listed first
+                self._add_firefly_transaction(
+                    "transfer", origin, destination, date, amount, libelles[min(origin, destination)]
+                )
+            return
+
+        account = self.rng.randrange(len(self.bank_accounts))
+        libelle = "CB %s %s" % (self.rng.choice(MERCHANTS), reference)
+        if self.rng.random() < 0.8:
+            self._add_bank_operation(account, date, -amount, libelle)
+            if imported:
+                self._add_firefly_transaction("withdrawal", account, None, date, amount, libelle)
+        else:
+            self._add_bank_operation(account, date, amount, libelle)
+            if imported:
+                self._add_firefly_transaction("deposit", None, account, date, amount, libelle)
+
+    def _add_bank_operation(self, account: int, date: datetime, amount: float, libelle: str):
+        self.bank_accounts[account].operations.append(
+            SimpleNamespace(
+                # parsed date kept to filter the operations without parsing them again
+                date=date,
+                dateOp=date.strftime(BANK_DATE_FORMAT),
+                libelleOp=libelle,
+                montantOp=amount,
+            )
+        )
+
+    def _firefly_account(self, account: int | None) -> dict:
+        if account is None:
+            return self.firefly_accounts[-1]
+        return self.firefly_accounts[account]
+
+    def _add_firefly_transaction(
+        self,
+        transaction_type: str,
+        origin: int | None,
+        destination: int | None,
+        date: datetime,
+        amount: float,
+        libelle: str,
+    ):
+        self._journal_id += 1
+        source = self._firefly_account(origin)
+        target = self._firefly_account(destination)
+        group = {
+            "type": "transactions",
+            "id": str(self._journal_id),
+            "attributes": {
+                "transactions": [
+                    {
+                        "transaction_journal_id": str(self._journal_id),
+                        "type": transaction_type,
+                        "date": date.strftime("%Y-%m-%dT%H:%M:%S+01:00"),
+                        "amount": "%.2f" % amount,
+                        "description": libelle,
+                        "source_id": source["id"],
+                        "source_name": source["attributes"]["name"],
+                        "destination_id": target["id"],
+                        "destination_name": target["attributes"]["name"],
+                    }
+                ]
+            },
+            "links": {"self": "/transactions/%s" % self._journal_id},
+        }
+        for account in {source["id"], target["id"]}:
+            self.firefly_transactions[account].append(group)
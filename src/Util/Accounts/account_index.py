@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, Iterator, List
+
+if TYPE_CHECKING:
+    from firefly_iii_client import AccountRead
+
+
+class AmbiguousAccountError(LookupError):
+    """Raised when a lookup matches several Firefly III accounts."""
+
+
+class AccountIndex:
+    """Index of Firefly III accounts by name, account number, IBAN and type.
+    The index is built once and gives constant time lookups.
+
+    :param accounts: The Firefly III accounts to index
+    """
+
+    def __init__(self, accounts: List[AccountRead]):
+        self.accounts = list(accounts or [])
+        self._by_name: Dict[str, List[AccountRead]] = defaultdict(list)
+        self._by_account_number: Dict[str, List[AccountRead]] = defaultdict(list)
+        self._by_iban: Dict[str, List[AccountRead]] = defaultdict(list)
+        self._by_type: Dict[str, List[AccountRead]] = defaultdict(list)
+
+        for a in self.accounts:
+            # empty values are not indexed, they cannot identify an account
+            if a.attributes.name:
+                self._by_name[a.attributes.name].append(a)
+            if a.attributes.account_number:
+                self._by_account_number[a.attributes.account_number].append(a)
+            if a.attributes.iban:
+                self._by_iban[a.attributes.iban].append(a)
+            self._by_type[a.attributes.type.value].append(a)
+
+    def __iter__(self) -> Iterator[AccountRead]:
+        return iter(self.accounts)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def has_account_number(self, account_number: str) -> bool:
+        return account_number in self._by_account_number
+
+    def find(
+        self,
+        account_name: str = None,
+        account_number: str = None,
+        account_type=None,
+        iban: str = None,
+    ) -> AccountRead | None:
+        """Find the account matching all the given criteria.
+
+        :param account_name: The name of the account
+        :param account_number: The account number
+        :param account_type: The type of the account, only used to narrow a lookup by name, number or IBAN
+        :param iban: The IBAN of the account
+        :return: The matching account, or None if no account matches
+        :raises AmbiguousAccountError: If several accounts match
+        """
+        # At least one of the parameters must be provided
+        if account_name is None and account_number is None and iban is None:
+            return None
+
+        candidates: List[List[AccountRead]] = []
+        if account_name is not None:
+            candidates.append(self._by_name.get(account_name, []))
+        if account_number is not None:
+            candidates.append(self._by_account_number.get(account_number, []))
+        if iban is not None:
+            candidates.append(self._by_iban.get(iban, []))
+        if account_type is not None:
+            candidates.append(self._by_type.get(account_type.value, []))
+
+        smallest = min(candidates, key=len)
+        others = [{id(a) for a in c} for c in candidates if c is not smallest]
+        matches = [a for a in smallest if all(id(a) in o for o in others)]
+
+        if len(matches) > 1:
+            raise AmbiguousAccountError(
+                "Several Firefly III accounts match name=%s, account number=%s, type=%s, iban=%s: %s"
+                % (
+                    account_name,
+                    account_number,
+                    account_type,
+                    iban,
+                    [a.id for a in matches],
+                )
+            )
+        return matches[0] if matches else None
@@ -1,12 +1,43 @@
-import difflib
 from datetime import datetime
+from functools import lru_cache
 from dateutil import tz
 from typing import List
 
-from firefly_iii_client.models.transaction_type_property import TransactionTypeProperty
+from Util.Transactions.similarity import DEFAULT_SIMILARITY_ENGINE, SimilarityEngine
+from Util.Transactions.transaction_type import TransactionType
+
+# all the dates are expressed in the timezone of the bank
+BANK_TIMEZONE = tz.gettz("Europe/Berlin")
+BANK_DATE_FORMAT = "%b %d, %Y, %I:%M:%S %p"
+
+
+@lru_cache(maxsize=8192)
+def parse_bank_date(date: str) -> datetime:
+    """Parse a date as returned by the bank. Operations share few distinct dates, so parsing is memoised."""
+    return datetime.strptime(date, BANK_DATE_FORMAT).replace(tzinfo=BANK_TIMEZONE)
+
+
+@lru_cache(maxsize=8192)
+def normalize_libelle(libelle: str) -> str:
+    """Case and whitespace insensitive form of a libelle, memoised so that repeated libelles share it"""
+    if libelle is None:
+        return None
+    return " ".join(libelle.casefold().split())
 
 
 class TransactionCustom:
+    __slots__ = (
+        "found_account_number",
+        "origin_account_number",
+        "destination_account_number",
+        "date",
+        "_libelle",
+        "libelle_normalized",
+        "amount_cents",
+        "type",
+        "fingerprint",
+    )
+
     def __init__(
         self,
         date: str | datetime,
@@ -14,7 +45,7 @@ class TransactionCustom:
         amount: float,
         found_account_number: str,
         origin_account_number: str,
-        transaction_type: TransactionTypeProperty,
+        transaction_type: TransactionType,
         destination_account_number: str = None,
     ):
         # found account number is the account number where the transaction was found
@@ -22,58 +53,74 @@ class TransactionCustom:
         self.found_account_number = found_account_number
         self.origin_account_number = origin_account_number
 
-        self.date = date
-        if not isinstance(date, datetime):
-            self.date = datetime.strptime(date, "%b %d, %Y, %I:%M:%S %p")
-        self.date = self.date.replace(tzinfo=tz.gettz('Europe / Berlin'))
-        
+        if isinstance(date, datetime):
+            self.date = date.replace(tzinfo=BANK_TIMEZONE)
+        else:
+            self.date = parse_bank_date(date)
+
         self.libelle = libelle
-        self.amount = abs(amount)
+        # the absolute amount of the transaction as an integer number of cents
+        self.amount_cents = round(abs(amount) * 100)
         self.destination_account_number = destination_account_number
         self.type = transaction_type
+        # stable content hash stored as the external id in Firefly III, see Util.Transactions.fingerprint
+        self.fingerprint: str | None = None
+
+    @property
+    def amount(self) -> float:
+        return self.amount_cents / 100
+
+    @amount.setter
+    def amount(self, amount: float):
+        self.amount_cents = round(abs(amount) * 100)
+
+    @property
+    def libelle(self) -> str:
+        return self._libelle
+
+    @libelle.setter
+    def libelle(self, libelle: str):
+        self._libelle = libelle
+        self.libelle_normalized = normalize_libelle(libelle)
 
     def __str__(self):
         return f"Origin account: {self.origin_account_number}, Destination account: {self.destination_account_number}, Amount: {self.amount}, Date: {self.date}, Libelle {self.libelle}"
 
-    def __hash__(self):
-        return hash(
-            (
-                self.found_account_number,
-                self.origin_account_number,
-                self.destination_account_number,
-                self.date,
-                self.libelle,
-                self.amount
-            )
+    @property
+    def identity(self) -> tuple:
+        """Canonical identity of the transaction, shared by __eq__ and __hash__.
+        Amounts are compared as integer cents so that float rounding cannot break equality.
+        """
+        return (
+            self.origin_account_number,
+            self.destination_account_number,
+            self.date,
+            self.libelle,
+            self.amount_cents,
+            self.type,
         )
 
+    def __hash__(self):
+        return hash(self.identity)
+
     def __eq__(self, other: "TransactionCustom"):
         if self.__class__ != other.__class__:
             return NotImplemented
 
-        return (
-            self.origin_account_number == other.origin_account_number
-            and self.destination_account_number == other.destination_account_number
-            and self.date == other.date
-            and self.libelle == other.libelle
-            and self.amount == other.amount
-            and self.type == other.type
-        )
+        return self.identity == other.identity
 
     def match(
         self,
         transaction_to_match: "TransactionCustom",
         similarity_ratio=None,
         ignore_destination_account=False,
+        similarity_engine: SimilarityEngine = None,
     ):
         libelle_equal = self.libelle == transaction_to_match.libelle
         if similarity_ratio:
             libelle_equal = (
-                difflib.SequenceMatcher(
-                    None, self.libelle, transaction_to_match.libelle
-                ).ratio()
-                >= similarity_ratio
-            )
+                similarity_engine or DEFAULT_SIMILARITY_ENGINE
+            ).is_similar(self.libelle, transaction_to_match.libelle, similarity_ratio)
 
         destination_account_equal = (
             self.destination_account_number == transaction_to_match.destination_account_number
@@ -83,7 +130,7 @@ class TransactionCustom:
 
         return (
             self.date == transaction_to_match.date
-            and self.amount == transaction_to_match.amount
+            and self.amount_cents == transaction_to_match.amount_cents
             and libelle_equal
             and destination_account_equal
         )
@@ -93,11 +140,14 @@ class TransactionCustom:
         transactions: List["TransactionCustom"],
         similarity_ratio=None,
         ignore_destination_account=False,
+        similarity_engine: SimilarityEngine = None,
     ):
         return [
             x
             for x in transactions
-            if self.match(x, similarity_ratio, ignore_destination_account)
+            if self.match(
+                x, similarity_ratio, ignore_destination_account, similarity_engine
+            )
         ]
 
     def find_exact_transactions_in_list(self, transactions: List["TransactionCustom"]):
@@ -0,0 +1,187 @@
+from datetime import datetime
+from typing import Dict, Hashable, Iterable
+
+import numpy as np
+
+from Util.Transactions.Transaction_custom import TransactionCustom
+
+# day and cents packed in one int64 key: the cents take the lower bits
+CENTS_BITS = 40
+
+
+class Interner:
+    """Dense integer ids for values, so that strings can be compared as integers. None gets -1."""
+
+    def __init__(self):
+        self.ids: Dict[Hashable, int] = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id(self, value: Hashable) -> int:
+        if value is None:
+            return -1
+        return self.ids.setdefault(value, len(self.ids))
+
+
+class Interners:
+    """The interners shared by the columns compared with each other"""
+
+    def __init__(self):
+        self.accounts = Interner()
+        self.libelles = Interner()
+        self.types = Interner()
+        self.fingerprints = Interner()
+
+
+def wall_clock_microseconds(date: datetime) -> int:
+    """Microseconds of the wall clock time of a date since 0001-01-01.
+    All the operations are dated in the bank time zone, where equal dates have equal wall clock
+    times, and reading the fields avoids the slow conversions of the time zone."""
+    return (
+        ((date.toordinal() * 24 + date.hour) * 60 + date.minute) * 60 + date.second
+    ) * 1_000_000 + date.microsecond
+
+
+class OperationColumns:
+    """Columnar form of a list of operations: one int64 array per field, the row of an operation
+    being its position in the list. Account numbers, libelles, types and fingerprints are interned.
+
+    :param transactions: The operations
+    :param interners: The interners of the values, shared with the columns these ones are compared with
+    """
+
+    def __init__(self, transactions: Iterable[TransactionCustom], interners: Interners):
+        fields = {
+            name: []
+            for name in (
+                "date",
+                "day",
+                "cents",
+                "found_account",
+                "origin_account",
+                "destination_account",
+                "libelle",
+                "type",
+                "fingerprint",
+            )
+        }
+        for t in transactions:
+            fields["date"].append(wall_clock_microseconds(t.date))
+            fields["day"].append(t.date.toordinal())
+            fields["cents"].append(t.amount_cents)
+            fields["found_account"].append(interners.accounts.id(t.found_account_number))
+            fields["origin_account"].append(interners.accounts.id(t.origin_account_number))
+            fields["destination_account"].append(
+                interners.accounts.id(t.destination_account_number)
+            )
+            fields["libelle"].append(interners.libelles.id(t.libelle))
+            fields["type"].append(interners.types.id(t.type))
+            fields["fingerprint"].append(interners.fingerprints.id(t.fingerprint))
+        for name, values in fields.items():
+            setattr(self, name, np.array(values, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.date)
+
+    def day_amount_keys(self) -> np.ndarray:
+        return (self.day << CENTS_BITS) | self.cents
+
+    def identities(self) -> np.ndarray:
+        """The fields of TransactionCustom.identity, one row per operation"""
+        return np.stack(
+            (
+                self.origin_account,
+                self.destination_account,
+                self.date,
+                self.libelle,
+                self.cents,
+                self.type,
+            ),
+            axis=1,
+        )
+
+
+def transfer_candidates(columns: OperationColumns) -> np.ndarray:
+    """Mask of the operations sharing their date and amount with an operation of another account.
+
+    Self sort-merge join on (date, amount): once sorted by date, amount and account, the rows of
+    a (date, amount) run come from several accounts exactly when the first and last accounts of
+    the run differ. Only these operations can be transfers, so only they need the fuzzy check.
+    """
+    count = len(columns)
+    if count == 0:
+        return np.zeros(0, dtype=bool)
+    order = np.lexsort((columns.found_account, columns.cents, columns.date))
+    dates = columns.date[order]
+    cents = columns.cents[order]
+    accounts = columns.found_account[order]
+
+    run_starts = np.ones(count, dtype=bool)
+    run_starts[1:] = (dates[1:] != dates[:-1]) | (cents[1:] != cents[:-1])
+    runs = np.cumsum(run_starts) - 1
+    first = np.flatnonzero(run_starts)
+    last = np.append(first[1:], count) - 1
+    several_accounts = accounts[first] != accounts[last]
+
+    candidates = np.empty(count, dtype=bool)
+    candidates[order] = several_accounts[runs]
+    return candidates
+
+
+def duplicates(new: OperationColumns, known: OperationColumns) -> tuple:
+    """Find the new operations already known, with the rules of DuplicateFilter.
+
+    A sort-merge join on (day, amount) first keeps the new operations having a known operation
+    the same day with the same amount, as both the fingerprint and the identity include them.
+    Among them, a new operation whose fingerprint is known is a duplicate. Every known operation
+    without a fingerprint then removes at most one remaining new operation with the same
+    identity, the first ones in the order of the list.
+
+    :param new: The new operations, with their fingerprints
+    :param known: The operations already imported
+    :return: The masks of the new operations known by fingerprint and by identity
+    """
+    by_fingerprint = np.zeros(len(new), dtype=bool)
+    by_identity = np.zeros(len(new), dtype=bool)
+    if len(new) == 0 or len(known) == 0:
+        return by_fingerprint, by_identity
+
+    known_keys = np.sort(known.day_amount_keys())
+    new_keys = new.day_amount_keys()
+    candidates = np.searchsorted(known_keys, new_keys, side="right") > np.searchsorted(
+        known_keys, new_keys, side="left"
+    )
+
+    known_fingerprints = known.fingerprint[known.fingerprint >= 0]
+    by_fingerprint = candidates & np.isin(new.fingerprint, known_fingerprints)
+
+    remaining = np.flatnonzero(candidates & ~by_fingerprint)
+    legacy = known.fingerprint < 0
+    if len(remaining) == 0 or not legacy.any():
+        return by_fingerprint, by_identity
+
+    known_identities = known.identities()[legacy]
+    _, groups = np.unique(
+        np.concatenate((known_identities, new.identities()[remaining])),
+        axis=0,
+        return_inverse=True,
+    )
+    groups = groups.ravel()
+    known_groups = groups[: len(known_identities)]
+    new_groups = groups[len(known_identities) :]
+    known_counts = np.bincount(known_groups, minlength=groups.max() + 1)
+
+    # rank of each remaining new operation among the identical ones, in the order of the list
+    order = np.argsort(new_groups, kind="stable")
+    sorted_groups = new_groups[order]
+    group_starts = np.ones(len(order), dtype=bool)
+    group_starts[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    start_positions = np.flatnonzero(group_starts)
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(
+        start_positions, np.diff(np.append(start_positions, len(order)))
+    )
+
+    by_identity[remaining] = ranks < known_counts[new_groups]
+    return by_fingerprint, by_identity
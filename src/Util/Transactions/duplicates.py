@@ -0,0 +1,72 @@
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Set, Tuple
+
+from metrics import metrics
+from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.fingerprint import assign_fingerprints
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateFilter:
+    """Remove the transactions already known from lists of new transactions.
+
+    New transactions get their fingerprint first. A new transaction whose fingerprint is known
+    is a duplicate, even if it was edited in Firefly III since. Known transactions without a
+    fingerprint, imported before fingerprints existed, are compared field by field: each of them
+    removes at most one identical new transaction, and the counts are kept between calls to
+    `filter`, so new transactions can be filtered in several batches.
+    The known transactions can be a Firefly III mirror (anything with `has_fingerprint` and
+    `count_matching` methods), which is then queried for each distinct new transaction.
+
+    :param known_transactions: The transactions already imported
+    """
+
+    def __init__(self, known_transactions: Iterable[TransactionCustom]):
+        self.mirror = (
+            known_transactions if hasattr(known_transactions, "count_matching") else None
+        )
+        self.known_fingerprints: Set[str] = set()
+        self.remaining: Dict[Tuple, int] = {}
+        if self.mirror is None:
+            legacy_identities = []
+            for t in known_transactions:
+                if t.fingerprint is not None:
+                    self.known_fingerprints.add(t.fingerprint)
+                else:
+                    legacy_identities.append(t.identity)
+            self.remaining = Counter(legacy_identities)
+
+    def _is_known(self, fingerprint: str) -> bool:
+        if self.mirror is not None:
+            return self.mirror.has_fingerprint(fingerprint)
+        return fingerprint in self.known_fingerprints
+
+    def filter(self, transactions: List[TransactionCustom]) -> List[TransactionCustom]:
+        """Remove the duplicates from the list in place and return it.
+        The list must hold all the operations of the days it covers, see assign_fingerprints."""
+        assign_fingerprints(transactions)
+        kept_transactions: List[TransactionCustom] = []
+        for t in transactions:
+            if self._is_known(t.fingerprint):
+                metrics.increment("duplicates_removed")
+                metrics.increment("duplicates_removed_by_fingerprint")
+                logger.info(
+                    "Found duplicate by fingerprint: %s. Removing it from the list of transactions to add.",
+                    t,
+                )
+                continue
+            if self.mirror is not None and t.identity not in self.remaining:
+                self.remaining[t.identity] = self.mirror.count_matching(t)
+            if self.remaining.get(t.identity, 0) > 0:
+                self.remaining[t.identity] -= 1
+                metrics.increment("duplicates_removed")
+                logger.info(
+                    "Found duplicate: %s. Removing it from the list of transactions to add.",
+                    t,
+                )
+                continue
+            kept_transactions.append(t)
+        transactions[:] = kept_transactions
+        return transactions
@@ -0,0 +1,46 @@
+import hashlib
+from collections import Counter
+from typing import Iterable
+
+from Util.Transactions.Transaction_custom import TransactionCustom
+
+# the version of the fingerprint is part of it, so that a new scheme never matches an old one
+FINGERPRINT_PREFIX = "fp1:"
+
+
+def content_key(transaction: TransactionCustom) -> tuple:
+    """The fields of a transaction that make its fingerprint.
+    Only the day of the date is kept: the time and offset of the bank dates are not stable."""
+    return (
+        transaction.origin_account_number,
+        transaction.destination_account_number,
+        transaction.date.date().isoformat(),
+        transaction.amount_cents,
+        transaction.libelle_normalized,
+    )
+
+
+def _hash_content(key: tuple, occurrence: int) -> str:
+    """Stable fingerprint of a content key, see content_key.
+
+    :param key: The content key of the transaction
+    :param occurrence: The number of transactions with the same content before this one,
+        so that two identical operations of the same day get different fingerprints
+    """
+    content = "\x1f".join("" if value is None else str(value) for value in key + (occurrence,))
+    return FINGERPRINT_PREFIX + hashlib.sha256(content.encode()).hexdigest()
+
+
+def assign_fingerprints(transactions: Iterable[TransactionCustom]):
+    """Set the fingerprint of the transactions, written to the external_id of their Firefly III split,
+    numbering the identical ones in the order of the list.
+    The list must hold all the operations of the days it covers for the numbering to be stable."""
+    occurrences = Counter()
+    for t in transactions:
+        key = content_key(t)
+        t.fingerprint = _hash_content(key, occurrences[key])
+        occurrences[key] += 1
+
+
+def is_fingerprint(external_id: str | None) -> bool:
+    return bool(external_id) and external_id.startswith(FINGERPRINT_PREFIX)
@@ -0,0 +1,78 @@
+import difflib
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Callable
+
+# prefixes added by the bank in front of the libelle, depending on the kind of operation
+BANK_LIBELLE_PREFIXES = re.compile(
+    r"^(?:(?:vir(?:ement)?|prlv|prelevement|cb|carte|sepa|inst|emis|recu)\b[\s.:/-]*)+"
+)
+
+
+def normalize_bank_libelle(libelle: str) -> str:
+    """Case, whitespace and bank prefix ("VIR", "PRLV"...) insensitive form of a libelle"""
+    libelle = " ".join(libelle.casefold().split())
+    return BANK_LIBELLE_PREFIXES.sub("", libelle) or libelle
+
+
+class SimilarityEngine:
+    """Fuzzy libelle comparison with difflib's ratio, accelerated by exact upper bounds and a memo.
+
+    Before computing the full ratio, a pair is rejected if the similarity cannot reach the
+    threshold given the lengths of the strings, then given their character counts.
+    Both bounds never underestimate the ratio, so the decisions are the same as with the
+    full ratio alone. Full ratios are kept in a bounded LRU memo.
+
+    :param normalizer: Optional function applied to the libelles before comparing them
+    :param cache_size: The maximum number of ratios kept in the memo
+    """
+
+    def __init__(self, normalizer: Callable[[str], str] = None, cache_size: int = 65536):
+        self.normalizer = normalizer
+        self._ratio = lru_cache(maxsize=cache_size)(SimilarityEngine._compute_ratio)
+        self._character_counts = lru_cache(maxsize=cache_size)(Counter)
+        self.comparisons = 0
+        self.rejected_by_length = 0
+        self.rejected_by_characters = 0
+
+    @staticmethod
+    def _compute_ratio(a: str, b: str) -> float:
+        return difflib.SequenceMatcher(None, a, b).ratio()
+
+    def normalize(self, libelle: str) -> str:
+        if self.normalizer is None or libelle is None:
+            return libelle
+        return self.normalizer(libelle)
+
+    def ratio(self, a: str, b: str) -> float:
+        return self._ratio(self.normalize(a), self.normalize(b))
+
+    def is_similar(self, a: str, b: str, similarity_ratio: float) -> bool:
+        """Whether the similarity ratio of the two libelles reaches the given ratio"""
+        self.comparisons += 1
+        a = self.normalize(a)
+        b = self.normalize(b)
+        if a == b:
+            return True
+
+        length = len(a) + len(b)
+        # at most all the characters of the shortest string match
+        if 2.0 * min(len(a), len(b)) / length < similarity_ratio:
+            self.rejected_by_length += 1
+            return False
+
+        # at most the characters common to both strings match
+        common = sum((self._character_counts(a) & self._character_counts(b)).values())
+        if 2.0 * common / length < similarity_ratio:
+            self.rejected_by_characters += 1
+            return False
+
+        return self._ratio(a, b) >= similarity_ratio
+
+    def cache_info(self):
+        return self._ratio.cache_info()
+
+
+# engine used when no engine is given, without normalisation to keep difflib's decisions
+DEFAULT_SIMILARITY_ENGINE = SimilarityEngine()
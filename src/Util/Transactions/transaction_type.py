@@ -0,0 +1,12 @@
+from enum import Enum
+
+
+class TransactionType(str, Enum):
+    """Type of a transaction, with the values of Firefly III's TransactionTypeProperty.
+    Defined here so that the reconciliation does not need to import the Firefly III client."""
+
+    WITHDRAWAL = "withdrawal"
+    DEPOSIT = "deposit"
+    TRANSFER = "transfer"
+    RECONCILIATION = "reconciliation"
+    OPENING_BALANCE = "opening balance"
@@ -0,0 +1,137 @@
+import logging
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from metrics import metrics
+from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.similarity import DEFAULT_SIMILARITY_ENGINE, SimilarityEngine
+from Util.Transactions.transaction_type import TransactionType
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_SIMILARITY_RATIO = 0.9
+
+
+class TransferDetector:
+    """Detect transfer operations between accounts.
+
+    Transactions are bucketed by (date, amount) and, inside a bucket, by the account
+    where they were found. Only transactions sharing a bucket can be part of the same
+    transfer, so the fuzzy libelle comparison only runs inside a bucket.
+    Matched counterparts are marked as consumed instead of being removed from the list.
+
+    :param transactions: The list of transactions to analyse
+    :param similarity_ratio: The minimum libelle similarity ratio of a transfer counterpart
+    :param similarity_engine: The engine comparing the libelles
+    """
+
+    def __init__(
+        self,
+        transactions: List[TransactionCustom],
+        similarity_ratio: float = TRANSFER_SIMILARITY_RATIO,
+        similarity_engine: SimilarityEngine = DEFAULT_SIMILARITY_ENGINE,
+    ):
+        self.transactions = transactions
+        self.similarity_ratio = similarity_ratio
+        self.similarity_engine = similarity_engine
+        # (date, amount in cents) -> found account number -> positions in the transactions list
+        self._buckets: Dict[Tuple, Dict[str, List[int]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        self._consumed: List[bool] = [False] * len(transactions)
+
+        for position, t in enumerate(transactions):
+            self._buckets[(t.date, t.amount_cents)][t.found_account_number].append(position)
+
+    def _find_in_bucket(self, position: int, same_account: bool) -> List[int]:
+        t = self.transactions[position]
+        bucket = self._buckets[(t.date, t.amount_cents)]
+        candidates: List[int] = []
+        for account_number, positions in bucket.items():
+            if (account_number == t.found_account_number) != same_account:
+                continue
+            candidates.extend(p for p in positions if not self._consumed[p])
+        # keep the order of the original list so that the first match stays the same
+        candidates.sort()
+        return [
+            p
+            for p in candidates
+            if t.match(
+                self.transactions[p],
+                self.similarity_ratio,
+                True,
+                self.similarity_engine,
+            )
+        ]
+
+    def detect(self):
+        """Detect the transfers, update them in place and drop their counterparts from the list."""
+        for position, t in enumerate(self.transactions):
+            if self._consumed[position]:
+                continue
+
+            similar_positions = self._find_in_bucket(position, same_account=False)
+            if len(similar_positions) == 0:
+                continue
+
+            similar_transaction = self.transactions[similar_positions[0]]
+
+            if len(similar_positions) > 1:
+                # either there is a false positive, or the same transaction was done twice
+                logger.info(
+                    "Found multiple potential transactions for transfer. \n Original: %s \n Similar Transactions: [%s]",
+                    t,
+                    ", ".join(str(self.transactions[p]) for p in similar_positions),
+                )
+
+                # check if the same transaction was done twice
+                if len(self._find_in_bucket(position, same_account=True)) != len(
+                    similar_positions
+                ):
+                    raise Exception(
+                        "Found multiple potential transactions for transfer. See logs for more details"
+                    )
+
+            if (
+                t.origin_account_number and similar_transaction.origin_account_number
+            ) or (
+                t.destination_account_number
+                and similar_transaction.destination_account_number
+            ):
+                raise Exception(
+                    "Error in transfer detection: %s and %s",
+                    t,
+                    similar_transaction,
+                )
+
+            origin_account = (
+                t.origin_account_number
+                if t.origin_account_number
+                else similar_transaction.origin_account_number
+            )
+            destination_account_number = (
+                t.destination_account_number
+                if t.destination_account_number
+                else similar_transaction.destination_account_number
+            )
+            logger.info(
+                "Found transfer: %s. %s -> %s",
+                t,
+                origin_account,
+                destination_account_number,
+            )
+
+            t.origin_account_number = origin_account
+            t.destination_account_number = destination_account_number
+            t.amount = abs(t.amount)
+            t.type = TransactionType.TRANSFER
+            # the counterpart is no longer a candidate and will be dropped from the list
+            self._consumed[similar_positions[0]] = True
+            metrics.increment("transfers_detected")
+
+        self.transactions[:] = [
+            t
+            for position, t in enumerate(self.transactions)
+            if not self._consumed[position]
+        ]
+        return self.transactions
@@ -0,0 +1,247 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from typing import Any, Dict, Mapping
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses by which a server asks its clients to slow down
+THROTTLING_HTTP_STATUSES = {429, 503}
+# how many times slower the limit grows near the limit of the last congestion
+CONGESTION_PROBE_SLOWDOWN = 10
+
+
+class CallOutcome(Enum):
+    SUCCESS = "success"
+    THROTTLED = "throttled"
+    FAILED = "failed"
+
+
+class AdaptiveLimiter:
+    """Bound on the number of concurrent requests to one server, adapted to how the server copes.
+
+    The limit follows an AIMD scheme: every response received in time raises it by about one
+    request per round of `limit` responses, while a throttling response, a server error or
+    responses of an operation getting much slower than usual for that operation divide it by
+    `decrease_factor`, at most once per
+    round trip so that a burst of failures from the same overload counts once. Near the limit
+    at which the last congestion happened, the limit grows much slower, so that the server is not
+    pushed into throttling again after every decrease.
+    A `Retry-After` delay given by the server holds every new request until it has passed.
+    The current limit and the throttling events are published as metrics prefixed by `name`.
+
+    :param name: The name of the server, prefix of the metrics
+    :param max_limit: The maximum number of concurrent requests, usually the number of worker threads
+    :param initial_limit: The limit to start with, defaults to max_limit
+    :param min_limit: The minimum number of concurrent requests
+    :param decrease_factor: The factor applied to the limit on congestion
+    :param latency_tolerance: How many times slower than its fastest recent responses the average
+        response of an operation can get before it is taken as a sign of congestion, None to only
+        react to errors. Each operation, e.g. each endpoint, has its own latencies, so that a slow
+        endpoint is not taken for a congested server
+    :param max_retry_after: The longest Retry-After delay honoured, in seconds
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_limit: int,
+        initial_limit: int = None,
+        min_limit: int = 1,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 4.0,
+        max_retry_after: float = 300,
+    ):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(
+            min(self.max_limit, max(self.min_limit, initial_limit or self.max_limit))
+        )
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_retry_after = max_retry_after
+        self.in_flight = 0
+        # no request is sent before this time.monotonic() value
+        self.paused_until = 0.0
+        self._condition = threading.Condition()
+        # operation -> fastest recent latency and average latency of its responses
+        self._baseline_latency: Dict[str, float] = {}
+        self._smoothed_latency: Dict[str, float] = {}
+        self._last_decrease = 0.0
+        # the limit at the last congestion, forgotten once the limit grows past it
+        self._congestion_limit: float = None
+
+    def raise_max_limit(self, max_limit: int):
+        """Raise the maximum number of concurrent requests, for callers running more requests at a
+        time than the limiter was created for. The limit is raised by as much, so that a limit
+        lowered by a congestion stays as far below the maximum.
+
+        :param max_limit: The new maximum number of concurrent requests, ignored if lower than the current one
+        """
+        with self._condition:
+            if max_limit <= self.max_limit:
+                return
+            self.limit += max_limit - self.max_limit
+            self.max_limit = max_limit
+            metrics.set_gauge("%s_concurrency_limit" % self.name, int(self.limit))
+            self._condition.notify_all()
+
+    def slot(self, operation: str = None) -> "LimiterSlot":
+        """A context manager holding one request slot, see LimiterSlot
+
+        :param operation: The operation of the request, whose latencies are compared to its own
+        """
+        return LimiterSlot(self, operation)
+
+    def acquire(self):
+        """Wait for a free slot and for the end of any Retry-After pause"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self._condition.wait(self.paused_until - now)
+                elif self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                else:
+                    self._condition.wait()
+
+    def release(
+        self,
+        latency: float,
+        outcome: CallOutcome,
+        retry_after: float = None,
+        operation: str = None,
+    ):
+        """Free a slot and adapt the limit to the outcome of the request.
+
+        :param latency: The number of seconds the request took
+        :param outcome: Whether the request succeeded, was throttled or failed
+        :param retry_after: The number of seconds the server asked to wait before the next request
+        :param operation: The operation of the request
+        """
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == CallOutcome.SUCCESS:
+                self._observe_latency(operation, latency)
+                smoothed = self._smoothed_latency[operation]
+                if (
+                    self.latency_tolerance is not None
+                    and smoothed > self._baseline_latency[operation] * self.latency_tolerance
+                ):
+                    self._decrease(
+                        now, operation, "slow responses of %s (%.3fs)" % (operation, smoothed)
+                    )
+                else:
+                    self._increase()
+            else:
+                metrics.increment("%s_%s" % (self.name, outcome.value))
+                self._decrease(now, operation, outcome.value)
+            retry_after = min(retry_after or 0, self.max_retry_after)
+            if retry_after:
+                if now + retry_after > self.paused_until:
+                    self.paused_until = now + retry_after
+                    metrics.increment("%s_retry_after_pauses" % self.name)
+                    metrics.increment("%s_retry_after_seconds" % self.name, retry_after)
+                    logger.warning(
+                        "%s asked to retry after %.1fs, pausing its requests", self.name, retry_after
+                    )
+            metrics.set_gauge("%s_concurrency_limit" % self.name, int(self.limit))
+            self._condition.notify_all()
+
+    def _observe_latency(self, operation: str, latency: float):
+        baseline = self._baseline_latency.get(operation)
+        if baseline is None or latency < baseline:
+            self._baseline_latency[operation] = latency
+        else:
+            # drift slowly to the recent latencies, in case the server got slower for good
+            self._baseline_latency[operation] = baseline + (latency - baseline) * 0.01
+        smoothed = self._smoothed_latency.get(operation)
+        if smoothed is None:
+            self._smoothed_latency[operation] = latency
+        else:
+            self._smoothed_latency[operation] = smoothed + (latency - smoothed) * 0.2
+
+    def _increase(self):
+        # one more request per round of `limit` responses
+        step = 1 / self.limit
+        if self._congestion_limit is not None:
+            if self.limit > self._congestion_limit:
+                self._congestion_limit = None
+            elif self.limit + 1 > self._congestion_limit:
+                step /= CONGESTION_PROBE_SLOWDOWN
+        self.limit = min(self.max_limit, self.limit + step)
+
+    def _decrease(self, now: float, operation: str, reason: str):
+        # the responses of requests sent before the previous decrease reflect the old limit
+        if now - self._last_decrease < self._smoothed_latency.get(operation, 0):
+            return
+        self._last_decrease = now
+        self._congestion_limit = self.limit
+        limit = max(self.min_limit, self.limit * self.decrease_factor)
+        if int(limit) < int(self.limit):
+            metrics.increment("%s_concurrency_decreases" % self.name)
+            logger.info(
+                "Concurrency of %s lowered from %d to %d: %s",
+                self.name,
+                self.limit,
+                limit,
+                reason,
+            )
+        self.limit = limit
+
+
+class LimiterSlot:
+    """One request slot of an AdaptiveLimiter, held for the duration of a `with` block.
+
+    The request is taken as successful unless `throttled` or `failed` is called in the block,
+    so that an error of the request itself, e.g. a validation error, does not lower the limit.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, operation: str = None):
+        self.limiter = limiter
+        self.operation = operation
+        self.outcome = CallOutcome.SUCCESS
+        self.retry_after: float = None
+
+    def throttled(self, retry_after: float = None):
+        self.outcome = CallOutcome.THROTTLED
+        self.retry_after = retry_after
+
+    def failed(self, retry_after: float = None):
+        self.outcome = CallOutcome.FAILED
+        self.retry_after = retry_after
+
+    def __enter__(self):
+        self.limiter.acquire()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.limiter.release(
+            time.perf_counter() - self.start, self.outcome, self.retry_after, self.operation
+        )
+
+
+def parse_retry_after(headers: Mapping[str, Any] | None) -> float | None:
+    """The number of seconds of the Retry-After header, given as seconds or as an HTTP date"""
+    if not headers:
+        return None
+    value = next((v for k, v in headers.items() if k.lower() == "retry-after"), None)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        logger.warning("Ignoring the invalid Retry-After header %r", value)
+        return None
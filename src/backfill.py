@@ -0,0 +1,422 @@
+"""Import several years of bank history, chunk by chunk.
+
+The range is split in chunks of days. Each chunk is fetched from the bank and from Firefly III
+with a few days of overlap on both edges, so that the two operations of a transfer crossing the
+edge are both seen, reconciled, and only the operations dated inside the chunk are stored.
+The operations of a chunk are held in columns of NumPy arrays, and the transfer and duplicate
+candidates are found with sort-merge joins on (date, amount) before any libelle is compared.
+The chunks already imported are recorded in a checkpoint, and a backfill run again resumes
+after them. The next chunk is fetched while the current one is stored.
+
+The configuration is the one of main.py, read from the environment.
+
+Usage:
+    python src/backfill.py 2019-01-01 [--until 2023-12-31] [--chunk-days 30] [--overlap-days 2] [--checkpoint backfill.sqlite]
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Any, Dict, List, Set, Tuple
+
+import numpy as np
+
+from banks_clients.bank_client import BankClient
+from firefly_connector import FireflyConnector, StoreStatus, firefly_client
+from metrics import metrics
+from Util.Accounts.account_index import AccountIndex
+from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.columns import (
+    Interners,
+    OperationColumns,
+    duplicates,
+    transfer_candidates,
+)
+from Util.Transactions.fingerprint import assign_fingerprints
+from Util.Transactions.similarity import SimilarityEngine, normalize_bank_libelle
+
+if TYPE_CHECKING:
+    from firefly_iii_client import AccountRead
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+class BackfillCheckpoint:
+    """Persist the chunks of a backfill already imported.
+
+    The chunks are only comparable between runs with the same first day and chunk size,
+    a checkpoint made with other ones is refused.
+
+    :param path: The path of the SQLite database
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS backfill_parameters (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS backfill_chunks (
+                    chunk_start TEXT PRIMARY KEY,
+                    chunk_stop TEXT NOT NULL,
+                    stored INTEGER NOT NULL,
+                    duplicates INTEGER NOT NULL,
+                    completed_at TEXT NOT NULL
+                );
+                """
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def check_parameters(self, parameters: Dict[str, str]):
+        """Record the parameters of the backfill, or check that they are the recorded ones"""
+        recorded = dict(
+            self.connection.execute("SELECT name, value FROM backfill_parameters")
+        )
+        if recorded and recorded != parameters:
+            raise Exception(
+                "The checkpoint %s was made for another backfill (%s instead of %s), remove it to start over"
+                % (self.path, recorded, parameters)
+            )
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO backfill_parameters VALUES (?, ?)", parameters.items()
+            )
+
+    def completed(self) -> Set[Tuple[str, str]]:
+        """The first and last days (YYYY-MM-DD) of the chunks already imported"""
+        return set(self.connection.execute("SELECT chunk_start, chunk_stop FROM backfill_chunks"))
+
+    def complete(self, chunk_start: str, chunk_stop: str, stored: int, duplicates: int):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO backfill_chunks VALUES (?, ?, ?, ?, ?)",
+                (chunk_start, chunk_stop, stored, duplicates, datetime.now().isoformat()),
+            )
+
+
+class Backfill:
+    """Import the bank operations of a long range of dates, chunk by chunk.
+
+    The reconciliation is the one of the regular import: the same transfers are detected and the
+    same duplicates removed, decided within each (date, amount) group, which a chunk always holds
+    whole. The chunks are aligned on the first day of the backfill, so that a resumed backfill
+    has the same chunks.
+
+    :param firefly_connector: The Firefly III connector
+    :param bank_client: The logged in bank client
+    :param firefly_accounts: The Firefly III accounts
+    :param checkpoint: The checkpoint of the chunks already imported
+    :param chunk_days: The number of days of a chunk
+    :param overlap_days: The number of days fetched before and after a chunk
+    :param similarity_engine: The engine comparing the libelles of the transfers, None for the default one
+    :param fetch_workers: The number of bank accounts fetched at the same time
+    """
+
+    def __init__(
+        self,
+        firefly_connector: FireflyConnector,
+        bank_client: BankClient,
+        firefly_accounts: List[AccountRead] | AccountIndex,
+        checkpoint: BackfillCheckpoint,
+        chunk_days: int = 30,
+        overlap_days: int = 2,
+        similarity_engine: SimilarityEngine = None,
+        fetch_workers: int = 4,
+    ):
+        self.firefly_connector = firefly_connector
+        self.bank_client = bank_client
+        self.account_index = (
+            firefly_accounts
+            if isinstance(firefly_accounts, AccountIndex)
+            else AccountIndex(firefly_accounts)
+        )
+        self.checkpoint = checkpoint
+        self.chunk_days = max(1, chunk_days)
+        self.overlap_days = max(0, overlap_days)
+        self.similarity_engine = similarity_engine
+        self.fetch_workers = max(1, fetch_workers)
+        # every fetch worker sends its own bank requests
+        self.bank_client.allow_concurrency(self.fetch_workers)
+        # cash accounts are reached through the transactions of the asset accounts
+        self.firefly_accounts = [
+            a
+            for a in self.account_index
+            if a.attributes.type.value != firefly_client().AccountTypeFilter.CASH
+        ]
+
+    def chunks(self, date_start: date, date_stop: date) -> List[Tuple[date, date]]:
+        """The first and last days of the chunks covering the range, both included"""
+        chunks = []
+        chunk_start = date_start
+        while chunk_start <= date_stop:
+            chunk_stop = min(date_stop, chunk_start + timedelta(days=self.chunk_days - 1))
+            chunks.append((chunk_start, chunk_stop))
+            chunk_start = chunk_stop + timedelta(days=1)
+        return chunks
+
+    def run(self, bank_accounts: List[Any], date_start: date, date_stop: date) -> Dict[str, int]:
+        """Import the operations of the given bank accounts between two days, both included.
+        A chunk is only recorded in the checkpoint once all its transactions are stored; if one
+        of them fails, the backfill stops and the chunk is imported again by the next run.
+        A backfill can outlast the bank session: it is renewed when needed before each chunk,
+        and the accounts are listed again with it.
+
+        :param bank_accounts: The bank accounts to import, only their numbers are kept
+        :param date_start: The first day to import
+        :param date_stop: The last day to import
+        :return: The number of chunks imported and skipped, of transactions stored and of duplicates removed
+        """
+        self.checkpoint.check_parameters(
+            {"date_start": date_start.strftime(DATE_FORMAT), "chunk_days": str(self.chunk_days)}
+        )
+        completed = self.checkpoint.completed()
+        all_chunks = self.chunks(date_start, date_stop)
+        # the last chunk is imported again if the range now goes further
+        chunks = [
+            c
+            for c in all_chunks
+            if (c[0].strftime(DATE_FORMAT), c[1].strftime(DATE_FORMAT)) not in completed
+        ]
+        account_numbers = [self.bank_client.account_number(a) for a in bank_accounts]
+        summary = {
+            "chunks_imported": 0,
+            "chunks_skipped": len(all_chunks) - len(chunks),
+            "stored": 0,
+            "duplicates": 0,
+        }
+        if summary["chunks_skipped"]:
+            logger.info(
+                "Resuming the backfill, %s chunks already imported", summary["chunks_skipped"]
+            )
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            next_fetch = (
+                prefetch.submit(self._fetch, *chunks[0], account_numbers) if chunks else None
+            )
+            for position, (chunk_start, chunk_stop) in enumerate(chunks):
+                bank_transactions, known, interners = next_fetch.result()
+                # stored chunks are never in the window of the next chunk, it can be fetched meanwhile
+                next_fetch = (
+                    prefetch.submit(self._fetch, *chunks[position + 1], account_numbers)
+                    if position + 1 < len(chunks)
+                    else None
+                )
+                with metrics.span("backfill_reconcile"):
+                    new_transactions, removed = self._reconcile(
+                        chunk_start, chunk_stop, bank_transactions, known, interners
+                    )
+                with metrics.span("backfill_store"):
+                    store_results = self.firefly_connector.create_firefly_transactions(
+                        self.firefly_connector.convert_to_firefly_transactions(
+                            new_transactions, self.account_index
+                        )
+                    )
+                failed = sum(1 for r in store_results if r.status == StoreStatus.FAILED)
+                if failed:
+                    raise Exception(
+                        "%s transactions of the chunk %s - %s could not be stored, "
+                        "run the backfill again to resume" % (failed, chunk_start, chunk_stop)
+                    )
+                stored = sum(1 for r in store_results if r.status == StoreStatus.STORED)
+                self.checkpoint.complete(
+                    chunk_start.strftime(DATE_FORMAT),
+                    chunk_stop.strftime(DATE_FORMAT),
+                    stored,
+                    removed,
+                )
+                metrics.increment("backfill_chunks")
+                summary["chunks_imported"] += 1
+                summary["stored"] += stored
+                summary["duplicates"] += removed
+                logger.info(
+                    "Backfill chunk %s - %s imported: %s operations, %s stored, %s duplicates",
+                    chunk_start,
+                    chunk_stop,
+                    len(bank_transactions),
+                    stored,
+                    removed,
+                )
+        return summary
+
+    def _window(self, chunk_start: date, chunk_stop: date) -> Tuple[str, str]:
+        return (
+            (chunk_start - timedelta(days=self.overlap_days)).strftime(DATE_FORMAT),
+            (chunk_stop + timedelta(days=self.overlap_days)).strftime(DATE_FORMAT),
+        )
+
+    def _bank_accounts(self, account_numbers: List[str]) -> List[Any]:
+        """The bank accounts of the given numbers, listed with a session renewed if it expired"""
+        self.bank_client.ensure_session()
+        listed = {
+            self.bank_client.account_number(a): a
+            for a in self.bank_client.list_account(self.account_index)
+        }
+        missing = [number for number in account_numbers if number not in listed]
+        if missing:
+            raise Exception("The bank accounts %s are not listed anymore" % missing)
+        return [listed[number] for number in account_numbers]
+
+    def _fetch(
+        self, chunk_start: date, chunk_stop: date, account_numbers: List[str]
+    ) -> Tuple[List[TransactionCustom], OperationColumns, Interners]:
+        """The bank operations and the columns of the Firefly III transactions of the window of a chunk,
+        with the interners of the chunk. The chunk is given up if any bank account cannot be
+        fetched, as its transfers would be missed."""
+        window_start, window_stop = self._window(chunk_start, chunk_stop)
+        with metrics.span("backfill_bank_accounts"):
+            bank_accounts = self._bank_accounts(account_numbers)
+        with metrics.span("backfill_bank_fetch"), ThreadPoolExecutor(
+            max_workers=min(self.fetch_workers, len(bank_accounts) or 1)
+        ) as executor:
+            bank_transactions: List[TransactionCustom] = []
+            # in the order of the accounts, as the regular import
+            for operations in executor.map(
+                lambda a: self.bank_client.list_account_transactions(a, window_start, window_stop),
+                bank_accounts,
+            ):
+                bank_transactions.extend(operations)
+
+        with metrics.span("backfill_firefly_fetch"):
+            # each chunk has its own, the next chunk is fetched while the current one is reconciled
+            interners = Interners()
+            pages = (
+                page
+                for _, page in self.firefly_connector.list_transaction_pages(
+                    self.firefly_accounts, window_start, window_stop
+                )
+            )
+            # converted one by one into the columns, without keeping the objects
+            known = OperationColumns(
+                (
+                    custom_operation
+                    for _, _, custom_operation in self.firefly_connector.iter_custom_transactions(
+                        pages, self.account_index
+                    )
+                ),
+                interners,
+            )
+        return bank_transactions, known, interners
+
+    def _reconcile(
+        self,
+        chunk_start: date,
+        chunk_stop: date,
+        bank_transactions: List[TransactionCustom],
+        known: OperationColumns,
+        interners: Interners,
+    ) -> Tuple[List[TransactionCustom], int]:
+        """Detect the transfers, remove the duplicates and keep the new operations dated inside the chunk.
+
+        :return: The new operations of the chunk and the number of duplicates removed from the chunk
+        """
+        import main
+
+        candidates = transfer_candidates(OperationColumns(bank_transactions, interners))
+        metrics.increment("backfill_transfer_candidates", int(candidates.sum()))
+        if candidates.any():
+            candidate_transactions = [
+                t for t, candidate in zip(bank_transactions, candidates) if candidate
+            ]
+            kept = {id(t) for t in candidate_transactions}
+            main.check_transfers(candidate_transactions, self.similarity_engine)
+            # the counterparts of the transfers were dropped from the candidates
+            consumed = kept - {id(t) for t in candidate_transactions}
+            bank_transactions = [t for t in bank_transactions if id(t) not in consumed]
+
+        assign_fingerprints(bank_transactions)
+        new = OperationColumns(bank_transactions, interners)
+        by_fingerprint, by_identity = duplicates(new, known)
+        in_chunk = (new.day >= chunk_start.toordinal()) & (new.day <= chunk_stop.toordinal())
+        removed = int(((by_fingerprint | by_identity) & in_chunk).sum())
+        metrics.increment("duplicates_removed", removed)
+        metrics.increment(
+            "duplicates_removed_by_fingerprint", int((by_fingerprint & in_chunk).sum())
+        )
+        kept_rows = np.flatnonzero(in_chunk & ~by_fingerprint & ~by_identity)
+        return [bank_transactions[row] for row in kept_rows], removed
+
+
+def main_cli():
+    import main
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("date_start", help="The first day to import, YYYY-MM-DD")
+    parser.add_argument("--until", help="The last day to import, YYYY-MM-DD, defaults to today")
+    parser.add_argument("--chunk-days", type=int, default=30, help="The number of days of a chunk")
+    parser.add_argument(
+        "--overlap-days", type=int, default=2, help="The number of days fetched around a chunk"
+    )
+    parser.add_argument(
+        "--checkpoint", default="backfill.sqlite", help="Where the imported chunks are recorded"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename="logging.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s: %(message)s",
+    )
+    date_start = datetime.strptime(args.date_start, DATE_FORMAT).date()
+    date_stop = (
+        datetime.strptime(args.until, DATE_FORMAT).date() if args.until else datetime.now().date()
+    )
+    similarity_engine = None
+    if os.environ.get("TRANSFER_NORMALIZE_LIBELLES") == "1":
+        similarity_engine = SimilarityEngine(normalizer=normalize_bank_libelle)
+
+    metrics.reset()
+    start = time.perf_counter()
+    try:
+        with main.build_firefly_connector() as firefly_connector, main.build_bank_client() as bank_client, \
+                BackfillCheckpoint(args.checkpoint) as checkpoint:
+            firefly_accounts = firefly_connector.get_firefly_accounts()
+            backfill = Backfill(
+                firefly_connector,
+                bank_client,
+                firefly_accounts,
+                checkpoint,
+                chunk_days=args.chunk_days,
+                overlap_days=args.overlap_days,
+                similarity_engine=similarity_engine,
+            )
+            summary = backfill.run(
+                bank_client.list_account(backfill.account_index), date_start, date_stop
+            )
+    except Exception as e:
+        logger.exception("Backfill stopped")
+        print("Backfill stopped: %s" % e)
+        sys.exit(1)
+    finally:
+        main.export_metrics()
+    print(
+        "%(chunks_imported)s chunks imported (%(chunks_skipped)s already done): "
+        "%(stored)s transactions stored, %(duplicates)s duplicates" % summary
+        + " in %.1fs" % (time.perf_counter() - start)
+    )
+
+
+if __name__ == "__main__":
+    main_cli()
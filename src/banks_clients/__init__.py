@@ -1 +1,5 @@
-from banks_clients.credit_agricole import CreditAgricole
\ No newline at end of file
+from banks_clients.bank_client import BankClient, BankError
+from banks_clients.credit_agricole import CreditAgricole
+from banks_clients.multi_bank import MultiBankClient
+from banks_clients.registry import BANK_CLIENTS, create_bank_client, register_bank_client
+from banks_clients.watermarks import BankWatermarks
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, List, Protocol
+
+from Util.Accounts.account_index import AccountIndex
+from Util.Transactions.Transaction_custom import TransactionCustom
+
+if TYPE_CHECKING:
+    from firefly_iii_client import AccountRead
+
+
+class BankError(Exception):
+    """Error of a request to a bank, including its login, the original error being its cause"""
+
+
+class BankClient(Protocol):
+    """Interface of the bank clients used by the import.
+
+    Accounts returned by `list_account` are opaque to the import, which only reads their
+    number through `account_number`.
+    """
+
+    # account number -> error raised while fetching its operations during the last listing
+    failed_accounts: Dict[str, Exception]
+
+    def __enter__(self) -> "BankClient":
+        ...
+
+    def __exit__(self, *args):
+        ...
+
+    def allow_concurrency(self, count: int):
+        """Let up to `count` bank requests run at the same time, for callers fetching several accounts concurrently"""
+        ...
+
+    def ensure_session(self):
+        """Open a new session if the current one expired"""
+        ...
+
+    def account_number(self, account: Any) -> str:
+        """The account number of an account returned by `list_account`"""
+        ...
+
+    def list_account(self, reference_accounts: List[AccountRead] | AccountIndex = None) -> List[Any]:
+        """Get the accounts of the bank matching the reference accounts"""
+        ...
+
+    def list_transactions(
+        self,
+        accounts: List[Any],
+        period_days: int = None,
+        date_starts: Dict[str, str] = None,
+        now: datetime = None,
+    ) -> List[TransactionCustom]:
+        """Get the operations of the given accounts, over the period ending on the day of `now`"""
+        ...
+
+    def list_account_transactions(
+        self, account: Any, date_start: str, date_stop: str
+    ) -> List[TransactionCustom]:
+        """Get the operations of one account between two dates (YYYY-MM-DD), both included.
+        Errors are raised to the caller."""
+        ...
@@ -7,7 +7,16 @@ class Configuration:
         department: str = None,
         username: str = None,
         password: str | List[int] = None,
+        max_workers: int = 1,
+        account_timeout: float = None,
+        session_ttl: float = None,
     ):
         self.department = department
         self.username = username
         self.password = password
+        # number of accounts fetched concurrently, 1 fetches the accounts one after the other
+        self.max_workers = max_workers
+        # maximum number of seconds the operations of a single account may take, from the start of their fetch
+        self.account_timeout = account_timeout
+        # number of seconds after which the session is renewed, None to keep it until it fails
+        self.session_ttl = session_ttl
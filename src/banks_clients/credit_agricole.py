@@ -1,15 +1,34 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from contextlib import ExitStack
 from datetime import datetime, timedelta
-from typing import List
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
 
 from creditagricole_particuliers import Authenticator
 from creditagricole_particuliers.accounts import Account, Accounts
-from firefly_iii_client import AccountRead
 
+from adaptive_limiter import THROTTLING_HTTP_STATUSES, AdaptiveLimiter, parse_retry_after
+from metrics import metrics
+from Util.Accounts.account_index import AccountIndex
 from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.transaction_type import TransactionType
+from banks_clients.bank_client import BankError
 from banks_clients.configuration import Configuration
-from firefly_iii_client.models.transaction_type_property import TransactionTypeProperty
+from banks_clients.registry import login_slot, register_bank_client
+
+if TYPE_CHECKING:
+    from firefly_iii_client import AccountRead
+
+# number of times a request throttled by the bank is sent again, after 1, 2, 4... seconds
+# when the bank does not give a Retry-After delay
+THROTTLED_RETRIES = 3
+THROTTLED_BACKOFF = 1.0
 
 
+@register_bank_client("credit_agricole")
 class CreditAgricole:
     """This class contains the client and useful functions for the Credit Agricole bank.
 
@@ -17,9 +36,17 @@ class CreditAgricole:
     """
 
     def __init__(self, configuration: Configuration):
-        self.session = Authenticator(
-            configuration.username, configuration.password, configuration.department
+        self.configuration = configuration
+        self.logger = logging.getLogger(__name__)
+        # adapts the number of concurrent bank requests, shared between the clients of a MultiBankClient
+        self.request_limiter = AdaptiveLimiter(
+            "bank", max_limit=max(1, configuration.max_workers or 1)
         )
+        # optional CaptureWriter recording the accounts and operations received
+        self.capture = None
+        self.login()
+        # account number -> error raised while fetching its operations during the last listing
+        self.failed_accounts: Dict[str, Exception] = {}
 
     def __enter__(self):
         return self
@@ -27,54 +54,238 @@ class CreditAgricole:
     def __exit__(self, *args):
         self.session = None
 
-    def list_account(self, reference_accounts: List[AccountRead] = None):
+    def login(self):
+        """Open a new session on the bank, in a login slot of the bank when their number is capped"""
+        metrics.increment("bank_logins")
+        with ExitStack() as slot:
+            with metrics.span("bank_login_wait"):
+                slot.enter_context(login_slot(self.bank))
+            self.session = self._call_bank(
+                Authenticator,
+                self.configuration.username,
+                self.configuration.password,
+                self.configuration.department,
+            )
+        self.logged_in_at = time.monotonic()
+
+    def allow_concurrency(self, count: int):
+        """Let up to `count` bank requests run at the same time, for callers fetching several
+        accounts concurrently. The request limiter is otherwise bounded by `max_workers`."""
+        if count > self.request_limiter.max_limit:
+            self.logger.info(
+                "Up to %d concurrent bank requests instead of the %d of max_workers",
+                count,
+                self.request_limiter.max_limit,
+            )
+            self.request_limiter.raise_max_limit(count)
+
+    def ensure_session(self):
+        """Open a new session if there is none or if the current one is older than the session TTL"""
+        if self.session is None or (
+            self.configuration.session_ttl is not None
+            and time.monotonic() - self.logged_in_at > self.configuration.session_ttl
+        ):
+            self.login()
+
+    def account_number(self, account: Account) -> str:
+        return account.numeroCompte
+
+    def list_account(
+        self, reference_accounts: List[AccountRead] | AccountIndex = None
+    ):
         """Get the accounts of the bank.
         If a reference list is provided, fetch only the accounts matching the accounts in the provided slist
 
         :param reference_accounts: TThe list of reference accounts to match
         :return: A list of matching accounts
         """
-        accounts: List[Account] = Accounts(session=self.session)
-        matching_accounts: List[Account] = []
+        try:
+            accounts: List[Account] = self._call_bank(Accounts, session=self.session)
+        except Exception as e:
+            # the session may have expired, log in again once
+            self.logger.warning("Could not list the accounts, logging in again: %r", e)
+            self.login()
+            accounts = self._call_bank(Accounts, session=self.session)
+        if self.capture is not None:
+            self.capture.record_bank_accounts(accounts)
 
         if reference_accounts is None:
             return accounts
+        return self._filter_accounts(accounts, reference_accounts)
 
+    @staticmethod
+    def _filter_accounts(
+        accounts: List[Account], reference_accounts: List[AccountRead] | AccountIndex
+    ) -> List[Account]:
+        matching_accounts: List[Account] = []
+        if not isinstance(reference_accounts, AccountIndex):
+            reference_accounts = AccountIndex(reference_accounts)
         for acc in accounts:
-            if any(
-                e.attributes.account_number == acc.numeroCompte
-                for e in reference_accounts
-            ):
+            if reference_accounts.has_account_number(acc.numeroCompte):
                 matching_accounts.append(acc)
         return matching_accounts
 
     def list_transactions(
-        self, accounts: List[Account], period_days=None
-    ):
+        self,
+        accounts: List[Account],
+        period_days=None,
+        date_starts: Dict[str, str] = None,
+        now: datetime = None,
+    ) -> List[TransactionCustom]:
+        """Get the operations of the given accounts.
+        Accounts are fetched concurrently using the shared session when the configuration allows
+        more than one worker. The operations are returned in the order of the accounts.
+        An account whose operations cannot be fetched, or are not received within `account_timeout`
+        seconds of the start of their fetch, is logged, recorded in `failed_accounts` and skipped.
+
+        :param accounts: The accounts to fetch the operations of
+        :param period_days: The number of days in the past to fetch the operations for
+        :param date_starts: Start dates (YYYY-MM-DD) by account number overriding the start of the period,
+            used to only fetch the operations since the last import
+        :param now: The time of the import, the period ends on its day, defaults to the current time
+        :return: The operations of all the accounts
+        """
+        date_start = None
+        date_stop = None
         if period_days is not None:
-            date_start = (datetime.now() - timedelta(days=period_days)).strftime(
-                "%Y-%m-%d"
-            )
-            date_stop = datetime.now().strftime("%Y-%m-%d")
+            now = now or datetime.now()
+            date_start = (now - timedelta(days=period_days)).strftime("%Y-%m-%d")
+            date_stop = now.strftime("%Y-%m-%d")
+        date_starts = date_starts or {}
 
-        all_operations: List[TransactionCustom] = []
-        for acc in accounts:
-            operations_for_account = acc.get_operations(
-                date_start=date_start, date_stop=date_stop
-            )
-            custom_operations_for_account = [
-                TransactionCustom(
-                    found_account_number=acc.numeroCompte,
-                    origin_account_number=acc.numeroCompte if t.montantOp < 0 else None,
-                    destination_account_number=None if t.montantOp < 0 else acc.numeroCompte,
-                    transaction_type=TransactionTypeProperty.WITHDRAWAL
-                    if t.montantOp < 0
-                    else TransactionTypeProperty.DEPOSIT,
-                    date=t.dateOp,
-                    amount=t.montantOp,
-                    libelle=t.libelleOp,
-                )
-                for t in operations_for_account.list_operations
+        self.failed_accounts = {}
+        results = self._fetch_accounts(
+            [
+                (acc, date_starts.get(acc.numeroCompte, date_start), date_stop)
+                for acc in accounts
             ]
-            all_operations.extend(custom_operations_for_account)
+        )
+        all_operations: List[TransactionCustom] = []
+        # collect in the order of the accounts to keep the output deterministic
+        for acc, result in zip(accounts, results):
+            if isinstance(result, Exception):
+                self._record_failure(acc, result)
+            else:
+                all_operations.extend(result)
         return all_operations
+
+    def _fetch_accounts(
+        self, fetches: List[Tuple[Account, str, str]]
+    ) -> List[List[TransactionCustom] | Exception]:
+        """Run `list_account_transactions` for each (account, date_start, date_stop), at most
+        `max_workers` at a time, and return their operations or errors in the same order.
+
+        The timeout of an account runs from the start of its own fetch, so that an account queued
+        behind slow ones is not given up before it was even sent. The thread of an account that
+        timed out cannot be interrupted: it is left to finish in the background and its slot is
+        given to the next account.
+        """
+        max_workers = max(1, self.configuration.max_workers or 1)
+        timeout = self.configuration.account_timeout
+        results: Dict[int, List[TransactionCustom] | Exception] = {}
+        # index of the fetches running -> time.monotonic() at their start
+        running: Dict[int, float] = {}
+        condition = threading.Condition()
+
+        def fetch(index: int):
+            try:
+                result = self.list_account_transactions(*fetches[index])
+            except Exception as e:
+                result = e
+            with condition:
+                # unless it timed out meanwhile
+                if index in running:
+                    del running[index]
+                    results[index] = result
+                condition.notify_all()
+
+        next_index = 0
+        with condition:
+            while len(results) < len(fetches):
+                while len(running) < max_workers and next_index < len(fetches):
+                    running[next_index] = time.monotonic()
+                    threading.Thread(
+                        target=fetch,
+                        args=(next_index,),
+                        name="bank-account-%d" % next_index,
+                        daemon=True,
+                    ).start()
+                    next_index += 1
+                if timeout is None:
+                    condition.wait()
+                    continue
+                now = time.monotonic()
+                timed_out = [i for i, started in running.items() if now - started >= timeout]
+                for index in timed_out:
+                    del running[index]
+                    results[index] = TimeoutError(
+                        "No operations received within %ss" % timeout
+                    )
+                if not timed_out and running:
+                    condition.wait(min(running.values()) + timeout - now)
+        return [results[index] for index in range(len(fetches))]
+
+    def _record_failure(self, account: Account, error: Exception):
+        metrics.increment("bank_accounts_failed")
+        self.failed_accounts[account.numeroCompte] = error
+        self.logger.error(
+            "Could not fetch the operations of account %s: %r",
+            account.numeroCompte,
+            error,
+        )
+
+    def _call_bank(self, function: Callable, *args, **kwargs) -> Any:
+        """Call the bank in a slot of the request limiter.
+        Every error lowers the concurrency; a throttling response, recognised by the status of the
+        response attached to the error, is retried once the Retry-After delay has passed
+        or after an exponential backoff. Errors are raised as a BankError caused by the original error."""
+        attempt = 0
+        while True:
+            attempt += 1
+            with self.request_limiter.slot(function.__name__) as slot:
+                try:
+                    return function(*args, **kwargs)
+                except Exception as e:
+                    response = getattr(e, "response", None)
+                    retry_after = parse_retry_after(getattr(response, "headers", None))
+                    if getattr(response, "status_code", None) not in THROTTLING_HTTP_STATUSES:
+                        slot.failed(retry_after)
+                        raise BankError("%s failed: %r" % (function.__name__, e)) from e
+                    slot.throttled(retry_after)
+                    if attempt > THROTTLED_RETRIES:
+                        raise BankError("%s still throttled: %r" % (function.__name__, e)) from e
+                    self.logger.warning("Throttled by the bank, retrying: %r", e)
+                    metrics.increment("bank_retries")
+            if retry_after is None:
+                # out of the slot, other requests go on meanwhile
+                time.sleep(THROTTLED_BACKOFF * 2 ** (attempt - 1))
+
+    def list_account_transactions(
+        self, acc: Account, date_start: str, date_stop: str
+    ) -> List[TransactionCustom]:
+        """Get the operations of one account between two dates (YYYY-MM-DD), both included"""
+        metrics.increment("bank_api_calls")
+        operations_for_account = self._call_bank(
+            acc.get_operations, date_start=date_start, date_stop=date_stop
+        )
+        metrics.increment(
+            "bank_transactions_fetched", len(operations_for_account.list_operations)
+        )
+        if self.capture is not None:
+            self.capture.record_bank_operations(
+                acc, date_start, date_stop, operations_for_account.list_operations
+            )
+        return [
+            TransactionCustom(
+                found_account_number=acc.numeroCompte,
+                origin_account_number=acc.numeroCompte if t.montantOp < 0 else None,
+                destination_account_number=None if t.montantOp < 0 else acc.numeroCompte,
+                transaction_type=TransactionType.WITHDRAWAL
+                if t.montantOp < 0
+                else TransactionType.DEPOSIT,
+                date=t.dateOp,
+                amount=t.montantOp,
+                libelle=t.libelleOp,
+            )
+            for t in operations_for_account.list_operations
+        ]
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple
+
+from adaptive_limiter import AdaptiveLimiter
+from metrics import metrics
+from Util.Accounts.account_index import AccountIndex
+from Util.Transactions.Transaction_custom import TransactionCustom
+from banks_clients.bank_client import BankClient
+from banks_clients.registry import create_bank_client, load_connections
+
+if TYPE_CHECKING:
+    from firefly_iii_client import AccountRead
+
+
+class ConnectionAccount(NamedTuple):
+    """An account of one of the connections of a MultiBankClient"""
+
+    connection: str
+    account: Any
+
+
+class MultiBankClient:
+    """Bank client merging several bank connections, possibly to different banks.
+
+    The connections are queried concurrently and their operations are merged, in the order of
+    the connections, into one list so that transfers between banks are detected like transfers
+    within a bank. A shared limiter bounds the number of bank requests running at the same time
+    over all the connections, and lowers it when the banks throttle or fail.
+
+    :param clients: The logged in client of each connection, by connection name
+    :param max_concurrency: The maximum number of bank requests running at the same time
+    """
+
+    def __init__(self, clients: Dict[str, BankClient], max_concurrency: int = 4):
+        self.clients = clients
+        self.logger = logging.getLogger(__name__)
+        self.request_limiter = AdaptiveLimiter("bank", max_limit=max_concurrency)
+        for client in self.clients.values():
+            client.request_limiter = self.request_limiter
+        self.failed_accounts: Dict[str, Exception] = {}
+
+    @classmethod
+    def from_connections_file(cls, path: str) -> "MultiBankClient":
+        """Create and log in the clients of the connections listed in a file, see `load_connections`"""
+        connections = load_connections(path)
+        names = [c.get("name", c["bank"]) for c in connections["connections"]]
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            clients = list(executor.map(create_bank_client, connections["connections"]))
+        return cls(dict(zip(names, clients)), connections.get("max_concurrency", 4))
+
+    @property
+    def capture(self):
+        return next(iter(self.clients.values())).capture if self.clients else None
+
+    @capture.setter
+    def capture(self, capture):
+        for client in self.clients.values():
+            client.capture = capture
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for client in self.clients.values():
+            client.__exit__(*args)
+
+    def allow_concurrency(self, count: int):
+        """The shared limiter stays bounded by `max_concurrency`, set for all the connections"""
+        if count > self.request_limiter.max_limit:
+            self.logger.info(
+                "%d accounts fetched at the same time, but at most %d bank requests by max_concurrency",
+                count,
+                self.request_limiter.max_limit,
+            )
+
+    def ensure_session(self):
+        self._each(lambda name, client: client.ensure_session())
+
+    def account_number(self, account: ConnectionAccount) -> str:
+        return self.clients[account.connection].account_number(account.account)
+
+    def list_account(
+        self, reference_accounts: List[AccountRead] | AccountIndex = None
+    ) -> List[ConnectionAccount]:
+        """Get the accounts of all the connections.
+
+        :param reference_accounts: The list of reference accounts to match
+        :return: The matching accounts, in the order of the connections
+        """
+        if reference_accounts is not None and not isinstance(reference_accounts, AccountIndex):
+            reference_accounts = AccountIndex(reference_accounts)
+        accounts = self._each(
+            lambda name, client: [
+                ConnectionAccount(name, a) for a in client.list_account(reference_accounts)
+            ]
+        )
+        return [a for connection_accounts in accounts for a in connection_accounts]
+
+    def list_transactions(
+        self,
+        accounts: List[ConnectionAccount],
+        period_days: int = None,
+        date_starts: Dict[str, str] = None,
+        now: datetime = None,
+    ) -> List[TransactionCustom]:
+        """Get the operations of the given accounts of all the connections.
+        The failed accounts of every connection are gathered in `failed_accounts`.
+
+        :param accounts: The accounts to fetch the operations of
+        :param period_days: The number of days in the past to fetch the operations for
+        :param date_starts: Start dates (YYYY-MM-DD) by account number overriding the start of the period
+        :param now: The time of the import, the period ends on its day, defaults to the current time
+        :return: The operations of all the accounts, in the order of the connections
+        """
+        accounts_by_connection = {name: [] for name in self.clients}
+        for a in accounts:
+            accounts_by_connection[a.connection].append(a.account)
+
+        operations = self._each(
+            lambda name, client: client.list_transactions(
+                accounts_by_connection[name], period_days, date_starts=date_starts, now=now
+            )
+            if accounts_by_connection[name]
+            else []
+        )
+        self.failed_accounts = {}
+        for client in self.clients.values():
+            self.failed_accounts.update(client.failed_accounts)
+        metrics.set_gauge("bank_connections", len(self.clients))
+        return [t for connection_operations in operations for t in connection_operations]
+
+    def list_account_transactions(
+        self, account: ConnectionAccount, date_start: str, date_stop: str
+    ) -> List[TransactionCustom]:
+        return self.clients[account.connection].list_account_transactions(
+            account.account, date_start, date_stop
+        )
+
+    def _each(self, function) -> list:
+        # one thread per connection, the bank requests themselves are bounded by the request limiter
+        with ThreadPoolExecutor(max_workers=len(self.clients) or 1) as executor:
+            futures = [
+                executor.submit(function, name, client) for name, client in self.clients.items()
+            ]
+            return [f.result() for f in futures]
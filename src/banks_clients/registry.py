@@ -0,0 +1,76 @@
+import json
+import os
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Dict, Tuple
+
+from banks_clients.bank_client import BankClient
+from banks_clients.configuration import Configuration
+
+# bank name -> (client class, configuration class)
+BANK_CLIENTS: Dict[str, Tuple[Callable[..., BankClient], type]] = {}
+# bank name -> context manager held around every login to the bank, e.g. a semaphore shared between processes
+LOGIN_LIMITS: Dict[str, ContextManager] = {}
+
+
+def register_bank_client(name: str, configuration_class: type = Configuration):
+    """Class decorator registering a bank client under the name used in the connections file"""
+
+    def register(client_class):
+        BANK_CLIENTS[name] = (client_class, configuration_class)
+        client_class.bank = name
+        return client_class
+
+    return register
+
+
+def login_slot(bank: str) -> ContextManager:
+    """The context manager to hold around a login to the bank, see LOGIN_LIMITS"""
+    return LOGIN_LIMITS.get(bank) or nullcontext()
+
+
+def create_bank_client(settings: dict) -> BankClient:
+    """Create and log in the client of a bank connection.
+
+    :param settings: The settings of the connection: the `bank` name and the arguments of its configuration.
+        String values are expanded with the environment variables, e.g. "${BANK_PASSWORD}".
+    :return: The client of the connection
+    """
+    settings = dict(settings)
+    bank = settings.pop("bank")
+    settings.pop("name", None)
+    if bank not in BANK_CLIENTS:
+        raise Exception(
+            "Unknown bank %s, registered banks: %s" % (bank, ", ".join(sorted(BANK_CLIENTS)))
+        )
+    client_class, configuration_class = BANK_CLIENTS[bank]
+    configuration = configuration_class(
+        **{
+            k: os.path.expandvars(v) if isinstance(v, str) else v
+            for k, v in settings.items()
+        }
+    )
+    return client_class(configuration)
+
+
+def load_connections(path: str) -> dict:
+    """Read a bank connections file.
+
+    The file is a JSON object with an optional `max_concurrency`, the maximum number of bank
+    requests running at the same time over all the connections, and the list of `connections`:
+
+        {
+            "max_concurrency": 4,
+            "connections": [
+                {"name": "personal", "bank": "credit_agricole", "department": 81,
+                 "username": "${CA_USERNAME}", "password": "${CA_PASSWORD}", "max_workers": 2}
+            ]
+        }
+    """
+    with open(path) as f:
+        connections = json.load(f)
+    names = [c.get("name", c.get("bank")) for c in connections.get("connections", [])]
+    if not names:
+        raise Exception("No bank connection in %s" % path)
+    if len(set(names)) != len(names):
+        raise Exception("Bank connection names must be unique in %s" % path)
+    return connections
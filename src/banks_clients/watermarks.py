@@ -0,0 +1,76 @@
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, Iterable
+
+
+class BankWatermarks:
+    """Persist, for each bank account, the day up to which its operations were imported.
+
+    :param path: The path of the SQLite database
+    :param overlap_days: The number of days before the watermark fetched again, to catch late operations
+    """
+
+    def __init__(self, path: str, overlap_days: int = 7):
+        self.overlap_days = overlap_days
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bank_watermarks (
+                    account_number TEXT PRIMARY KEY,
+                    imported_until TEXT NOT NULL
+                )
+                """
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self) -> Dict[str, str]:
+        return dict(
+            self.connection.execute(
+                "SELECT account_number, imported_until FROM bank_watermarks"
+            )
+        )
+
+    def date_starts(
+        self, account_numbers: Iterable[str], period_days: int, now: datetime = None
+    ) -> Dict[str, str]:
+        """Compute the first day (YYYY-MM-DD) to fetch for each account.
+        Accounts without a watermark are fetched for the whole period,
+        and the overlap never reaches further back than the period.
+
+        :param account_numbers: The bank account numbers
+        :param period_days: The number of days of the full window
+        :param now: The time of the import, the window ends on its day, defaults to the current time
+        :return: The start dates by account number
+        """
+        now = now or datetime.now()
+        period_start = (now - timedelta(days=period_days)).strftime("%Y-%m-%d")
+        watermarks = self.get()
+        date_starts: Dict[str, str] = {}
+        for account_number in account_numbers:
+            if account_number not in watermarks:
+                date_starts[account_number] = period_start
+                continue
+            date_start = (
+                datetime.strptime(watermarks[account_number], "%Y-%m-%d")
+                - timedelta(days=self.overlap_days)
+            ).strftime("%Y-%m-%d")
+            date_starts[account_number] = max(date_start, period_start)
+        return date_starts
+
+    def update(self, account_numbers: Iterable[str], imported_until: str):
+        """Record that the operations of the accounts were imported up to the given day (YYYY-MM-DD)."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO bank_watermarks VALUES (?, ?)",
+                ((a, imported_until) for a in account_numbers),
+            )
@@ -0,0 +1,210 @@
+"""Run the imports of several tenants in parallel.
+
+Every tenant is one Firefly III instance with its bank logins, configured by the environment
+variables that main.py reads. The tenants run in a pool of processes, so that the reconciliation
+of several tenants uses several cores, while the number of concurrent logins to each bank is
+capped over all the processes. A failing tenant does not stop the others, and one report gathers
+the result and the timings of every tenant.
+
+The manifest is a JSON file:
+
+    {
+        "max_logins_per_bank": {"credit_agricole": 2},
+        "tenants": [
+            {"name": "household-a", "environment": {"FIREFLY_III_URL": "...", "CREDIT_AGRICOLE_PASSWORD": "${A_PASSWORD}"}},
+            {"name": "household-b", "environment": {...}}
+        ]
+    }
+
+String values of the environments are expanded with the environment variables of the runner.
+A tenant with a "replay" capture path runs on that capture instead of the bank and Firefly III.
+
+Usage:
+    python src/batch_runner.py tenants.json [--workers 4] [--report report.json] [--log-directory logs]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+logger = logging.getLogger(__name__)
+
+# set in each worker process by _init_worker
+_log_directory: str = None
+
+
+def load_manifest(path: str) -> dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    names = [t.get("name") for t in manifest.get("tenants", [])]
+    if not names or None in names:
+        raise Exception("Every tenant of %s needs a name" % path)
+    if len(set(names)) != len(names):
+        raise Exception("Tenant names must be unique in %s" % path)
+    return manifest
+
+
+def _init_worker(login_limits: dict, log_directory: str):
+    global _log_directory
+    from banks_clients.registry import LOGIN_LIMITS
+
+    # every login of the clients of this process, one per connection, takes a slot of its bank
+    LOGIN_LIMITS.update(login_limits)
+    _log_directory = log_directory
+
+
+def run_tenant(tenant: dict) -> dict:
+    """Run the import of one tenant in the current process and report its outcome, never raising"""
+    import main
+    from firefly_connector import StoreStatus
+    from metrics import metrics
+
+    name = tenant["name"]
+    environment = {
+        k: os.path.expandvars(v) if isinstance(v, str) else str(v)
+        for k, v in tenant.get("environment", {}).items()
+    }
+    saved_environment = dict(os.environ)
+    handler = None
+    if _log_directory:
+        handler = logging.FileHandler(os.path.join(_log_directory, "%s.log" % name))
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s: %(message)s"))
+        logging.getLogger().addHandler(handler)
+
+    report = {"name": name, "pid": os.getpid(), "status": "ok", "error": None}
+    start = time.perf_counter()
+    try:
+        # the tenant configuration is read from the environment by main
+        os.environ.update(environment)
+        metrics.reset()
+        metrics.profile_stage = os.environ.get("PROFILE_STAGE")
+        logger.critical("Starting the import of tenant %s", name)
+
+        with ExitStack() as clients:
+            if tenant.get("replay"):
+                from capture import Capture, ReplayBankClient, ReplayFireflyConnector
+
+                capture = Capture(tenant["replay"])
+                firefly_connector = clients.enter_context(ReplayFireflyConnector(capture))
+                bank_client = clients.enter_context(ReplayBankClient(capture))
+            else:
+                firefly_connector = clients.enter_context(main.build_firefly_connector())
+                bank_client = clients.enter_context(main.build_bank_client())
+
+            results = main.run_import(firefly_connector, bank_client=bank_client)
+        report["transactions"] = {
+            status.value: sum(1 for r in results if r.status == status) for status in StoreStatus
+        }
+        if report["transactions"][StoreStatus.FAILED.value]:
+            report["status"] = "partial"
+    except Exception as e:
+        logger.exception("Import of tenant %s failed", name)
+        report.update(
+            {"status": "failed", "error": repr(e), "traceback": traceback.format_exc()}
+        )
+    finally:
+        report["seconds"] = round(time.perf_counter() - start, 3)
+        report["metrics"] = metrics.to_dict()
+        # the process runs other tenants next
+        os.environ.clear()
+        os.environ.update(saved_environment)
+        if handler is not None:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+    return report
+
+
+def run_batch(manifest: dict, workers: int = None, log_directory: str = None) -> dict:
+    """Run the imports of the tenants of a manifest in a pool of processes.
+
+    :param manifest: The manifest, see load_manifest
+    :param workers: The number of processes, defaults to the number of cores
+    :param log_directory: The directory where the log of each tenant is written, None to not write them
+    :return: The consolidated report of the tenants, in the order of the manifest
+    """
+    tenants = manifest["tenants"]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tenants)))
+    if log_directory:
+        os.makedirs(log_directory, exist_ok=True)
+
+    started_at = time.time()
+    start = time.perf_counter()
+    # imported once here, the workers forked from this process inherit the modules instead of importing them;
+    # main only imports the Firefly III client when it is first used, so it is loaded explicitly
+    import main  # noqa: F401
+    from firefly_connector import firefly_client
+
+    firefly_client()
+
+    with multiprocessing.Manager() as manager:
+        login_limits = {
+            bank: manager.BoundedSemaphore(max(1, limit))
+            for bank, limit in manifest.get("max_logins_per_bank", {}).items()
+        }
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(login_limits, log_directory),
+        ) as executor:
+            futures = [executor.submit(run_tenant, t) for t in tenants]
+            reports = []
+            for tenant, future in zip(tenants, futures):
+                try:
+                    reports.append(future.result())
+                except Exception as e:
+                    # the worker process died, e.g. killed or out of memory
+                    logger.error("Tenant %s crashed its worker: %r", tenant["name"], e)
+                    reports.append(
+                        {"name": tenant["name"], "status": "failed", "error": repr(e)}
+                    )
+
+    return {
+        "started_at": started_at,
+        "duration_seconds": round(time.perf_counter() - start, 3),
+        "workers": workers,
+        "summary": {
+            status: sum(1 for r in reports if r["status"] == status)
+            for status in ("ok", "partial", "failed")
+        },
+        "tenant_seconds": round(sum(r.get("seconds", 0) for r in reports), 3),
+        "tenants": reports,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("manifest", help="The JSON manifest of the tenants")
+    parser.add_argument("--workers", type=int, help="Number of processes, defaults to the number of cores")
+    parser.add_argument("--report", default="batch_report.json", help="Where to write the report")
+    parser.add_argument("--log-directory", help="Write the log of each tenant to this directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename="logging.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s: %(message)s",
+    )
+    report = run_batch(load_manifest(args.manifest), args.workers, args.log_directory)
+
+    temporary_path = args.report + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(temporary_path, args.report)
+    print(
+        "%(ok)s ok, %(partial)s partial, %(failed)s failed" % report["summary"]
+        + " in %ss, report written to %s" % (report["duration_seconds"], args.report)
+    )
+    if report["summary"]["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
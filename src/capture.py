@@ -0,0 +1,343 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Tuple
+
+import firefly_iii_client
+from firefly_iii_client import AccountRead, TransactionArray
+from firefly_iii_client.configuration import Configuration as Firefly_configuration
+
+from adaptive_limiter import AdaptiveLimiter
+from banks_clients.configuration import Configuration as Bank_configuration
+from banks_clients.credit_agricole import CreditAgricole
+from firefly_connector import FireflyConnector, StoreResult, StoreStatus
+from metrics import metrics
+from Util.Transactions.Transaction_custom import parse_bank_date
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FORMAT = "firefly-importer-capture"
+CAPTURE_VERSION = 1
+
+# fields of the Firefly III payloads replaced by a pseudonym when redacting
+REDACTED_FIREFLY_FIELDS = {
+    "name",
+    "iban",
+    "bic",
+    "account_number",
+    "notes",
+    "source_name",
+    "source_iban",
+    "destination_name",
+    "destination_iban",
+}
+# attributes of the Credit Agricole payloads read by the importer
+BANK_ACCOUNT_FIELDS = ("numeroCompte", "libelleProduit")
+BANK_OPERATION_FIELDS = ("dateOp", "libelleOp", "montantOp")
+REDACTED_BANK_FIELDS = {"numeroCompte", "libelleProduit"}
+
+
+class Redactor:
+    """Replace sensitive values by pseudonyms.
+
+    The same value always gets the same pseudonym within a capture, so that an account number
+    still matches between the bank and Firefly III payloads. The key is random and never written,
+    so the pseudonyms cannot be reversed by trying account numbers.
+    """
+
+    def __init__(self):
+        self._key = os.urandom(32)
+
+    def redact(self, value: Any) -> Any:
+        if not isinstance(value, str) or not value:
+            return value
+        digest = hmac.new(self._key, value.encode(), hashlib.sha256).hexdigest()
+        return "redacted-%s" % digest[:16]
+
+    def redact_fields(self, payload: Any, fields: set) -> Any:
+        """Redact the values of the given keys anywhere in a JSON payload"""
+        if isinstance(payload, dict):
+            return {
+                k: self.redact(v) if k in fields else self.redact_fields(v, fields)
+                for k, v in payload.items()
+            }
+        if isinstance(payload, list):
+            return [self.redact_fields(v, fields) for v in payload]
+        return payload
+
+
+class CaptureWriter:
+    """Record the raw inputs of an import in a gzip compressed JSON lines file.
+
+    The first line is a header with the format and its version, every other line is one record:
+    the Firefly III accounts, a page of Firefly III transactions, the bank accounts or the
+    operations of a bank account over a window.
+    The operation libelles are kept even when redacting, as transfer detection depends on them.
+
+    :param path: The path of the capture file
+    :param redact: Whether to replace the account numbers, IBANs and names by pseudonyms
+    :param now: The time of the captured import, defaults to the current time. The import must be
+        run with it, so that its replay requests the same windows whatever the day
+    """
+
+    def __init__(self, path: str, redact: bool = False, now: datetime = None):
+        self.path = path
+        self.redactor = Redactor() if redact else None
+        self.now = now or datetime.now()
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._write(
+            {
+                "format": CAPTURE_FORMAT,
+                "version": CAPTURE_VERSION,
+                "created_at": time.time(),
+                # local time of the import, the day on which its windows end
+                "now": self.now.isoformat(),
+                "redacted": redact,
+            }
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def _write(self, record: dict):
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def _firefly_payload(self, payload: dict) -> dict:
+        if self.redactor is None:
+            return payload
+        return self.redactor.redact_fields(payload, REDACTED_FIREFLY_FIELDS)
+
+    def _bank_value(self, field: str, value: Any) -> Any:
+        if self.redactor is None or field not in REDACTED_BANK_FIELDS:
+            return value
+        return self.redactor.redact(value)
+
+    def record_firefly_accounts(self, accounts: List[AccountRead]):
+        self._write(
+            {
+                "kind": "firefly_accounts",
+                "accounts": [
+                    self._firefly_payload(
+                        a.model_dump(mode="json", by_alias=True, exclude_none=True)
+                    )
+                    for a in accounts
+                ],
+            }
+        )
+
+    def record_firefly_page(self, account_id: str, page: TransactionArray):
+        self._write(
+            {
+                "kind": "firefly_page",
+                "account_id": account_id,
+                "page": self._firefly_payload(
+                    page.model_dump(mode="json", by_alias=True, exclude_none=True)
+                ),
+            }
+        )
+
+    def record_bank_accounts(self, accounts: Iterable[Any]):
+        self._write(
+            {
+                "kind": "bank_accounts",
+                "accounts": [
+                    {f: self._bank_value(f, getattr(a, f, None)) for f in BANK_ACCOUNT_FIELDS}
+                    for a in accounts
+                ],
+            }
+        )
+
+    def record_bank_operations(
+        self, account: Any, date_start: str, date_stop: str, operations: Iterable[Any]
+    ):
+        self._write(
+            {
+                "kind": "bank_operations",
+                "account_number": self._bank_value("numeroCompte", account.numeroCompte),
+                "date_start": date_start,
+                "date_stop": date_stop,
+                "operations": [
+                    {f: getattr(o, f, None) for f in BANK_OPERATION_FIELDS} for o in operations
+                ],
+            }
+        )
+
+
+class Capture:
+    """The content of a capture file, see CaptureWriter
+
+    :param path: The path of the capture file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header: dict = {}
+        self.firefly_accounts: List[dict] = []
+        # Firefly III account id -> pages
+        self.firefly_pages: Dict[str, List[dict]] = defaultdict(list)
+        # account number -> account
+        self.bank_accounts: Dict[str, dict] = {}
+        # account number -> (date start, date stop) -> operations
+        self.bank_operations: Dict[str, Dict[Tuple[str, str], List[dict]]] = defaultdict(dict)
+
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            self.header = json.loads(f.readline() or "{}")
+            if (
+                self.header.get("format") != CAPTURE_FORMAT
+                or self.header.get("version") != CAPTURE_VERSION
+            ):
+                raise Exception(
+                    "Unsupported capture %s: format %s version %s, expected %s version %s"
+                    % (
+                        path,
+                        self.header.get("format"),
+                        self.header.get("version"),
+                        CAPTURE_FORMAT,
+                        CAPTURE_VERSION,
+                    )
+                )
+            for line in f:
+                record = json.loads(line)
+                kind = record["kind"]
+                if kind == "firefly_accounts":
+                    self.firefly_accounts = record["accounts"]
+                elif kind == "firefly_page":
+                    self.firefly_pages[record["account_id"]].append(record["page"])
+                elif kind == "bank_accounts":
+                    for a in record["accounts"]:
+                        self.bank_accounts[a["numeroCompte"]] = a
+                elif kind == "bank_operations":
+                    self.bank_operations[record["account_number"]][
+                        (record["date_start"], record["date_stop"])
+                    ] = record["operations"]
+                else:
+                    logger.warning("Unknown record %s in capture %s", kind, path)
+
+    @property
+    def now(self) -> datetime:
+        """The time of the captured import, to run its replay with"""
+        if "now" in self.header:
+            return datetime.fromisoformat(self.header["now"])
+        # captures made before the time of the import was recorded
+        return datetime.fromtimestamp(self.header["created_at"])
+
+
+class ReplayAccount:
+    """Bank account answering with the operations of a capture"""
+
+    def __init__(self, account: dict, windows: Dict[Tuple[str, str], List[dict]]):
+        self.numeroCompte = account["numeroCompte"]
+        self.libelleProduit = account.get("libelleProduit")
+        self.windows = windows
+
+    def get_operations(self, date_start: str = None, date_stop: str = None):
+        operations = self.windows.get((date_start, date_stop))
+        if operations is None:
+            # another window than the captured ones, e.g. replayed without the time of the capture
+            operations = []
+            for _, window in sorted(self.windows.items(), key=lambda w: w[0][0] or ""):
+                for o in window:
+                    day = parse_bank_date(o["dateOp"]).strftime("%Y-%m-%d")
+                    if (date_start is None or day >= date_start) and (
+                        date_stop is None or day <= date_stop
+                    ):
+                        operations.append(o)
+        return SimpleNamespace(list_operations=[SimpleNamespace(**o) for o in operations])
+
+
+class ReplayBankClient(CreditAgricole):
+    """Credit Agricole client replaying the accounts and operations of a capture, without network.
+    The conversion of the operations is the one of the real client.
+
+    :param capture: The capture to replay
+    :param configuration: A bank configuration object, only used for the fetching options
+    """
+
+    def __init__(self, capture: Capture, configuration: Bank_configuration = None):
+        self.capture_source = capture
+        self.configuration = configuration or Bank_configuration()
+        self.logger = logging.getLogger(__name__)
+        self.request_limiter = AdaptiveLimiter(
+            "bank", max_limit=max(1, self.configuration.max_workers or 1)
+        )
+        self.capture = None
+        self.session = None
+        self.failed_accounts: Dict[str, Exception] = {}
+
+    def login(self):
+        pass
+
+    def ensure_session(self):
+        pass
+
+    def list_account(self, reference_accounts=None) -> List[ReplayAccount]:
+        accounts = [
+            ReplayAccount(a, self.capture_source.bank_operations.get(number, {}))
+            for number, a in self.capture_source.bank_accounts.items()
+        ]
+        if reference_accounts is None:
+            return accounts
+        return self._filter_accounts(accounts, reference_accounts)
+
+
+class ReplayFireflyConnector(FireflyConnector):
+    """Firefly III connector replaying the accounts and transactions of a capture, without network.
+    New transactions are not sent anywhere and are reported as stored.
+
+    :param capture: The capture to replay
+    :param max_workers: The number of concurrent calls, as for the real connector
+    """
+
+    def __init__(self, capture: Capture, max_workers: int = 4):
+        super().__init__(Firefly_configuration(host="http://replay.invalid/api"), max_workers)
+        self.capture_source = capture
+
+    def get_firefly_accounts(self):
+        accounts = [AccountRead.from_dict(a) for a in self.capture_source.firefly_accounts]
+        if self.capture is not None:
+            self.capture.record_firefly_accounts(accounts)
+        return accounts
+
+    def list_transaction_pages(
+        self,
+        accounts: List[AccountRead],
+        date_start: str = None,
+        date_stop: str = None,
+        date_starts: Dict[str, str] = None,
+    ):
+        for a in accounts:
+            for page in self.capture_source.firefly_pages.get(a.id, []):
+                transactions = TransactionArray.from_dict(page)
+                metrics.increment("firefly_pages")
+                metrics.increment("firefly_transactions_fetched", len(transactions.data))
+                yield a.id, transactions
+
+    def create_firefly_transactions(
+        self, transaction: List[firefly_iii_client.TransactionSplitStore]
+    ) -> List[StoreResult]:
+        return [self.create_firefly_transaction(t) for t in transaction]
+
+    def create_firefly_transaction(
+        self, transaction: firefly_iii_client.TransactionSplitStore
+    ) -> StoreResult:
+        metrics.increment("transactions_stored")
+        return StoreResult(transaction, StoreStatus.STORED, 1)
@@ -0,0 +1,129 @@
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+import banks_clients
+from firefly_connector import FireflyConnector
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImportDaemon:
+    """Run imports on a schedule in a long running process.
+
+    The Firefly III connector and its connection pool, as well as the bank session, are kept
+    between the imports, also after a failed import unless a bank request failed. The bank
+    session is renewed when it expires and the Firefly III accounts are reloaded when they are
+    older than their TTL.
+    Imports run one after the other and never overlap: the next import starts one interval,
+    plus or minus the jitter, after the start of the previous one, or right after it if it took longer.
+
+    :param interval: The number of seconds between the start of two imports
+    :param jitter: The maximum number of seconds added to or removed from the interval
+    :param accounts_ttl: The number of seconds the Firefly III accounts are kept before being reloaded
+    """
+
+    def __init__(self, interval: float, jitter: float = 0, accounts_ttl: float = 3600):
+        self.interval = interval
+        self.jitter = jitter
+        self.accounts_ttl = accounts_ttl
+        self.stop_event = threading.Event()
+        self._cycle_lock = threading.Lock()
+        self.firefly_connector: FireflyConnector = None
+        self.bank_client: banks_clients.BankClient = None
+        self._firefly_accounts = None
+        self._firefly_accounts_loaded_at = None
+
+    @classmethod
+    def from_environment(cls) -> "ImportDaemon":
+        return cls(
+            interval=float(os.environ.get("IMPORT_INTERVAL_SECONDS", 3600)),
+            jitter=float(os.environ.get("IMPORT_JITTER_SECONDS", 0)),
+            accounts_ttl=float(os.environ.get("ACCOUNTS_TTL_SECONDS", 3600)),
+        )
+
+    def stop(self, *args):
+        logger.info("Stopping the import daemon after the current import")
+        self.stop_event.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.critical(
+            "Starting the import daemon, importing every %ss (+/- %ss)",
+            self.interval,
+            self.jitter,
+        )
+        try:
+            while not self.stop_event.is_set():
+                cycle_start = time.monotonic()
+                self.run_cycle()
+                delay = self.interval + random.uniform(-self.jitter, self.jitter)
+                self.stop_event.wait(max(0, cycle_start + delay - time.monotonic()))
+        finally:
+            self.close()
+        logger.critical("Import daemon stopped")
+
+    def run_cycle(self):
+        """Run one import, unless one is already running"""
+        # imported here as main imports this module for the --daemon flag
+        from main import build_bank_client, build_firefly_connector, export_metrics, run_import
+
+        if not self._cycle_lock.acquire(blocking=False):
+            logger.warning("An import is still running, skipping this cycle")
+            return
+        try:
+            logger.critical(
+                "\n\n*****************************\nStarting new import cycle\n*****************************\n"
+            )
+            metrics.reset()
+            metrics.profile_stage = os.environ.get("PROFILE_STAGE")
+            if self.firefly_connector is None:
+                self.firefly_connector = build_firefly_connector()
+            if self.bank_client is None:
+                self.bank_client = build_bank_client()
+            else:
+                with metrics.span("bank_login"):
+                    self.bank_client.ensure_session()
+            run_import(
+                self.firefly_connector,
+                bank_client=self.bank_client,
+                firefly_accounts=self._accounts(),
+            )
+        except banks_clients.BankError:
+            logger.exception("Import cycle failed on a bank request")
+            metrics.increment("import_cycles_failed")
+            # the session may be the cause, start the next cycle with a new one
+            self._close_bank_client()
+        except Exception:
+            # the bank session is kept, it is renewed by the next cycle if it expired meanwhile
+            logger.exception("Import cycle failed")
+            metrics.increment("import_cycles_failed")
+        finally:
+            export_metrics()
+            self._cycle_lock.release()
+
+    def _accounts(self):
+        if (
+            self._firefly_accounts is None
+            or time.monotonic() - self._firefly_accounts_loaded_at > self.accounts_ttl
+        ):
+            with metrics.span("firefly_accounts"):
+                self._firefly_accounts = self.firefly_connector.get_firefly_accounts()
+            self._firefly_accounts_loaded_at = time.monotonic()
+        return self._firefly_accounts
+
+    def _close_bank_client(self):
+        if self.bank_client is not None:
+            self.bank_client.__exit__(None, None, None)
+            self.bank_client = None
+
+    def close(self):
+        self._close_bank_client()
+        if self.firefly_connector is not None:
+            self.firefly_connector.close()
+            self.firefly_connector = None
@@ -1,56 +1,173 @@
+from __future__ import annotations
+
 import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from typing import List
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 
-import firefly_iii_client
-from firefly_iii_client import AccountRead, ApiException, TransactionArray
-from firefly_iii_client.configuration import Configuration as Firefly_configuration
-from firefly_iii_client.models.transaction_type_property import TransactionTypeProperty
+from adaptive_limiter import THROTTLING_HTTP_STATUSES, AdaptiveLimiter, parse_retry_after
+from metrics import metrics
+from Util.Accounts.account_index import AccountIndex
+from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.fingerprint import assign_fingerprints, is_fingerprint
+from Util.Transactions.transaction_type import TransactionType
 
+if TYPE_CHECKING:
+    # the generated client is large, it is only imported when the connector is created
+    import firefly_iii_client
+    from firefly_iii_client import AccountRead, TransactionArray
+    from firefly_iii_client.configuration import Configuration as Firefly_configuration
 
-from Util.Transactions.Transaction_custom import TransactionCustom
+# HTTP statuses worth retrying: throttling and temporary server errors
+TRANSIENT_HTTP_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def firefly_client():
+    """The generated Firefly III client package.
+    Importing it takes seconds, so it is imported on the first call instead of with this module."""
+    import firefly_iii_client
+
+    return firefly_iii_client
+
+
+class StoreStatus(Enum):
+    STORED = "stored"
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+
+
+class StoredSplit(NamedTuple):
+    """The identifiers given by Firefly III to a stored split, with the accounts it resolved, e.g. its
+    cash account for the missing side of a withdrawal.
+    The names are those of the fields of the split read from Firefly III."""
+
+    group_id: str
+    transaction_journal_id: str
+    source_id: str | None
+    destination_id: str | None
+
+
+class StoreResult:
+    """Outcome of the creation of a transaction in Firefly III.
+
+    :param transaction: The transaction that was sent
+    :param status: Whether the transaction was stored, rejected as a duplicate or failed
+    :param attempts: The number of calls made to store the transaction
+    :param error: The last error received, if any
+    :param stored: The identifiers of the split created by Firefly III, if it was stored
+    """
+
+    def __init__(
+        self,
+        transaction: firefly_iii_client.TransactionSplitStore,
+        status: StoreStatus,
+        attempts: int,
+        error: Exception = None,
+        stored: StoredSplit = None,
+    ):
+        self.transaction = transaction
+        self.status = status
+        self.attempts = attempts
+        self.error = error
+        self.stored = stored
+
+    def __str__(self):
+        return f"{self.status.value} after {self.attempts} attempt(s): {self.transaction}"
 
 
 class FireflyConnector:
-    def __init__(self, configuration: Firefly_configuration):
+    def __init__(
+        self,
+        configuration: Firefly_configuration,
+        max_workers: int = 4,
+        page_size: int = None,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5,
+        limiter: AdaptiveLimiter = None,
+    ):
         self.configuration = configuration
+        # maximum number of concurrent requests sent to Firefly III
+        self.max_workers = max_workers
+        # adapts the number of requests actually in flight, up to max_workers, to the load of Firefly III
+        self.limiter = limiter or AdaptiveLimiter("firefly", max_limit=max_workers)
+        # number of transactions per page, None uses the page size configured in Firefly III
+        self.page_size = page_size
+        # transient failures are retried after retry_backoff, 2 * retry_backoff, 4 * retry_backoff... seconds,
+        # or once the delay asked by a Retry-After header has passed
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
         self.logger = logging.getLogger(__name__)
+        # keep a pooled connection per worker instead of reconnecting
+        self.configuration.connection_pool_maxsize = max(
+            self.configuration.connection_pool_maxsize or 0, max_workers
+        )
+        # a single client, and its HTTP connection pool, is shared by all the calls of the connector
+        self.api_client = firefly_client().ApiClient(self.configuration)
+        # optional CaptureWriter recording the accounts and pages received
+        self.capture = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.api_client.rest_client.pool_manager.clear()
 
     def get_firefly_accounts(self):
         # List all accounts
-        with firefly_iii_client.ApiClient(self.configuration) as api_client:
-            api_instance = firefly_iii_client.AccountsApi(api_client)
+        with self.api_client as api_client:
+            api_instance = firefly_client().AccountsApi(api_client)
             try:
-                api_response = api_instance.list_account()
+                metrics.increment("firefly_api_calls")
+                api_response = self._send(api_instance.list_account)
                 accounts = []
                 for a in api_response.data:
                     if (
                         a.attributes.type.value
-                        == firefly_iii_client.AccountTypeFilter.ASSET
+                        == firefly_client().AccountTypeFilter.ASSET
                         or a.attributes.type.value
-                        == firefly_iii_client.AccountTypeFilter.CASH
+                        == firefly_client().AccountTypeFilter.CASH
                     ):
                         accounts.append(a)
                 logging.info(
                     "Listing of Firefly-III accounts: %s"
                     % [a.attributes.name for a in accounts]
                 )
+                if self.capture is not None:
+                    self.capture.record_firefly_accounts(accounts)
                 return accounts
-            except ApiException as e:
+            except firefly_client().ApiException as e:
                 logging.error(
                     "Exception when calling AccountsApi->list_account: %s\n" % e
                 )
 
-    def get_firefly_transactions(self, accounts: List[AccountRead], period_days: int):
+    def get_firefly_transactions(
+        self,
+        accounts: List[AccountRead],
+        period_days: int,
+        date_starts: Dict[str, str] = None,
+        now: datetime = None,
+    ) -> Iterator[TransactionArray]:
         """
         Retrieve transactions from Firefly III for the specified accounts and period.
 
+        Every page of every account is fetched, using the pagination metadata of the first page.
+        Accounts and pages are fetched concurrently with at most `max_workers` requests in flight,
+        fewer when the limiter has lowered the concurrency; transient failures are retried,
+        and each page is yielded as soon as it is received, in no particular order.
+
         Args:
             accounts (List[AccountRead]): A list of account objects to retrieve transactions for.
             period_days (int): The number of days in the past to retrieve transactions for. If None, retrieves all transactions.
+            date_starts (Dict[str, str]): Optional start dates (YYYY-MM-DD) by account id, overriding the start of the period.
+            now (datetime): The time of the import, the period ends on its day. Defaults to the current time.
 
         Returns:
-            List[TransactionArray]: A list of transaction arrays for the specified accounts and period.
+            Iterator[TransactionArray]: The pages of transactions for the specified accounts and period.
 
         Raises:
             ApiException: If there is an error when retrieving transactions from the Firefly III API.
@@ -59,73 +176,308 @@ class FireflyConnector:
             Accounts of type 'CASH' are excluded from the retrieval to avoid duplicates.
         """
 
+        date_start = None
+        date_stop = None
         if period_days is not None:
-            date_start = (datetime.now() - timedelta(days=period_days)).strftime(
-                "%Y-%m-%d"
-            )
-            date_stop = datetime.now().strftime("%Y-%m-%d")
+            now = now or datetime.now()
+            date_start = (now - timedelta(days=period_days)).strftime("%Y-%m-%d")
+            date_stop = now.strftime("%Y-%m-%d")
             accounts = [
                 a
                 for a in accounts
-                if a.attributes.type.value != firefly_iii_client.AccountTypeFilter.CASH
+                if a.attributes.type.value != firefly_client().AccountTypeFilter.CASH
             ]
 
-        with firefly_iii_client.ApiClient(self.configuration) as api_client:
-            api_instance = firefly_iii_client.AccountsApi(api_client)
-            try:
-                all_transactions: List[TransactionArray] = []
-                for a in accounts:
-                    all_transactions.append(
-                        api_instance.list_transaction_by_account(
-                            id=a.id, start=date_start, end=date_stop
+        for _, transactions in self.list_transaction_pages(
+            accounts, date_start, date_stop, date_starts
+        ):
+            yield transactions
+
+    def list_transaction_pages(
+        self,
+        accounts: List[AccountRead],
+        date_start: str = None,
+        date_stop: str = None,
+        date_starts: Dict[str, str] = None,
+    ) -> Iterator[Tuple[str, TransactionArray]]:
+        """Fetch every page of transactions of the given accounts concurrently.
+
+        :param accounts: The accounts to fetch the transactions of
+        :param date_start: The first day (YYYY-MM-DD) to fetch, None for no lower bound
+        :param date_stop: The last day (YYYY-MM-DD) to fetch, None for no upper bound
+        :param date_starts: Start dates by account id overriding date_start
+        :return: Pairs of (account id, page of transactions), as soon as each page is received
+        """
+
+        date_starts = date_starts or {}
+        with self.api_client as api_client, ThreadPoolExecutor(
+            max_workers=max(1, self.max_workers)
+        ) as executor:
+            api_instance = firefly_client().AccountsApi(api_client)
+            # future -> (account id, page number)
+            pending = {}
+
+            def submit(account_id: str, page: int):
+                future = executor.submit(
+                    self._fetch_page,
+                    api_instance,
+                    id=account_id,
+                    limit=self.page_size,
+                    page=page,
+                    start=date_starts.get(account_id, date_start),
+                    end=date_stop,
+                )
+                pending[future] = (account_id, page)
+
+            for a in accounts:
+                submit(a.id, 1)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    account_id, page = pending.pop(future)
+                    try:
+                        transactions: TransactionArray = future.result()
+                    except firefly_client().ApiException as e:
+                        for f in pending:
+                            f.cancel()
+                        self.logger.error(
+                            "Exception when retrieving transactions of account %s (page %s): %s\n"
+                            % (account_id, page, e)
                         )
-                    )
-                return all_transactions
-            except ApiException as e:
-                raise ("Exception when retrieving transactions%s\n" % e)
+                        raise
+
+                    metrics.increment("firefly_pages")
+                    metrics.increment("firefly_transactions_fetched", len(transactions.data))
+                    if page == 1:
+                        for next_page in range(
+                            2, FireflyConnector._total_pages(transactions) + 1
+                        ):
+                            submit(account_id, next_page)
+                    if self.capture is not None:
+                        self.capture.record_firefly_page(account_id, transactions)
+                    yield account_id, transactions
+
+    def _fetch_page(
+        self, api_instance: firefly_iii_client.AccountsApi, **kwargs
+    ) -> TransactionArray:
+        """Fetch a page of transactions of an account, retrying the transient failures"""
+        import urllib3
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                metrics.increment("firefly_api_calls")
+                return self._send(api_instance.list_transaction_by_account, **kwargs)
+            except firefly_client().ApiException as e:
+                if e.status not in TRANSIENT_HTTP_STATUSES or attempt > self.max_retries:
+                    raise
+                error = e
+            except urllib3.exceptions.HTTPError as e:
+                if attempt > self.max_retries:
+                    raise
+                error = e
+            delay = self._retry_delay(attempt, error)
+            self.logger.warning(
+                "Transient error when fetching transactions, retrying in %.1fs: %s"
+                % (delay, error)
+            )
+            metrics.increment("firefly_retries")
+            time.sleep(delay)
+
+    def _send(self, function: Callable, *args, **kwargs) -> Any:
+        """Make one call to the API in a slot of the limiter, reporting throttling and server errors to it"""
+        import urllib3
+
+        with self.limiter.slot(function.__name__) as slot:
+            try:
+                return function(*args, **kwargs)
+            except firefly_client().ApiException as e:
+                if e.status in THROTTLING_HTTP_STATUSES:
+                    slot.throttled(parse_retry_after(e.headers))
+                elif e.status in TRANSIENT_HTTP_STATUSES:
+                    slot.failed(parse_retry_after(e.headers))
+                raise
+            except urllib3.exceptions.HTTPError:
+                slot.failed()
+                raise
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        # the limiter already holds the requests for the delay asked by Firefly III
+        if parse_retry_after(getattr(error, "headers", None)) is not None:
+            return 0
+        return self.retry_backoff * 2 ** (attempt - 1)
+
+    @staticmethod
+    def _total_pages(transactions: TransactionArray) -> int:
+        pagination = transactions.meta.pagination if transactions.meta else None
+        if pagination is None or pagination.total_pages is None:
+            return 1
+        return pagination.total_pages
 
     def create_firefly_transactions(
         self, transaction: List[firefly_iii_client.TransactionSplitStore]
-    ):
-        for t in transaction:
-            self.create_firefly_transaction(t)
+    ) -> List[StoreResult]:
+        """Store the transactions in Firefly III.
+        A single pooled client is shared by up to `max_workers` concurrent calls, as many as the
+        limiter allows, and transient failures are retried with an exponential backoff.
+
+        :param transaction: The transactions to store
+        :return: The outcome of each transaction, in the order of the given transactions
+        """
+
+        if not transaction:
+            return []
+
+        with self.api_client as api_client, ThreadPoolExecutor(
+            max_workers=max(1, min(self.max_workers, len(transaction)))
+        ) as executor:
+            api_instance = firefly_client().TransactionsApi(api_client)
+            results = list(
+                executor.map(
+                    lambda t: self._store_transaction(api_instance, t), transaction
+                )
+            )
+
+        self.logger.info(
+            "Transactions creation: %s stored, %s rejected as duplicates, %s failed"
+            % tuple(
+                sum(1 for r in results if r.status == status)
+                for status in (
+                    StoreStatus.STORED,
+                    StoreStatus.DUPLICATE,
+                    StoreStatus.FAILED,
+                )
+            )
+        )
+        return results
 
     def create_firefly_transaction(
         self, transaction: firefly_iii_client.TransactionSplitStore
-    ):
-        with firefly_iii_client.ApiClient(self.configuration) as api_client:
-            api_instance = firefly_iii_client.TransactionsApi(api_client)
-            transaction_store = firefly_iii_client.TransactionStore(
-                transactions=[transaction]
-            )
+    ) -> StoreResult:
+        with self.api_client as api_client:
+            api_instance = firefly_client().TransactionsApi(api_client)
+            return self._store_transaction(api_instance, transaction)
+
+    def _store_transaction(
+        self,
+        api_instance: firefly_iii_client.TransactionsApi,
+        transaction: firefly_iii_client.TransactionSplitStore,
+    ) -> StoreResult:
+        """Store one transaction, retrying the transient failures.
+
+        Storing is a POST, which is not idempotent: a request that failed with a server error or
+        a lost connection may have been stored all the same. Retrying it is only safe because
+        the split carries its fingerprint in external_id and is sent with error_if_duplicate_hash.
+        A retry of a transaction already stored is then rejected as a duplicate instead of being
+        stored twice. The fingerprint is part of the hash computed by Firefly III, and identical
+        operations of the same day get different fingerprints, so the flag does not reject them.
+        A split without a fingerprint would get the same hash as its identical twins and lose
+        all of them but the first one. It is therefore sent without the flag, and only retried
+        when Firefly III throttled it, since a throttled request is not processed.
+
+        :param api_instance: The transactions API of the shared client
+        :param transaction: The split to store
+        :return: The outcome of the call
+        """
+        import urllib3
+
+        fingerprinted = is_fingerprint(transaction.external_id)
+        transaction_store = firefly_client().TransactionStore(
+            transactions=[transaction], error_if_duplicate_hash=fingerprinted
+        )
+        attempt = 0
+        while True:
+            attempt += 1
             try:
                 # Store a new transaction
-                api_instance.store_transaction(transaction_store)
+                metrics.increment("firefly_api_calls")
+                response = self._send(api_instance.store_transaction, transaction_store)
                 self.logger.info("Stored new transaction: %s" % transaction)
-            except Exception as e:
+                metrics.increment("transactions_stored")
+                # only the identifiers are kept, the whole response weighs several kB
+                split = response.data.attributes.transactions[0]
+                stored = StoredSplit(
+                    response.data.id,
+                    split.transaction_journal_id,
+                    split.source_id,
+                    split.destination_id,
+                )
+                return StoreResult(transaction, StoreStatus.STORED, attempt, stored=stored)
+            except firefly_client().ApiException as e:
+                if FireflyConnector._is_duplicate_error(e):
+                    self.logger.info(
+                        "Transaction rejected as duplicate by Firefly III: %s"
+                        % transaction
+                    )
+                    metrics.increment("transactions_duplicate_rejected")
+                    return StoreResult(transaction, StoreStatus.DUPLICATE, attempt, e)
+                transient = e.status in (
+                    TRANSIENT_HTTP_STATUSES if fingerprinted else THROTTLING_HTTP_STATUSES
+                )
+                error = e
+            except urllib3.exceptions.HTTPError as e:
+                # connection errors, timeouts...
+                transient = fingerprinted
+                error = e
+
+            if not transient or attempt > self.max_retries:
                 self.logger.error(
                     "Exception when calling TransactionsApi->store_transaction: %s\n"
-                    % e
+                    % error
                 )
+                metrics.increment("transactions_failed")
+                return StoreResult(transaction, StoreStatus.FAILED, attempt, error)
+
+            delay = self._retry_delay(attempt, error)
+            self.logger.warning(
+                "Transient error when storing transaction, retrying in %.1fs: %s"
+                % (delay, error)
+            )
+            metrics.increment("firefly_retries")
+            time.sleep(delay)
+
+    @staticmethod
+    def _is_duplicate_error(error: firefly_iii_client.ApiException) -> bool:
+        # Firefly III answers 422 with a "Duplicate of transaction #..." message
+        return error.status == 422 and "duplicate" in str(error.body).lower()
 
     def convert_to_custom_transactions(
         self,
-        firefly_transactions: list[TransactionArray],
-        firefly_accounts: List[AccountRead],
+        firefly_transactions: Iterable[TransactionArray],
+        firefly_accounts: List[AccountRead] | AccountIndex,
     ):
-        all_operations: List[TransactionCustom] = []
+        return [
+            custom_operation
+            for _, _, custom_operation in self.iter_custom_transactions(
+                firefly_transactions, firefly_accounts
+            )
+        ]
+
+    def iter_custom_transactions(
+        self,
+        firefly_transactions: Iterable[TransactionArray],
+        firefly_accounts: List[AccountRead] | AccountIndex,
+    ) -> Iterator[
+        Tuple[
+            firefly_iii_client.TransactionRead,
+            firefly_iii_client.TransactionSplit,
+            TransactionCustom,
+        ]
+    ]:
+        """Convert Firefly III transactions, yielding each group and split with its converted transaction."""
+        account_index = FireflyConnector._as_index(firefly_accounts)
 
         for f in firefly_transactions:
             for data in f.data:
                 for t in data.attributes.transactions:
-                    source_account = FireflyConnector.find_account(
-                        firefly_accounts, account_name=t.source_name
-                    )
+                    source_account = account_index.find(account_name=t.source_name)
                     if not source_account:
                         raise Exception(f"Source account not found for transaction {t}")
 
-                    destination_account = FireflyConnector.find_account(
-                        firefly_accounts, account_name=t.destination_name
+                    destination_account = account_index.find(
+                        account_name=t.destination_name
                     )
                     if not destination_account:
                         continue
@@ -135,25 +487,29 @@ class FireflyConnector:
                         found_account_number=source_account.attributes.account_number,
                         origin_account_number=source_account.attributes.account_number,
                         destination_account_number=destination_account.attributes.account_number,
-                        transaction_type=t.type,
+                        transaction_type=TransactionType(t.type.value) if t.type else None,
                         date=t.var_date,
                         amount=float(t.amount),
                         libelle=t.description,
                     )
-                    all_operations.append(custom_operation)
-        return all_operations
+                    if is_fingerprint(t.external_id):
+                        custom_operation.fingerprint = t.external_id
+                    yield data, t, custom_operation
 
     def convert_to_firefly_transactions(
-        self, transactions: List[TransactionCustom], firefly_accounts: List[AccountRead]
+        self,
+        transactions: List[TransactionCustom],
+        firefly_accounts: List[AccountRead] | AccountIndex,
     ) -> List[firefly_iii_client.TransactionSplitStore]:
+        account_index = FireflyConnector._as_index(firefly_accounts)
+        # the fingerprints are normally set by the deduplication, before any transaction is removed
+        assign_fingerprints([t for t in transactions if t.fingerprint is None])
         firefly_transactions: List[firefly_iii_client.TransactionSplitStore] = []
         for t in transactions:
-            source_account = FireflyConnector.find_account(
-                firefly_accounts, account_number=t.origin_account_number
-            )
+            source_account = account_index.find(account_number=t.origin_account_number)
 
-            destination_account = FireflyConnector.find_account(
-                firefly_accounts, account_number=t.destination_account_number
+            destination_account = account_index.find(
+                account_number=t.destination_account_number
             )
 
             # Ensure source and destination accounts are different
@@ -167,41 +523,36 @@ class FireflyConnector:
                 else:
                     source_account = None
 
-            firefly_transaction = firefly_iii_client.TransactionSplitStore(
-                type=t.type,
+            firefly_transaction = firefly_client().TransactionSplitStore(
+                type=firefly_client().TransactionTypeProperty(t.type.value) if t.type else None,
                 var_date=t.date,
                 amount=str(abs(t.amount)),
                 description=t.libelle,
                 source_id=source_account.id if source_account else None,
                 destination_id=destination_account.id if destination_account else None,
+                # lets the next imports recognise the transaction, even once edited in Firefly III
+                external_id=t.fingerprint,
             )
             firefly_transactions.append(firefly_transaction)
         return firefly_transactions
 
     @staticmethod
     def find_account(
-        firefly_accounts: List[AccountRead],
+        firefly_accounts: List[AccountRead] | AccountIndex,
         account_name: str = None,
         account_number: str = None,
         account_type: str = None,
         iban: str = None,
     ) -> AccountRead | None:
-        # At least one of the parameters must be provided
-        if account_name is None and account_number is None and iban is None:
-            return None
+        return FireflyConnector._as_index(firefly_accounts).find(
+            account_name=account_name,
+            account_number=account_number,
+            account_type=account_type,
+            iban=iban,
+        )
 
-        for a in firefly_accounts:
-            if (
-                (account_name is None or a.attributes.name == account_name)
-                and (
-                    account_number is None
-                    or a.attributes.account_number == account_number
-                )
-                and (
-                    account_type is None
-                    or a.attributes.type.value == account_type.value
-                )
-                and (iban is None or a.attributes.iban == iban)
-            ):
-                return a
-        return None
+    @staticmethod
+    def _as_index(firefly_accounts: List[AccountRead] | AccountIndex) -> AccountIndex:
+        if isinstance(firefly_accounts, AccountIndex):
+            return firefly_accounts
+        return AccountIndex(firefly_accounts)
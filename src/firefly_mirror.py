@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, Iterable, List
+
+from firefly_connector import FireflyConnector, StoredSplit, StoreResult, StoreStatus, firefly_client
+from Util.Accounts.account_index import AccountIndex
+from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.fingerprint import is_fingerprint
+from Util.Transactions.transaction_type import TransactionType
+
+if TYPE_CHECKING:
+    import firefly_iii_client
+    from firefly_iii_client import AccountRead
+
+SCHEMA_VERSION = 2
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class FireflyMirror:
+    """Local SQLite copy of the Firefly III transactions, converted to TransactionCustom.
+
+    Each asset account has a sync watermark: the day up to which its transactions were fetched.
+    A sync only fetches the transactions since the watermark minus a safety overlap,
+    and replaces the mirrored transactions of that window.
+
+    :param path: The path of the SQLite database
+    :param overlap_days: The number of days before the watermark fetched again on each sync
+    """
+
+    def __init__(self, path: str, overlap_days: int = 7):
+        self.path = path
+        self.overlap_days = overlap_days
+        self.logger = logging.getLogger(__name__)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self._create_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _create_schema(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        with self.connection:
+            if version == 1:
+                # version 2 adds the fingerprints, fetch everything again to fill them
+                self.logger.info("Migrating the Firefly III mirror to version %s" % SCHEMA_VERSION)
+                self.connection.execute("ALTER TABLE transactions ADD COLUMN fingerprint TEXT")
+                self.connection.execute("DELETE FROM sync_state")
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS transactions (
+                    journal_id TEXT PRIMARY KEY,
+                    group_id TEXT,
+                    source_id TEXT,
+                    destination_id TEXT,
+                    found_account_number TEXT,
+                    origin_account_number TEXT,
+                    destination_account_number TEXT,
+                    type TEXT,
+                    date TEXT NOT NULL,
+                    amount_cents INTEGER NOT NULL,
+                    libelle TEXT,
+                    fingerprint TEXT
+                );
+                CREATE INDEX IF NOT EXISTS transactions_identity
+                    ON transactions (date, amount_cents, libelle);
+                CREATE INDEX IF NOT EXISTS transactions_fingerprint
+                    ON transactions (fingerprint);
+                CREATE INDEX IF NOT EXISTS transactions_source
+                    ON transactions (source_id, date);
+                CREATE INDEX IF NOT EXISTS transactions_destination
+                    ON transactions (destination_id, date);
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    account_id TEXT PRIMARY KEY,
+                    synced_until TEXT NOT NULL
+                );
+                """
+            )
+            self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def sync(
+        self,
+        connector: FireflyConnector,
+        accounts: List[AccountRead] | AccountIndex,
+        period_days: int,
+        full: bool = False,
+        now: datetime = None,
+    ) -> int:
+        """Fetch the transactions changed since the last sync and merge them into the mirror.
+
+        :param connector: The connector used to download the transactions
+        :param accounts: The Firefly III accounts
+        :param period_days: The number of days fetched for an account that was never synced, or on a full sync
+        :param full: Whether to ignore the watermarks and fetch the whole period again
+        :param now: The time of the sync, the fetched window ends on its day, defaults to the current time
+        :return: The number of transactions fetched
+        """
+        account_index = (
+            accounts if isinstance(accounts, AccountIndex) else AccountIndex(accounts)
+        )
+        # cash accounts are reached through the transactions of the asset accounts
+        synced_accounts = [
+            a
+            for a in account_index
+            if a.attributes.type.value != firefly_client().AccountTypeFilter.CASH
+        ]
+        today = now or datetime.now()
+        date_stop = today.strftime("%Y-%m-%d")
+        period_start = (today - timedelta(days=period_days)).strftime("%Y-%m-%d")
+        watermarks = self.watermarks()
+
+        date_starts: Dict[str, str] = {}
+        for a in synced_accounts:
+            if full or a.id not in watermarks:
+                date_starts[a.id] = period_start
+            else:
+                date_starts[a.id] = (
+                    datetime.strptime(watermarks[a.id], "%Y-%m-%d")
+                    - timedelta(days=self.overlap_days)
+                ).strftime("%Y-%m-%d")
+
+        fetched_journal_ids: Dict[str, set] = {a.id: set() for a in synced_accounts}
+        fetched = 0
+        with self.connection:
+            for account_id, page in connector.list_transaction_pages(
+                synced_accounts, date_stop=date_stop, date_starts=date_starts
+            ):
+                rows = [
+                    self._to_row(group.id, split, custom_operation)
+                    for group, split, custom_operation in connector.iter_custom_transactions(
+                        [page], account_index
+                    )
+                ]
+                fetched_journal_ids[account_id].update(row[0] for row in rows)
+                fetched += len(rows)
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+            # transactions deleted or moved in Firefly III disappear from the fetched window
+            for account_id, journal_ids in fetched_journal_ids.items():
+                self.connection.execute("DROP TABLE IF EXISTS temp.fetched")
+                self.connection.execute("CREATE TEMP TABLE fetched (journal_id TEXT PRIMARY KEY)")
+                self.connection.executemany(
+                    "INSERT INTO temp.fetched VALUES (?)", ((j,) for j in journal_ids)
+                )
+                self.connection.execute(
+                    """
+                    DELETE FROM transactions
+                    WHERE (source_id = ? OR destination_id = ?)
+                        AND date >= ? AND date < ?
+                        AND journal_id NOT IN (SELECT journal_id FROM temp.fetched)
+                    """,
+                    (
+                        account_id,
+                        account_id,
+                        date_starts[account_id],
+                        (today + timedelta(days=1)).strftime("%Y-%m-%d"),
+                    ),
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                    (account_id, date_stop),
+                )
+            self.connection.execute("DROP TABLE IF EXISTS temp.fetched")
+
+        self.logger.info(
+            "Firefly III mirror synced%s: %s transactions fetched since %s"
+            % (" (full)" if full else "", fetched, min(date_starts.values(), default=None))
+        )
+        return fetched
+
+    def record_stored(
+        self,
+        accounts: List[AccountRead] | AccountIndex,
+        store_results: Iterable[StoreResult],
+    ) -> int:
+        """Insert the transactions just stored in Firefly III, with the identifiers it gave them.
+
+        The next sync only fetches again from the watermark minus the overlap, so a stored
+        transaction dated before that window would otherwise never reach the mirror,
+        and be imported again by the next run.
+
+        :param accounts: The Firefly III accounts
+        :param store_results: The outcome of the creation of the transactions
+        :return: The number of transactions inserted
+        """
+        accounts_by_id = {a.id: a for a in accounts}
+        rows = []
+        for r in store_results:
+            if r.status != StoreStatus.STORED or r.stored is None:
+                continue
+            source = accounts_by_id.get(r.stored.source_id)
+            destination = accounts_by_id.get(r.stored.destination_id)
+            # as for the synced transactions, only the splits between known accounts are mirrored
+            if source is None or destination is None:
+                continue
+            transaction = TransactionCustom(
+                found_account_number=source.attributes.account_number,
+                origin_account_number=source.attributes.account_number,
+                destination_account_number=destination.attributes.account_number,
+                transaction_type=TransactionType(_type_value(r.transaction.type))
+                if r.transaction.type
+                else None,
+                date=r.transaction.var_date,
+                amount=float(r.transaction.amount),
+                libelle=r.transaction.description,
+            )
+            if is_fingerprint(r.transaction.external_id):
+                transaction.fingerprint = r.transaction.external_id
+            rows.append(self._to_row(r.stored.group_id, r.stored, transaction))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self.logger.info("Firefly III mirror: %s stored transactions inserted" % len(rows))
+        return len(rows)
+
+    def check_consistency(
+        self,
+        connector: FireflyConnector,
+        accounts: List[AccountRead] | AccountIndex,
+        period_days: int,
+        now: datetime = None,
+    ) -> int:
+        """Compare the mirror with a full download of the period and fix any drift.
+
+        :return: The number of mirrored transactions that were missing, stale or deleted
+        """
+        now = now or datetime.now()
+        period_start = (now - timedelta(days=period_days)).strftime("%Y-%m-%d")
+        before = self._snapshot(period_start)
+        self.sync(connector, accounts, period_days, full=True, now=now)
+        after = self._snapshot(period_start)
+
+        drift = len(set(before.items()) ^ set(after.items()))
+        if drift:
+            self.logger.warning(
+                "Firefly III mirror had drifted: %s transactions fixed" % drift
+            )
+        return drift
+
+    def _snapshot(self, date_start: str) -> Dict[str, tuple]:
+        return {
+            row[0]: row[1:]
+            for row in self.connection.execute(
+                "SELECT * FROM transactions WHERE date >= ?", (date_start,)
+            )
+        }
+
+    def watermarks(self) -> Dict[str, str]:
+        return dict(self.connection.execute("SELECT account_id, synced_until FROM sync_state"))
+
+    def has_fingerprint(self, fingerprint: str) -> bool:
+        """Whether a mirrored transaction has the given fingerprint, whatever its date."""
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM transactions WHERE fingerprint = ? LIMIT 1", (fingerprint,)
+            ).fetchone()
+            is not None
+        )
+
+    def count_matching(self, transaction: TransactionCustom) -> int:
+        """Count the mirrored transactions without fingerprint with the same identity as the given transaction."""
+        return self.connection.execute(
+            """
+            SELECT COUNT(*) FROM transactions
+            WHERE date = ? AND amount_cents = ? AND libelle IS ?
+                AND origin_account_number IS ? AND destination_account_number IS ?
+                AND type IS ? AND fingerprint IS NULL
+            """,
+            (
+                transaction.date.strftime(DATE_FORMAT),
+                transaction.amount_cents,
+                transaction.libelle,
+                transaction.origin_account_number,
+                transaction.destination_account_number,
+                _type_value(transaction.type),
+            ),
+        ).fetchone()[0]
+
+    @staticmethod
+    def _to_row(
+        group_id: str,
+        split: firefly_iii_client.TransactionSplit | StoredSplit,
+        transaction: TransactionCustom,
+    ) -> tuple:
+        return (
+            str(split.transaction_journal_id),
+            group_id,
+            split.source_id,
+            split.destination_id,
+            transaction.found_account_number,
+            transaction.origin_account_number,
+            transaction.destination_account_number,
+            _type_value(transaction.type),
+            transaction.date.strftime(DATE_FORMAT),
+            transaction.amount_cents,
+            transaction.libelle,
+            transaction.fingerprint,
+        )
+
+
+def _type_value(transaction_type) -> str | None:
+    return getattr(transaction_type, "value", transaction_type)
+
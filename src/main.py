@@ -1,138 +1,329 @@
+from __future__ import annotations
+
+import argparse
 import logging
 import os
-from firefly_iii_client.configuration import Configuration as Firefly_configuration
-
+from contextlib import nullcontext
+from datetime import datetime
+from typing import TYPE_CHECKING
 
+from Util.Accounts.account_index import AccountIndex
 from Util.Transactions.Transaction_custom import TransactionCustom
+from Util.Transactions.duplicates import DuplicateFilter
+from Util.Transactions.similarity import (
+    DEFAULT_SIMILARITY_ENGINE,
+    SimilarityEngine,
+    normalize_bank_libelle,
+)
+from Util.Transactions.transfer_detection import TransferDetector
 import banks_clients
 from banks_clients.configuration import Configuration as Bank_configuration
-from firefly_connector import FireflyConnector
-from firefly_iii_client.models.transaction_type_property import TransactionTypeProperty
+from firefly_connector import FireflyConnector, StoreStatus
+from firefly_mirror import FireflyMirror
+from metrics import metrics
+from streaming_import import StreamingImport
+
+if TYPE_CHECKING:
+    from firefly_iii_client import AccountRead
 
 logger = logging.getLogger(__name__)
 
 
-def check_transfers(transactions: list[TransactionCustom]):
+def check_transfers(
+    transactions: list[TransactionCustom], similarity_engine: SimilarityEngine = None
+):
     """Detect transfer operations from a list of operations.
     Add the destination account to detected transfers
     """
-    for t in transactions:
-        t_other_account = [
-            a for a in transactions if a.found_account_number != t.found_account_number
-        ]
-        similar_transactions = t.find_transactions_in_list(
-            t_other_account, 0.9, True
-        )
-
-        if len(similar_transactions) > 0:
-            similar_transaction = similar_transactions[0]
-
-            if len(similar_transactions) > 1:
-                # either there is a false positive, or the same transaction was done twice
-                logger.info(
-                    "Found multiple potential transactions for transfer. \n Original: %s \n Similar Transactions: [%s]",
-                    t,
-                    ", ".join(map(str, similar_transactions)),
-                )
-
-                # check if the same transaction was done twice
-                t_same_account = [
-                    a for a in transactions if a.found_account_number == t.found_account_number
-                ]
-                if len(
-                    t.find_transactions_in_list(t_same_account, 0.9, True)
-                ) == len(similar_transactions):
-                    pass
-                else:
-                    raise Exception(
-                        "Found multiple potential transactions for transfer. See logs for more details"
-                    )
-
-            if (t.origin_account_number and similar_transaction.origin_account_number) or (t.destination_account_number and similar_transaction.destination_account_number):
-                raise Exception(
-                    "Error in transfer detection: %s and %s",
-                    t,
-                    similar_transaction
-                )
-            
-            origin_account = (
-                t.origin_account_number if t.origin_account_number else similar_transaction.origin_account_number
-            )
-            destination_account_number = (
-                t.destination_account_number if t.destination_account_number else similar_transaction.destination_account_number
-            )
-            logger.info(
-                "Found transfer: %s. %s -> %s",
-                t,
-                origin_account,
-                destination_account_number,
-            )
-
-            t.origin_account_number = origin_account
-            t.destination_account_number = destination_account_number
-            t.amount = abs(t.amount)
-            t.type = TransactionTypeProperty.TRANSFER
-            # remove duplicate from transactions list
-            temp_transactions = transactions.copy()
-            temp_transactions.remove(similar_transaction)
-            transactions[:] = temp_transactions
+    similarity_engine = similarity_engine or DEFAULT_SIMILARITY_ENGINE
+    comparisons = similarity_engine.comparisons
+    ratios_computed = similarity_engine.cache_info().misses
+    TransferDetector(transactions, similarity_engine=similarity_engine).detect()
+    metrics.increment("fuzzy_comparisons", similarity_engine.comparisons - comparisons)
+    metrics.increment(
+        "fuzzy_ratios_computed", similarity_engine.cache_info().misses - ratios_computed
+    )
 
 
 def check_duplicates(
-    transactions_1: list[TransactionCustom], transactions_2: list[TransactionCustom]
+    transactions_1: list[TransactionCustom] | FireflyMirror,
+    transactions_2: list[TransactionCustom],
 ):
-    """Check for duplicates between two lists of transactions and remove them from the second list"""
-    for t in transactions_1:
-        similar_transactions = t.find_exact_transactions_in_list(transactions_2)
-        if len(similar_transactions) > 0:
-            logger.info(
-                "Found duplicate: %s. Removing it from the list of transactions to add.",
-                t,
-            )
-            transactions_2.remove(similar_transactions[0])
+    """Check for duplicates between two lists of transactions and remove them from the second list.
+    Each transaction of the first list removes at most one identical transaction from the second list.
+    The first list can be a Firefly III mirror, which is then queried for each distinct transaction.
+    """
+    DuplicateFilter(transactions_1).filter(transactions_2)
     return
 
 
-def main():
-    logging.basicConfig(
-        filename="logging.log",
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s: %(message)s",
-    )
+def build_firefly_connector() -> FireflyConnector:
+    from firefly_iii_client.configuration import Configuration as Firefly_configuration
 
-    logger.critical(
-        "\n\n*****************************\nStarting new import process\n*****************************\n"
-    )
     firefly_configuration = Firefly_configuration(
         host=os.environ["FIREFLY_III_URL"],
         access_token=os.environ["FIREFLY_PERSONAL_ACCESS_TOKEN"],
     )
-    firefly_connector = FireflyConnector(firefly_configuration)
-    firefly_accounts = firefly_connector.get_firefly_accounts()
-    firefly_transactions = firefly_connector.get_firefly_transactions(
-        firefly_accounts, int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"])
-    )
-    firefly_transactions_custom = firefly_connector.convert_to_custom_transactions(
-        firefly_transactions, firefly_accounts
+    return FireflyConnector(
+        firefly_configuration,
+        max_workers=int(os.environ.get("FIREFLY_MAX_WORKERS", 4)),
     )
 
+
+def build_bank_client() -> banks_clients.BankClient:
+    if os.environ.get("BANK_CONNECTIONS_PATH"):
+        # several bank connections fetched concurrently
+        with metrics.span("bank_login"):
+            return banks_clients.MultiBankClient.from_connections_file(
+                os.environ["BANK_CONNECTIONS_PATH"]
+            )
     credit_agricole_configuration = Bank_configuration(
         department=os.environ["CREDIT_AGRICOLE_DEPARTMENT"],
         username=os.environ["CREDIT_AGRICOLE_USERNAME"],
         password=os.environ["CREDIT_AGRICOLE_PASSWORD"],
+        max_workers=int(os.environ.get("CREDIT_AGRICOLE_MAX_WORKERS", 1)),
+        account_timeout=float(os.environ["CREDIT_AGRICOLE_ACCOUNT_TIMEOUT"])
+        if os.environ.get("CREDIT_AGRICOLE_ACCOUNT_TIMEOUT")
+        else None,
+        session_ttl=float(os.environ["CREDIT_AGRICOLE_SESSION_TTL"])
+        if os.environ.get("CREDIT_AGRICOLE_SESSION_TTL")
+        else None,
+    )
+    with metrics.span("bank_login"):
+        return banks_clients.CreditAgricole(credit_agricole_configuration)
+
+
+def export_metrics():
+    if os.environ.get("METRICS_JSON_PATH"):
+        metrics.export_json(os.environ["METRICS_JSON_PATH"])
+    if os.environ.get("METRICS_PROMETHEUS_PATH"):
+        metrics.export_prometheus(os.environ["METRICS_PROMETHEUS_PATH"])
+    logger.info("Import metrics: %s", metrics.to_dict())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import the bank operations into Firefly III"
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and import on a schedule (see IMPORT_INTERVAL_SECONDS)",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="Record the bank and Firefly III data received during the import to this file",
+    )
+    parser.add_argument(
+        "--redact",
+        action="store_true",
+        help="Replace the account numbers, IBANs and names by pseudonyms in the capture",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Run the import on a capture instead of the bank and Firefly III, without network",
     )
-    with banks_clients.CreditAgricole(credit_agricole_configuration) as ca_client:
-        accounts = ca_client.list_account(firefly_accounts)
-        all_bank_transactions = ca_client.list_transactions(accounts, int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]))
+    args = parser.parse_args()
 
-    check_transfers(all_bank_transactions)
-    check_duplicates(firefly_transactions_custom, all_bank_transactions)
+    logging.basicConfig(
+        filename="logging.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s: %(message)s",
+    )
+
+    if args.daemon:
+        from daemon import ImportDaemon
 
-    # convert transactions back to firefly transactions
-    all_bank_transactions = firefly_connector.convert_to_firefly_transactions(
-        all_bank_transactions, firefly_accounts
+        ImportDaemon.from_environment().run()
+        return
+
+    logger.critical(
+        "\n\n*****************************\nStarting new import process\n*****************************\n"
     )
-    firefly_connector.create_firefly_transactions(all_bank_transactions)
+    metrics.reset()
+    metrics.profile_stage = os.environ.get("PROFILE_STAGE")
+    try:
+        if args.replay:
+            from capture import Capture, ReplayBankClient, ReplayFireflyConnector
+
+            capture = Capture(args.replay)
+            with ReplayFireflyConnector(
+                capture, max_workers=int(os.environ.get("FIREFLY_MAX_WORKERS", 4))
+            ) as firefly_connector:
+                # the windows are computed as on the day of the capture, for the same requests
+                run_import(
+                    firefly_connector, bank_client=ReplayBankClient(capture), now=capture.now
+                )
+        else:
+            with build_firefly_connector() as firefly_connector:
+                if args.capture:
+                    from capture import CaptureWriter
+
+                    with CaptureWriter(args.capture, redact=args.redact) as capture:
+                        run_import(firefly_connector, capture=capture, now=capture.now)
+                else:
+                    run_import(firefly_connector)
+    finally:
+        export_metrics()
+
+
+def run_import(
+    firefly_connector: FireflyConnector,
+    bank_client: banks_clients.BankClient = None,
+    firefly_accounts: list[AccountRead] = None,
+    capture=None,
+    now: datetime = None,
+):
+    """Run one import: fetch the bank operations and store the new ones in Firefly III.
+
+    :param firefly_connector: The Firefly III connector
+    :param bank_client: A logged in bank client kept across imports, None to log in for this import only
+    :param firefly_accounts: The Firefly III accounts, None to fetch them
+    :param capture: Optional CaptureWriter recording the data received from the bank and Firefly III
+    :param now: The time of the import, the windows fetched end on its day, defaults to the current
+        time; a replay passes the time of the capture
+    :return: The outcome of the creation of each new transaction
+    """
+    now = now or datetime.now()
+    firefly_connector.capture = capture
+    if firefly_accounts is None:
+        with metrics.span("firefly_accounts"):
+            firefly_accounts = firefly_connector.get_firefly_accounts()
+    elif capture is not None:
+        capture.record_firefly_accounts(firefly_accounts)
+    firefly_account_index = AccountIndex(firefly_accounts)
+    firefly_mirror = None
+    with metrics.span("firefly_transactions"):
+        if os.environ.get("FIREFLY_MIRROR_PATH"):
+            # deduplicate against a local copy of Firefly III, only fetching what changed since the last run
+            firefly_mirror = FireflyMirror(
+                os.environ["FIREFLY_MIRROR_PATH"],
+                overlap_days=int(os.environ.get("FIREFLY_MIRROR_OVERLAP_DAYS", 7)),
+            )
+            if os.environ.get("FIREFLY_MIRROR_CHECK_CONSISTENCY") == "1":
+                firefly_mirror.check_consistency(
+                    firefly_connector,
+                    firefly_account_index,
+                    int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]),
+                    now=now,
+                )
+            else:
+                firefly_mirror.sync(
+                    firefly_connector,
+                    firefly_account_index,
+                    int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]),
+                    full=os.environ.get("FIREFLY_MIRROR_FULL_RESYNC") == "1",
+                    now=now,
+                )
+            firefly_transactions_custom = firefly_mirror
+        else:
+            firefly_transactions = firefly_connector.get_firefly_transactions(
+                firefly_accounts, int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]), now=now
+            )
+            firefly_transactions_custom = firefly_connector.convert_to_custom_transactions(
+                firefly_transactions, firefly_account_index
+            )
+
+    bank_watermarks = None
+    if os.environ.get("BANK_WATERMARKS_PATH"):
+        bank_watermarks = banks_clients.BankWatermarks(
+            os.environ["BANK_WATERMARKS_PATH"],
+            overlap_days=int(os.environ.get("BANK_OVERLAP_DAYS", 7)),
+        )
+    similarity_engine = None
+    if os.environ.get("TRANSFER_NORMALIZE_LIBELLES") == "1":
+        # compare libelles without case, whitespace and bank prefixes
+        similarity_engine = SimilarityEngine(normalizer=normalize_bank_libelle)
+
+    with build_bank_client() if bank_client is None else nullcontext(
+        bank_client
+    ) as client:
+        client.capture = capture
+        with metrics.span("bank_accounts"):
+            accounts = client.list_account(firefly_account_index)
+        date_starts = None
+        if bank_watermarks and os.environ.get("BANK_FULL_WINDOW") != "1":
+            # only fetch the operations since the last import, the overlap goes through check_duplicates
+            date_starts = bank_watermarks.date_starts(
+                [client.account_number(a) for a in accounts],
+                int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]),
+                now=now,
+            )
+        import_date = now.strftime("%Y-%m-%d")
+
+        if os.environ.get("STREAMING_IMPORT") == "1":
+            # store the operations of each day as soon as every account has been fetched past it
+            duplicate_filter = DuplicateFilter(firefly_transactions_custom)
+
+            def reconcile(transactions: list[TransactionCustom]):
+                check_transfers(transactions, similarity_engine)
+                duplicate_filter.filter(transactions)
+                return firefly_connector.convert_to_firefly_transactions(
+                    transactions, firefly_account_index
+                )
+
+            streaming_import = StreamingImport(
+                client,
+                firefly_connector,
+                reconcile,
+                chunk_days=int(os.environ.get("STREAMING_CHUNK_DAYS", 7)),
+                fetch_workers=int(os.environ.get("STREAMING_FETCH_WORKERS", 4)),
+            )
+            with metrics.span("streaming_import"):
+                store_results = streaming_import.run(
+                    accounts,
+                    int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]),
+                    date_starts=date_starts,
+                    now=now,
+                )
+            failed_accounts = streaming_import.failed_accounts
+        else:
+            with metrics.span("bank_transactions"):
+                all_bank_transactions = client.list_transactions(
+                    accounts,
+                    int(os.environ["GET_TRANSACTIONS_PERIOD_DAYS"]),
+                    date_starts=date_starts,
+                    now=now,
+                )
+            failed_accounts = client.failed_accounts
+            store_results = None
+        imported_accounts = [
+            client.account_number(a)
+            for a in accounts
+            if client.account_number(a) not in failed_accounts
+        ]
+
+    if store_results is None:
+        with metrics.span("check_transfers"):
+            check_transfers(all_bank_transactions, similarity_engine)
+        with metrics.span("check_duplicates"):
+            check_duplicates(firefly_transactions_custom, all_bank_transactions)
+
+        # convert transactions back to firefly transactions
+        with metrics.span("convert_to_firefly"):
+            all_bank_transactions = firefly_connector.convert_to_firefly_transactions(
+                all_bank_transactions, firefly_account_index
+            )
+        with metrics.span("store"):
+            store_results = firefly_connector.create_firefly_transactions(
+                all_bank_transactions
+            )
+
+    if bank_watermarks:
+        if any(r.status == StoreStatus.FAILED for r in store_results):
+            logger.warning("Some transactions could not be stored, import watermarks are not moved")
+        else:
+            bank_watermarks.update(imported_accounts, import_date)
+        bank_watermarks.close()
+
+    if firefly_mirror:
+        # the stored transactions can be older than the window fetched again by the next sync
+        with metrics.span("firefly_mirror_update"):
+            firefly_mirror.record_stored(firefly_account_index, store_results)
+        firefly_mirror.close()
+    return store_results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = "firefly_importer"
+
+
+class Metrics:
+    """Lightweight instrumentation of an import run: stage spans, counters and gauges.
+
+    :param profile_stage: Name of a stage to run under cProfile and tracemalloc, None to disable profiling
+    :param profile_directory: The directory where the profile of the stage is written
+    """
+
+    def __init__(self, profile_stage: str = None, profile_directory: str = "."):
+        self.profile_stage = profile_stage
+        self.profile_directory = profile_directory
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # stage -> {"wall_seconds", "cpu_seconds", "count"}
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.counters: Dict[str, float] = {}
+            self.gauges: Dict[str, float] = {}
+            self.started_at = time.time()
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def span(self, stage: str):
+        """Measure the wall and CPU time of a stage. CPU time is the one of the whole process."""
+        profiler = None
+        if stage == self.profile_stage:
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            profiler.enable()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if profiler is not None:
+                profiler.disable()
+                self._write_profile(stage, profiler)
+            with self._lock:
+                measure = self.stages.setdefault(
+                    stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "count": 0}
+                )
+                measure["wall_seconds"] += wall
+                measure["cpu_seconds"] += cpu
+                measure["count"] += 1
+            logger.info("Stage %s done in %.3fs (cpu %.3fs)", stage, wall, cpu)
+
+    def _write_profile(self, stage: str, profiler: cProfile.Profile):
+        profile_path = os.path.join(self.profile_directory, "%s.prof" % stage)
+        profiler.dump_stats(profile_path)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logger.info(
+            "Profile of stage %s written to %s, peak traced memory %d bytes. Top allocations:\n%s",
+            stage,
+            profile_path,
+            peak,
+            "\n".join(str(s) for s in snapshot.statistics("lineno")[:10]),
+        )
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": time.time() - self.started_at,
+                "stages": {k: dict(v) for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def export_json(self, path: str):
+        _write_atomically(path, json.dumps(self.to_dict(), indent=2))
+
+    def export_prometheus(self, path: str):
+        """Write the metrics in the format of the Prometheus node exporter textfile collector."""
+        summary = self.to_dict()
+        lines = [
+            "# TYPE %s_last_run_timestamp_seconds gauge" % PROMETHEUS_PREFIX,
+            "%s_last_run_timestamp_seconds %f" % (PROMETHEUS_PREFIX, summary["started_at"]),
+            "# TYPE %s_run_duration_seconds gauge" % PROMETHEUS_PREFIX,
+            "%s_run_duration_seconds %f" % (PROMETHEUS_PREFIX, summary["duration_seconds"]),
+        ]
+        for field in ("wall_seconds", "cpu_seconds"):
+            lines.append("# TYPE %s_stage_%s gauge" % (PROMETHEUS_PREFIX, field))
+            for stage, measure in summary["stages"].items():
+                lines.append(
+                    '%s_stage_%s{stage="%s"} %f'
+                    % (PROMETHEUS_PREFIX, field, stage, measure[field])
+                )
+        for name, value in summary["counters"].items():
+            lines.append("# TYPE %s_%s_total counter" % (PROMETHEUS_PREFIX, name))
+            lines.append("%s_%s_total %s" % (PROMETHEUS_PREFIX, name, value))
+        for name, value in summary["gauges"].items():
+            lines.append("# TYPE %s_%s gauge" % (PROMETHEUS_PREFIX, name))
+            lines.append("%s_%s %s" % (PROMETHEUS_PREFIX, name, value))
+        _write_atomically(path, "\n".join(lines) + "\n")
+
+
+def _write_atomically(path: str, content: str):
+    # the textfile collector may read the file at any time, never expose a partial file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
+
+
+# metrics of the current run, shared by the connectors and the bank clients
+metrics = Metrics()
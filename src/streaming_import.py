@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
+
+from banks_clients.bank_client import BankClient
+from firefly_connector import FireflyConnector, StoreResult, StoreStatus
+from metrics import metrics
+from Util.Transactions.Transaction_custom import TransactionCustom
+
+if TYPE_CHECKING:
+    import firefly_iii_client
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+class StreamingImport:
+    """Import the bank operations while they are downloaded.
+
+    Every account is fetched in windows of `chunk_days` days, oldest first, and the operations
+    go through a bounded queue into date partitions. Transfers and duplicates are only matched
+    between operations of the same date, so a day is released as soon as every account has been
+    fetched past it: its operations are reconciled (transfer detection, deduplication, conversion)
+    and the resulting transactions are stored with a bounded number of concurrent calls, while
+    the other days are still downloading.
+    Inside a day, the operations keep the order of the accounts, so the imported transactions are
+    the same as the ones of the batch import.
+
+    :param bank_client: The logged in bank client
+    :param firefly_connector: The Firefly III connector storing the transactions
+    :param reconcile: Function turning the bank operations of one day into the Firefly III transactions to store
+    :param chunk_days: The number of days fetched per bank request
+    :param fetch_workers: The number of accounts fetched at the same time
+    :param queue_size: The maximum number of fetched windows waiting to be partitioned
+    :param max_pending_stores: The maximum number of transactions waiting to be stored,
+        defaults to twice the number of workers of the connector
+    """
+
+    def __init__(
+        self,
+        bank_client: BankClient,
+        firefly_connector: FireflyConnector,
+        reconcile: Callable[
+            [List[TransactionCustom]], List[firefly_iii_client.TransactionSplitStore]
+        ],
+        chunk_days: int = 7,
+        fetch_workers: int = 4,
+        queue_size: int = 16,
+        max_pending_stores: int = None,
+    ):
+        self.bank_client = bank_client
+        self.firefly_connector = firefly_connector
+        self.reconcile = reconcile
+        self.chunk_days = max(1, chunk_days)
+        self.fetch_workers = max(1, fetch_workers)
+        # every fetch worker sends its own bank requests
+        self.bank_client.allow_concurrency(self.fetch_workers)
+        self.queue_size = queue_size
+        self.store_workers = max(1, firefly_connector.max_workers)
+        self.max_pending_stores = max_pending_stores or 2 * self.store_workers
+        # account number -> error raised while fetching its operations
+        self.failed_accounts: Dict[str, Exception] = {}
+
+    def run(
+        self,
+        accounts: List[Any],
+        period_days: int,
+        date_starts: Dict[str, str] = None,
+        now: datetime = None,
+    ) -> List[StoreResult]:
+        """Fetch, reconcile and store the operations of the given accounts.
+        An account whose operations cannot be fetched is logged, recorded in `failed_accounts`
+        and skipped from then on; the days already released keep its operations.
+
+        :param accounts: The bank accounts to import
+        :param period_days: The number of days in the past to fetch the operations for
+        :param date_starts: Start dates (YYYY-MM-DD) by account number overriding the start of the period
+        :param now: The time of the import, the period ends on its day, defaults to the current time
+        :return: The outcome of the creation of each new transaction
+        """
+        date_stop = (now or datetime.now()).date()
+        date_start = date_stop - timedelta(days=period_days)
+        date_starts = date_starts or {}
+        starts = [
+            datetime.strptime(date_starts[number], DATE_FORMAT).date()
+            if number in date_starts
+            else date_start
+            for number in (self.bank_client.account_number(a) for a in accounts)
+        ]
+
+        self.failed_accounts = {}
+        self._windows: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        self._store_slots = threading.BoundedSemaphore(self.max_pending_stores)
+        # the last day fetched for each account, date.max once the account is done
+        frontier = [start - timedelta(days=1) for start in starts]
+        # day -> (account position, arrival order, operation)
+        pending: Dict[date, List[Tuple[int, int, TransactionCustom]]] = defaultdict(list)
+        pending_operations = 0
+        max_pending_operations = 0
+        arrivals = 0
+        store_futures: List[Future] = []
+
+        fetch_executor = ThreadPoolExecutor(
+            max_workers=min(self.fetch_workers, len(accounts) or 1)
+        )
+        store_executor = ThreadPoolExecutor(max_workers=self.store_workers)
+        try:
+            for position, account in enumerate(accounts):
+                fetch_executor.submit(
+                    self._fetch_account, position, account, starts[position], date_stop
+                )
+
+            remaining_accounts = len(accounts)
+            while remaining_accounts:
+                kind, position, payload = self._windows.get()
+                if kind == "window":
+                    window_stop, operations = payload
+                    for t in operations:
+                        pending[t.date.date()].append((position, arrivals, t))
+                        arrivals += 1
+                    pending_operations += len(operations)
+                    frontier[position] = window_stop
+                else:
+                    if payload is not None:
+                        self._record_failure(accounts[position], payload)
+                    frontier[position] = date.max
+                    remaining_accounts -= 1
+                max_pending_operations = max(max_pending_operations, pending_operations)
+
+                released_until = min(frontier, default=date.max)
+                for day in sorted(d for d in pending if d <= released_until):
+                    partition = pending.pop(day)
+                    pending_operations -= len(partition)
+                    self._release(day, partition, store_executor, store_futures)
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            fetch_executor.shutdown(wait=True, cancel_futures=True)
+            # transactions already handed to the store stage are stored in any case
+            store_executor.shutdown(wait=True)
+
+        metrics.set_gauge("streaming_max_pending_operations", max_pending_operations)
+        results = [f.result() for f in store_futures]
+        logger.info(
+            "Streaming import: %s stored, %s rejected as duplicates, %s failed",
+            *(
+                sum(1 for r in results if r.status == status)
+                for status in (StoreStatus.STORED, StoreStatus.DUPLICATE, StoreStatus.FAILED)
+            ),
+        )
+        return results
+
+    def _fetch_account(self, position: int, account: Any, start: date, stop: date):
+        error = None
+        try:
+            window_start = start
+            while window_start <= stop and not self._stop.is_set():
+                window_stop = min(stop, window_start + timedelta(days=self.chunk_days - 1))
+                operations = self.bank_client.list_account_transactions(
+                    account,
+                    window_start.strftime(DATE_FORMAT),
+                    window_stop.strftime(DATE_FORMAT),
+                )
+                self._put(("window", position, (window_stop, operations)))
+                window_start = window_stop + timedelta(days=1)
+        except Exception as e:
+            error = e
+        self._put(("done", position, error))
+
+    def _put(self, item):
+        # wait for room in the queue unless the import was stopped
+        while not self._stop.is_set():
+            try:
+                self._windows.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _release(
+        self,
+        day: date,
+        partition: List[Tuple[int, int, TransactionCustom]],
+        store_executor: ThreadPoolExecutor,
+        store_futures: List[Future],
+    ):
+        # the order of the batch import: accounts in order, operations in the order of the bank
+        partition.sort(key=lambda p: p[:2])
+        metrics.increment("streaming_partitions_released")
+        logger.debug("Releasing the %s operations of %s", len(partition), day)
+        for transaction in self.reconcile([t for _, _, t in partition]):
+            # bounded buffer between reconciliation and storage
+            self._store_slots.acquire()
+            future = store_executor.submit(
+                self.firefly_connector.create_firefly_transaction, transaction
+            )
+            future.add_done_callback(lambda _: self._store_slots.release())
+            store_futures.append(future)
+
+    def _record_failure(self, account: Any, error: Exception):
+        account_number = self.bank_client.account_number(account)
+        metrics.increment("bank_accounts_failed")
+        self.failed_accounts[account_number] = error
+        logger.error(
+            "Could not fetch the operations of account %s: %r", account_number, error
+        )